@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Headless batch conversion of directory trees
+#
+# Converts every file of the source tree whose syntax can be found from the
+# filetype mappings, using the settings saved by wxhighlight. For example:
+#
+#   python3 hlbatch.py src/ out/ --output html --jobs 8
+#
+# With --image the files are exported as SVG or PNG images instead. With
+# --shared-css the html pages link to one stylesheet instead of embedding
+# the theme css each, and the sizes saved are reported.
+#
+
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import hlconfig
+import hlcore
+import hldoc
+import hlimage
+import hlsite
+import hltoken
+
+
+## Engines of the conversion
+ENGINES = hlcore.ENGINES
+
+## Token backends of the process by theme folder, keeping the themes loaded
+tokenBackends = {}
+
+
+## Convert the source bytes with the engine in this process. Returns
+#  (stdout, stderr).
+def Render(opts, data, engine, exe, themeDir=None):
+    # already in a separate process, no need for the engine pool
+    if engine == hlcore.PygmentsBackend.name:
+        return hlcore.EngineRender(opts, data)
+    if engine == hltoken.TokenBackend.name:
+        backend = tokenBackends.get(themeDir)
+        if backend is None:
+            backend = tokenBackends[themeDir] = hltoken.TokenBackend(themeDir)
+        return backend.Start(opts, data).Wait()
+    if engine == hlcore.HighlightBackend.name:
+        return hlcore.HighlightBackend(exe).Start(opts, data).Wait()
+    return b'', 'Unknown engine %s' % engine
+
+
+## Convert one file, runs in a pool process. The source bytes are passed in
+#  their own encoding and the output bytes written as they are. The html
+#  output is saved as an image if image is set, or linked to the shared
+#  stylesheet at the path css if that is set. themeDir is the folder of the
+#  theme files read by the token engine. Returns (bytes in, bytes out,
+#  error message, bytes out as converted).
+def ConvertFile(src, dst, opts, engine, exe, image=None, dpi=96, css=None,
+        themeDir=None):
+    try:
+        with open(src, 'rb') as f:
+            data = f.read()
+    except Exception as e:
+        return 0, 0, str(e), 0
+
+    encoding = hldoc.DetectEncoding(data[:hldoc.ENCODING_SAMPLE])
+    data, encoding = hlcore.TranscodeSource(data, encoding)
+    opts = opts.Replace(encoding=encoding)
+
+    out, err = Render(opts, data, engine, exe, themeDir)
+    if err != '':
+        return len(data), 0, err, 0
+
+    try:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if image:
+            doc = hlimage.ParseHtml(out.decode(encoding, 'replace'))
+            if doc is None:
+                return len(data), 0, 'no <pre> in the html output', len(out)
+            hlimage.SaveImage(doc, dst, dpi)
+        else:
+            page = out
+            if css is not None:
+                href = os.path.relpath(css, os.path.dirname(dst))
+                page = hlsite.CompactPage(out.decode(encoding, 'replace'),
+                        href).encode(encoding, 'replace')
+            with open(dst, 'wb') as f:
+                f.write(page)
+    except Exception as e:
+        return len(data), 0, str(e), len(out)
+
+    return len(data), os.path.getsize(dst), '', len(out)
+
+
+## Theme stylesheet of the options, from the conversion of an empty source.
+#  Returns '' if the output has none.
+def SharedStylesheet(opts, engine, exe, themeDir=None):
+    opts = opts.Replace(encoding='utf-8')
+    out, err = Render(opts, b'', engine, exe, themeDir)
+    if err != '':
+        return ''
+    return hlsite.SplitStyle(out.decode('utf-8', 'replace'))[0]
+
+
+## Walk the source tree and yield (source, destination, syntax) of the files
+#  to be converted. The output folder is left out if it is in the tree, or
+#  the outputs of the last run would be converted again.
+def CollectFiles(srcdir, dstdir, index, ext):
+    outdir = os.path.realpath(dstdir)
+    for root, dirs, files in os.walk(srcdir):
+        # skip hidden folders and the output
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and
+                os.path.realpath(os.path.join(root, d)) != outdir)
+
+        for name in sorted(files):
+            src = os.path.join(root, name)
+            # linked in from the output
+            if os.path.realpath(src).startswith(outdir + os.sep):
+                continue
+            syntax = index.DetectFile(src)
+            if syntax == '':
+                continue
+            dst = os.path.join(dstdir, os.path.relpath(src, srcdir)) + ext
+            yield src, dst, syntax
+
+
+## Output is newer than the source
+def UpToDate(src, dst):
+    try:
+        return os.path.getmtime(dst) >= os.path.getmtime(src)
+    except OSError:
+        return False
+
+
+## Settings and metadata saved by wxhighlight. The metadata is scanned again
+#  if stale. Returns (meta, settng), meta is None on failure.
+def LoadStore(exe):
+    store = hlconfig.ConfigStore(exe=exe)
+    settng = store.LoadSettings()
+
+    meta = store.LoadMetadata()
+    if meta is None:
+        try:
+            meta = hlconfig.DiscoverParams(exe, store.FileCache())
+        except hlconfig.ConfigError as e:
+            meta = store.LegacyMetadata()
+            if meta is None:
+                print(e.args[0], file=sys.stderr)
+                return None, settng
+        else:
+            try:
+                store.SaveMetadata(meta)
+            except OSError:
+                pass
+
+    meta = dict(meta, ftmaps=store.Ftmaps())
+    return meta, settng
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Convert a directory tree with Highlight.')
+    parser.add_argument('srcdir', help='source folder')
+    parser.add_argument('dstdir', help='output folder')
+    parser.add_argument('-c', '--config',
+            help='legacy wxhighlight.cfg to use instead of the saved settings')
+    parser.add_argument('-o', '--output',
+            help='output format (default: from the settings)')
+    parser.add_argument('-t', '--theme',
+            help='theme description (default: from the settings)')
+    parser.add_argument('-e', '--engine',
+            help='%s (default: from the settings)' % ', '.join(ENGINES))
+    parser.add_argument('-i', '--image', choices=['svg', 'png'],
+            help='export images instead (png needs wx)')
+    parser.add_argument('--dpi', type=int, default=96,
+            help='resolution of the images (default: %(default)s)')
+    parser.add_argument('--shared-css', nargs='?', const='highlight.css',
+            metavar='NAME', help='link the html pages to one stylesheet in '
+            'the output folder (default name: %(const)s)')
+    parser.add_argument('-x', '--exe', default=hlcore.HIGHLIGHT,
+            help='highlight executable (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+            help='number of parallel conversions (default: %(default)s)')
+    parser.add_argument('-f', '--force', action='store_true',
+            help='convert even if the output is up to date')
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help='report the config scan and other details')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else
+            logging.WARNING, format='%(name)s: %(message)s')
+
+    # theme files of the token engine, none with the legacy parameters
+    themeDir = None
+    if args.config:
+        try:
+            (ftmaps, syntax, themes, plugin, output, astyle,
+                    settng) = hlcore.ReadParams(args.config)
+        except Exception as e:
+            print('Failed to read %s: %s' % (args.config, e), file=sys.stderr)
+            return 2
+    else:
+        meta, settng = LoadStore(args.exe)
+        if meta is None:
+            return 2
+        ftmaps = meta['ftmaps']
+        paths = meta.get('paths') or {}
+        if paths.get('config'):
+            themeDir = os.path.join(paths['config'], 'themes')
+        syntax, themes = meta['syntax'], meta['themes']
+        plugin = meta['plugin']
+        output, astyle = meta['output'], meta['astyle']
+
+    # command line overrides the saved settings
+    settng = dict(settng)
+    if args.output:
+        settng['output'] = args.output
+    if args.theme:
+        settng['themes'] = args.theme
+    engine = args.engine or settng.get('engine', 'highlight')
+    if engine not in ENGINES:
+        print('unknown engine %s, use one of %s' % (engine,
+            ', '.join(ENGINES)), file=sys.stderr)
+        return 2
+    # the embedded engines lex with pygments
+    if engine != hlcore.HighlightBackend.name and not hlcore.EngineAvailable():
+        print('pygments is not installed', file=sys.stderr)
+        return 2
+
+    opts = hlcore.SettingsOptions(settng, syntax, output, themes, astyle,
+            plugin)
+    ext = hlcore.OUTPUT_EXT.get(opts.get('output', 'html'), '.out')
+    # images are drawn from the html output
+    if args.image:
+        opts = opts.Replace(output='html')
+        ext = '.' + args.image
+
+    # one stylesheet for the pages, which use the classes
+    css = None
+    if args.shared_css and not args.image:
+        if opts.get('output', 'html') not in ('html', 'xhtml'):
+            print('--shared-css needs the html or xhtml output',
+                    file=sys.stderr)
+            return 2
+        opts = opts.Replace(inlcss=False)
+        style = SharedStylesheet(opts, engine, args.exe, themeDir)
+        if style == '':
+            print('no stylesheet in the %s output' % engine, file=sys.stderr)
+            return 2
+        css = os.path.abspath(os.path.join(args.dstdir, args.shared_css))
+        os.makedirs(os.path.dirname(css), exist_ok=True)
+        with open(css, 'w', encoding='utf-8') as f:
+            f.write(style)
+
+    start = time.perf_counter()
+    done = skipped = failed = 0
+    nbytes_in = nbytes_out = nbytes_conv = 0
+
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = {}
+        index = hlcore.FiletypeIndex(ftmaps, syntax)
+        for src, dst, lang in CollectFiles(args.srcdir, args.dstdir, index,
+                ext):
+            if not args.force and UpToDate(src, dst):
+                skipped += 1
+                continue
+            # syntax of each file from the filetype mappings
+            fopts = opts.Replace(syntax=lang)
+            futures[pool.submit(ConvertFile, src, dst, fopts, engine,
+                    args.exe, args.image, args.dpi, css, themeDir)] = src
+
+        for future in as_completed(futures):
+            size_in, size_out, err, size_conv = future.result()
+            nbytes_in += size_in
+            if err != '':
+                failed += 1
+                print('%s: %s' % (futures[future], err.strip()),
+                        file=sys.stderr)
+            else:
+                done += 1
+                nbytes_out += size_out
+                nbytes_conv += size_conv
+
+    elapsed = time.perf_counter() - start
+
+    # throughput report
+    print('%d converted, %d up to date, %d failed in %.2f s'
+            % (done, skipped, failed, elapsed))
+    if elapsed > 0:
+        print('%.1f files/s, %.2f MB/s in, %.2f MB/s out'
+                % (done / elapsed, nbytes_in / elapsed / 1e6,
+                    nbytes_out / elapsed / 1e6))
+
+    # byte counts of the shared stylesheet against the embedded ones
+    if css is not None:
+        size_css = os.path.getsize(css)
+        print('%d bytes of html and %d bytes of %s, %d bytes with the styles '
+                'embedded' % (nbytes_out, size_css, args.shared_css,
+                    nbytes_conv))
+        if nbytes_conv > 0:
+            print('%.1f%% smaller' % (100 - (nbytes_out + size_css) * 100 /
+                nbytes_conv))
+
+    return 1 if failed else 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Benchmark of the conversion pipeline
+#
+# Runs the OnConvert pipeline headlessly over a generated corpus, through the
+# ConvertWorker and the backend of the engine chosen as the GUI does, and
+# reports per-stage latency percentiles and throughput. Results are written
+# as JSON so that revisions can be compared:
+#
+#   python3 hlbench.py --stub --json base.json
+#   python3 hlbench.py --stub --json new.json --compare base.json
+#
+# --stub runs a stand-in highlight that only escapes the input, which
+# measures the pipeline overhead. --widgets adds the WebView and TextCtrl
+# stages, which need wx and a display. --startup adds the time the GUI takes
+# to show its window, also needing a display.
+#
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import hlcore
+
+
+## Stand-in for highlight: escapes stdin into a minimal html page
+STUB = r'''#!%s
+import html
+import sys
+
+lineno = '--line-numbers' in sys.argv
+data = sys.stdin.buffer.read().decode('utf-8')
+out = open(sys.stdout.fileno(), 'w', encoding='utf-8', closefd=False)
+out.write('<!DOCTYPE html>\n<html>\n<head>\n<style>\n'
+        '.hl { color:#000000; background-color:#ffffff; }\n'
+        '</style>\n</head>\n<body class="hl">\n<pre class="hl">')
+for idx, line in enumerate(data.splitlines()):
+    if lineno:
+        out.write('<span class="hl lin">%%5d </span>' %% (idx + 1))
+    out.write(html.escape(line) + '\n')
+out.write('</pre>\n</body>\n</html>\n')
+out.flush()
+'''
+
+## Source templates of the generated corpus, one repeating unit per syntax
+TEMPLATES = {
+    'c': '''/* block comment %d */
+static int func_%d(int a, const char *s)
+{
+    int i;
+    for (i = 0; i < a; i++) {
+        if (s[i] == '\\n') { return i * %d; }
+    }
+    return -1; // not found
+}
+''',
+    'python': '''# comment %d
+def func_%d(a, s="text"):
+    """Docstring of the function."""
+    for i in range(a):
+        if s[i] == "\\n":
+            return i * %d
+    return None
+''',
+    'js': '''// comment %d
+function func_%d(a, s) {
+    for (let i = 0; i < a; i++) {
+        if (s[i] === "\\n") { return i * %d; }
+    }
+    return null; /* not found */
+}
+''',
+}
+
+## Option variants
+VARIANTS = {
+    'plain': {},
+    'lineno': {'lineno':True, 'linestart':1},
+    'reformat': {'reformat':'allman'},
+}
+
+## Stages reported in order
+STAGES = ['command', 'spawn', 'execute', 'decode', 'webview', 'textview',
+        'total']
+
+
+## Parse the size with K/M suffix
+def ParseSize(text):
+    text = text.strip().upper()
+    scale = {'K':1 << 10, 'M':1 << 20}.get(text[-1:], 1)
+    if text[-1:] in 'KM':
+        text = text[:-1]
+    return int(float(text) * scale)
+
+
+## Generate the source of the syntax, about size bytes long
+def Generate(syntax, size):
+    template = TEMPLATES[syntax]
+    parts = []
+    total = 0
+    idx = 0
+    while total < size:
+        part = template % (idx, idx, idx)
+        parts.append(part)
+        total += len(part)
+        idx += 1
+    return ''.join(parts)[:size]
+
+
+## Write the stub highlight and return its path
+def WriteStub(folder):
+    path = os.path.join(folder, 'highlight-stub')
+    with open(path, 'w') as f:
+        f.write(STUB % sys.executable)
+    os.chmod(path, 0o755)
+    return path
+
+
+## Widgets of the GUI pipeline, created on demand
+class Widgets:
+
+    def __init__(self):
+        import wx
+        import wx.html2 as html2
+
+        self.wx = wx
+        self.app = wx.App(False)
+        self.frame = wx.Frame(None, size=(800,600))
+        self.webView = html2.WebView.New(self.frame)
+        self.textOut = wx.TextCtrl(self.frame,
+                style=wx.TE_MULTILINE|wx.TE_READONLY)
+        self.loaded = False
+        self.webView.Bind(html2.EVT_WEBVIEW_LOADED, self.OnLoaded)
+
+    def OnLoaded(self, evt):
+        self.loaded = True
+
+    ## Render the page and wait until loaded
+    def SetPage(self, text, timeout=60.0):
+        self.loaded = False
+        self.webView.SetPage(text, '')
+        limit = time.perf_counter() + timeout
+        while not self.loaded and time.perf_counter() < limit:
+            self.wx.Yield()
+            time.sleep(0.001)
+
+    def SetValue(self, text):
+        self.textOut.SetValue(text)
+
+
+## Run one conversion through the worker of the GUI and return the stage
+#  timings in seconds. The worker has no cache, every run converts.
+def RunOnce(worker, opts, text, widgets):
+    # nor does the token engine keep the lexed source of the last run
+    if worker.backend.name == 'tokens':
+        worker.backend.Forget()
+
+    timing = {}
+    start = time.perf_counter()
+
+    # options and source bytes, as the GUI prepares them
+    t = time.perf_counter()
+    opts = hlcore.ConvertOptions.Of(opts)
+    data, encoding = hlcore.EncodeSource(text, opts.encoding or 'utf-8')
+    opts = opts.Replace(encoding=encoding)
+    timing['command'] = time.perf_counter() - t
+
+    # the worker calls back from its thread
+    done = threading.Event()
+    result = []
+    def Done(seq, out, err):
+        result.extend([out, err])
+        done.set()
+
+    worker.callback = Done
+    worker.Submit(opts, data)
+    done.wait()
+    out, err = result
+    if err != '':
+        raise RuntimeError(err.strip())
+
+    # process creation and the engine itself, as timed by the worker
+    last = {item['stage']:item['last'] for item in worker.stats.Summary()}
+    timing['spawn'] = last.get('spawn', 0.0)
+    timing['execute'] = last.get('highlight', 0.0)
+
+    # output decode, for the widgets
+    t = time.perf_counter()
+    out = out.decode(encoding)
+    timing['decode'] = time.perf_counter() - t
+
+    if widgets is not None:
+        t = time.perf_counter()
+        widgets.SetPage(out)
+        timing['webview'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        widgets.SetValue(out)
+        timing['textview'] = time.perf_counter() - t
+
+    timing['total'] = time.perf_counter() - start
+    timing['bytes_out'] = len(out)
+    return timing
+
+
+## Start the GUI until its window is up, returns the startup time
+def RunStartup():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'wxhighlight.py')
+    proc = subprocess.run([sys.executable, path, '--startup'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    for line in proc.stdout.decode('utf-8', 'replace').splitlines():
+        if line.startswith('startup '):
+            elapsed = float(line.split()[1])
+            return {'total':elapsed, 'bytes_out':0}
+    raise RuntimeError(proc.stderr.decode('utf-8', 'replace').strip() or
+            'no startup time reported')
+
+
+## Summary of the runs of a case
+def Summarize(runs, size):
+    result = {'runs':len(runs), 'bytes_in':size,
+            'bytes_out':runs[0]['bytes_out'] if runs else 0, 'stages':{}}
+
+    for stage in STAGES:
+        values = [r[stage] for r in runs if stage in r]
+        if not values:
+            continue
+        result['stages'][stage] = {
+                'p50':hlcore.Percentile(values, 50),
+                'p90':hlcore.Percentile(values, 90),
+                'p99':hlcore.Percentile(values, 99),
+                'mean':sum(values) / len(values)}
+
+    total = result['stages']['total']['p50'] if runs else 0
+    result['mb_per_s'] = size / total / 1e6 if total > 0 else 0
+    return result
+
+
+## Print the comparison against the baseline results
+def Compare(results, baseline):
+    base = {c['name']:c for c in baseline['cases']}
+    print('\n%-28s %10s %10s %8s' % ('case', 'base p50', 'new p50', 'ratio'))
+    for case in results['cases']:
+        old = base.get(case['name'])
+        if old is None:
+            continue
+        a = old['stages']['total']['p50']
+        b = case['stages']['total']['p50']
+        print('%-28s %8.2fms %8.2fms %7.2fx' % (case['name'], a * 1000,
+            b * 1000, b / a if a > 0 else 0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Benchmark the wxhighlight conversion pipeline.')
+    parser.add_argument('--sizes', default='1K,16K,256K,4M,100M',
+            help='source sizes (default: %(default)s)')
+    parser.add_argument('--syntax', default=','.join(TEMPLATES),
+            help='languages (default: %(default)s)')
+    parser.add_argument('--variants', default=','.join(VARIANTS),
+            help='option variants (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+            help='runs per case (default: %(default)s)')
+    parser.add_argument('--exe', default=hlcore.HIGHLIGHT,
+            help='highlight executable (default: %(default)s)')
+    parser.add_argument('--stub', action='store_true',
+            help='use the stand-in highlight')
+    parser.add_argument('--engine', default='highlight',
+            choices=['highlight', 'pygments', 'tokens'],
+            help='conversion engine (default: %(default)s)')
+    parser.add_argument('--widgets', action='store_true',
+            help='include the WebView and TextCtrl stages (needs wx)')
+    parser.add_argument('--startup', action='store_true',
+            help='include the GUI startup time (needs wx)')
+    parser.add_argument('--json', help='write the results to the file')
+    parser.add_argument('--compare', help='baseline results to compare with')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.TemporaryDirectory()
+    exe = WriteStub(tmpdir.name) if args.stub else args.exe
+    try:
+        backend = hlcore.MakeBackend(args.engine, exe)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    widgets = Widgets() if args.widgets else None
+    # the backend and the worker of the GUI
+    worker = hlcore.ConvertWorker(None, backend)
+
+    results = {'python':platform.python_version(),
+            'platform':platform.platform(), 'engine':args.engine,
+            'exe':'stub' if args.stub else exe, 'time':time.time(),
+            'cases':[]}
+
+    print('%-28s %9s %9s %9s %9s %9s' % ('case', 'spawn', 'execute',
+        'total p50', 'total p90', 'MB/s'))
+
+    for size in [ParseSize(s) for s in args.sizes.split(',')]:
+        for syntax in args.syntax.split(','):
+            text = Generate(syntax, size)
+
+            for variant in args.variants.split(','):
+                opts = dict(VARIANTS[variant], syntax=syntax, output='html',
+                        style='edit-vim', encoding='utf-8')
+                name = '%s/%s/%d' % (syntax, variant, size)
+
+                try:
+                    runs = [RunOnce(worker, opts, text, widgets)
+                            for i in range(args.repeat)]
+                except Exception as e:
+                    print('%-28s failed: %s' % (name, e))
+                    continue
+
+                case = Summarize(runs, size)
+                case['name'] = name
+                results['cases'].append(case)
+
+                st = case['stages']
+                print('%-28s %7.2fms %7.2fms %7.2fms %7.2fms %9.2f' % (name,
+                    st['spawn']['p50'] * 1000, st['execute']['p50'] * 1000,
+                    st['total']['p50'] * 1000, st['total']['p90'] * 1000,
+                    case['mb_per_s']))
+
+    if args.startup:
+        try:
+            runs = [RunStartup() for i in range(args.repeat)]
+        except Exception as e:
+            print('%-28s failed: %s' % ('startup', e))
+        else:
+            case = Summarize(runs, 0)
+            case['name'] = 'startup'
+            results['cases'].append(case)
+            st = case['stages']
+            print('%-28s %9s %9s %7.2fms %7.2fms' % ('startup', '', '',
+                st['total']['p50'] * 1000, st['total']['p90'] * 1000))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            Compare(results, json.load(f))
+
+    worker.Stop()
+    worker.backend.Close()
+    tmpdir.cleanup()
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Clipboard payloads made on demand. No wx dependency except for
+#           the PNG image.
+#
+# A copy offers the output as plain text, html, rtf and a PNG image. Nothing
+# is made at the time of the copy; each payload is made when a program asks
+# for it on paste and kept for the pastes that follow:
+#
+#   clip = ClipPayloads(renderer, opts, data, output)
+#   html = clip.Get('html')
+#
+
+import logging
+import threading
+import time
+
+from hlcore import ConvertOptions
+from hlimage import CSS_DPI, ParseHtml, PngBytes
+
+
+log = logging.getLogger('wxhighlight')
+
+## Payloads offered, the output as it is first
+FORMATS = ('text', 'html', 'rtf', 'png')
+
+
+## Payloads of one copy. The output shown is given as text, the others are
+#  converted from the source bytes with the options of the output by the
+#  hlrender.Renderer.
+class ClipPayloads:
+
+    def __init__(self, renderer, opts, data, output, dpi=CSS_DPI,
+            stats=None):
+        self.renderer = renderer
+        self.opts = ConvertOptions.Of(opts)
+        self.data = data
+        self.output = output
+        self.dpi = dpi
+        self.stats = stats
+        # payloads made so far, and the errors of those that failed
+        self.made = {}
+        self.errors = {}
+        self.lock = threading.RLock()
+
+    ## Payload of the format, made on the first call. Returns None if it
+    #  could not be made, the error is kept in errors.
+    def Get(self, name):
+        with self.lock:
+            if name in self.made:
+                return self.made[name]
+            if name in self.errors:
+                return None
+
+            start = time.perf_counter()
+            try:
+                payload = getattr(self, name.capitalize())()
+            except Exception as e:
+                log.warning('clipboard %s: %s', name, e)
+                self.errors[name] = str(e)
+                return None
+
+            if self.stats is not None:
+                self.stats.Add('clipboard ' + name,
+                        time.perf_counter() - start, len(self.data),
+                        len(payload))
+            self.made[name] = payload
+            return payload
+
+    ## Output as it is shown
+    def Text(self):
+        return self.output
+
+    ## Html of the output, converted if the output is in another format
+    def Html(self):
+        if self.opts.output in ('', 'html', 'xhtml'):
+            return self.output
+        # the styles go with the pasted fragment
+        return self.Convert(output='html', inlcss=True)
+
+    ## Rtf of the output, converted if the output is in another format
+    def Rtf(self):
+        if self.opts.output == 'rtf':
+            text = self.output
+        else:
+            text = self.Convert(output='rtf')
+        # control words escape anything outside ascii
+        return text.encode('ascii', 'replace')
+
+    ## PNG image of the html. Needs a running wx.App.
+    def Png(self):
+        doc = ParseHtml(self.Get('html') or '')
+        if doc is None:
+            raise ValueError(self.errors.get('html', 'No image of the output'))
+        return PngBytes(doc, self.dpi)
+
+    ## Source converted with the options changed, as text
+    def Convert(self, **kwgs):
+        opts = self.opts.Replace(**kwgs)
+        stdout = self.renderer.RenderBytes(opts, self.data)
+        return stdout.decode(opts.encoding or 'utf-8', 'replace')
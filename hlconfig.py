@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Settings and highlight metadata store. No wx dependency.
+#
+# User settings and the metadata discovered from the highlight installation
+# (filetype mappings, syntax, themes and plugins) are kept apart in the user
+# config folder:
+#
+#   settings.json   user settings, small and always loaded
+#   metadata.json   choice lists, regenerated when highlight changes
+#   ftmaps.json     filetype mappings, loaded on first use
+#   files.json      descriptions of the config files by (path, mtime, size)
+#
+# The metadata carries a stamp of the highlight config folders. It is
+# discarded when the stamp no longer matches, so that the next start scans
+# the installation again.
+#
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run, PIPE
+
+import hlcore
+
+
+log = logging.getLogger('wxhighlight')
+
+## Number of threads reading the config files
+SCAN_THREADS = 8
+
+## Version of settings.json. Older settings are merged into the defaults.
+SETTINGS_VERSION = 1
+
+## Version of metadata.json and ftmaps.json. Older ones are discarded.
+#  2: shebang patterns in the filetype mappings
+METADATA_VERSION = 2
+
+## Default user settings
+DEFAULT_SETTINGS = {'themes':'vim molokai', 'syntax':'C and C++',
+        'output':'html', 'astyle':' ', 'plugin':None,
+        'hlfont': 'Courier New', 'fntsiz':'10', 'engine':'highlight',
+        'imgdpi':'96',
+        'option':{'lineno':1, 'wrapln':0, 'inlcss':0} }
+
+## Outputs formats
+OUTPUT_FORMATS = {'html':'html','xhtml':'xhtml','latex':'latex',
+        'tex':'tex','odt':'odt','rtf':'rtf','ansi':'ansi','svg':'svg',
+        'xterm256':'xterm256','truecolor':'truecolor','pango':'pango',
+        'bbcode':'bbcode'}
+
+## Reformat styles
+ASTYLE_STYLES = {' ':' ','allman':'allman','banner':'banner',
+        'gnu':'gnu', 'horstmann':'horstmann','java':'java','kr':'kr',
+        'linux':'linux','mozilla':'mozilla','pico':'pico','lisp':'lisp'}
+
+
+## Failure in reading the highlight configuration. args are (message, title).
+class ConfigError(Exception):
+    pass
+
+
+## Per-user config folder
+def UserConfigDir():
+    if 'nt' in os.name:
+        base = os.environ.get('APPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CONFIG_HOME',
+                os.path.join(os.path.expanduser('~'), '.config'))
+    return os.path.join(base, 'wxhighlight')
+
+
+## Get the Description string from the file
+def GetDescription(fname):
+    try:
+        with open(fname, 'r', errors='replace') as f:
+            for line in f:
+                if 'Description' in line:
+                    return line[line.find('"')+1:line.rfind('"')]
+    except:
+        pass
+    return ''
+
+
+## Get the Filename from the path string
+def GetFileName(fpath):
+    return os.path.splitext(os.path.basename(fpath))[0]
+
+
+## Get the descriptions of the config files. cache maps path to
+#  [mtime_ns, size, description] of the previous scan; only new or changed
+#  files are read, by a pool of threads. Returns (descriptions, new cache,
+#  number of files read).
+def ScanDescriptions(paths, cache=None):
+    cache = cache or {}
+    result = {}
+    todo = []
+
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entry = cache.get(path)
+        if entry is not None and entry[:2] == [st.st_mtime_ns, st.st_size]:
+            result[path] = entry
+        else:
+            todo.append((path, [st.st_mtime_ns, st.st_size]))
+
+    if todo:
+        with ThreadPoolExecutor(max_workers=SCAN_THREADS) as pool:
+            descs = pool.map(GetDescription, [path for path, key in todo])
+            for (path, key), desc in zip(todo, descs):
+                result[path] = key + [desc]
+
+    return ({path:entry[2] for path, entry in result.items()}, result,
+            len(todo))
+
+
+## Stamp of the highlight installation: executable, filetype config and the
+#  files in the config folders. Any change gives a different stamp.
+def ConfigStamp(exe, paths):
+    h = hashlib.sha1()
+    items = [exe, paths['ftcfg']]
+    for sub in ('themes', 'langDefs', 'plugins'):
+        folder = os.path.join(paths['config'], sub)
+        items.append(folder)
+        try:
+            items.extend(sorted(e.path for e in os.scandir(folder)))
+        except OSError:
+            pass
+
+    for item in items:
+        try:
+            st = os.stat(item)
+        except OSError:
+            h.update(('%s:-\n' % item).encode('utf-8', 'replace'))
+        else:
+            h.update(('%s:%d:%d\n' % (item, st.st_mtime_ns, st.st_size)
+                ).encode('utf-8', 'replace'))
+    return h.hexdigest()
+
+
+## Parse the filetype config file (filetypes.conf) into the mappings
+def ParseFiletypes(ftcfg):
+    # filetype mappings
+    ftmaps = {'Extensions':{},'Filenames':{},'Shebangs':{}}
+    saved = ''
+
+    for line in ftcfg:
+        # previous line continues
+        if saved != '':
+            # concatenate two lines
+            line = saved.rstrip('\r\n') + line.strip(' ')
+            # clear cache
+            saved = ''
+
+        # file extensions
+        if 'Lang' in line and 'Extensions' in line:
+            # unfinished line
+            if line.count('{') != line.count('}'):
+                # something is not right
+                if saved != '':
+                    # clear saved to prevent error propagation
+                    saved = ''
+                # line continues
+                else:
+                    # save current line to join next
+                    saved = line
+
+            else:
+                keys = line[line.find('Extensions')+12 : line.rfind(',')]
+                value = line[line.find('Lang')+6 : line.find('",')]
+                for key in keys.split(','):
+                    key = key.lstrip('" ').rstrip('" }')
+                    ftmaps['Extensions'][key] = value
+
+        # file names
+        elif 'Lang' in line and 'Filenames' in line:
+            # unfinished line
+            if line.count('{') != line.count('}'):
+                # something is not right
+                if saved != '':
+                    # clear saved to prevent error propagation
+                    saved = ''
+                # line continues
+                else:
+                    # save current line to join next
+                    saved = line
+
+            else:
+                keys = line[line.find('Filenames')+11 : line.rfind('"}') + 1]
+                value = line[line.find('Lang')+6 : line.find('",')]
+                for key in keys.split(','):
+                    key = key.lstrip('" ').rstrip('" ')
+                    ftmaps['Filenames'][key] = value
+
+        # shebang, the pattern is within [[ ]]
+        elif 'Lang' in line and 'Shebang' in line:
+            key = line[line.find('[[')+2 : line.rfind(']]')]
+            value = line[line.find('Lang')+6 : line.find('",')]
+            if key != '' and value != '':
+                ftmaps['Shebangs'][key] = value
+
+        # ignore empty line
+        elif line == '':
+            pass
+
+    return ftmaps
+
+
+## Query the highlight installation. Returns the metadata dict with the keys
+#  ftmaps, syntax, themes, plugin, output, astyle, paths, stamp and files,
+#  the latter being the file cache for the next scan (see ScanDescriptions).
+#  Raises ConfigError on failure.
+def DiscoverParams(exe=hlcore.HIGHLIGHT, files=None):
+    start = time.perf_counter()
+
+    # config folders and filetype config file
+    cmd = [exe, '--print-config']
+
+    # query config settings
+    try:
+        p = run(cmd, stdout=PIPE)
+    except:
+        raise ConfigError('Make sure that Highlight is installed properly',
+                'Highlight Execution Error')
+
+    # collect output
+    # paths may be non-ascii
+    output = p.stdout.decode('utf-8', 'replace').splitlines()
+    config_path = ftcfg_path = None
+
+    for idx, line in enumerate(output):
+        # read config file search path
+        if line == 'Config file search directories:':
+            config_path = output[idx+1]
+        # read filetype config file location
+        elif line == 'Filetype config file:':
+            ftcfg_path = output[idx+1]
+
+    try:
+        # open filetype config
+        with open(ftcfg_path, 'r', errors='replace') as ftcfg:
+            ftmaps = ParseFiletypes(ftcfg)
+        # enumerate other config files
+        themes = glob.glob(os.path.join(config_path, 'themes', '*.theme'))
+        syntax = glob.glob(os.path.join(config_path, 'langDefs', '*.lang'))
+        plugin = glob.glob(os.path.join(config_path, 'plugins', '*.lua'))
+    except:
+        raise ConfigError('Failed to retrieve config files',
+                'Hightlight Config Read Error')
+
+    meta = {'ftmaps':ftmaps, 'output':dict(OUTPUT_FORMATS),
+            'astyle':dict(ASTYLE_STYLES),
+            'paths':{'config':config_path, 'ftcfg':ftcfg_path}}
+
+    # read the descriptions of the changed files
+    desc, meta['files'], nread = ScanDescriptions(themes + syntax + plugin,
+            files)
+
+    # themes, description as key
+    meta['themes'] = {desc.get(item, ''):GetFileName(item)
+            for item in themes}
+    # syntax (langDefs), description as key
+    meta['syntax'] = {desc.get(item, ''):GetFileName(item)
+            for item in syntax}
+    # plugin, file name as key
+    meta['plugin'] = {GetFileName(item):desc.get(item, '')
+            for item in plugin}
+
+    meta['stamp'] = ConfigStamp(exe, meta['paths'])
+
+    log.info('config scan: %d files, %d read in %.1f ms',
+            len(themes) + len(syntax) + len(plugin), nread,
+            (time.perf_counter() - start) * 1000)
+    return meta
+
+
+## Write a json file atomically
+def WriteJson(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+## Read a json file, None if missing or broken
+def ReadJson(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except:
+        return None
+
+
+## Settings and metadata store in the user config folder
+class ConfigStore:
+
+    def __init__(self, folder=None, exe=hlcore.HIGHLIGHT):
+        self.folder = folder or UserConfigDir()
+        self.exe = exe
+        # filetype mappings, loaded on demand
+        self.ftmaps = None
+
+    ## Path of the store file
+    def Path(self, name):
+        return os.path.join(self.folder, name)
+
+    ## Legacy pickled parameters (wxhighlight.cfg), None if not found
+    def LegacyParams(self):
+        for folder in (os.getcwd(), os.path.dirname(os.path.abspath(__file__))):
+            try:
+                return hlcore.ReadParams(os.path.join(folder,
+                    'wxhighlight.cfg'))
+            except:
+                continue
+        return None
+
+    ## Metadata from the legacy parameters, None if not found. It cannot be
+    #  checked against the installation, use it only if a scan fails.
+    def LegacyMetadata(self):
+        params = self.LegacyParams()
+        if params is None:
+            return None
+        keys = ('ftmaps', 'syntax', 'themes', 'plugin', 'output', 'astyle')
+        meta = dict(zip(keys, params))
+        self.ftmaps = meta['ftmaps']
+        return meta
+
+    ## Load the user settings, defaults for the missing ones
+    def LoadSettings(self):
+        settng = dict(DEFAULT_SETTINGS)
+        settng['option'] = dict(DEFAULT_SETTINGS['option'])
+
+        data = ReadJson(self.Path('settings.json'))
+        if data is not None and isinstance(data.get('settng'), dict):
+            saved = data['settng']
+        else:
+            # first run, import the legacy settings if any
+            params = self.LegacyParams()
+            saved = params[6] if params is not None else {}
+
+        # merge, so that settings added by newer versions get the defaults
+        for key, value in saved.items():
+            if key == 'option' and isinstance(value, dict):
+                settng['option'].update(value)
+            else:
+                settng[key] = value
+        return settng
+
+    ## Save the user settings
+    def SaveSettings(self, settng):
+        os.makedirs(self.folder, exist_ok=True)
+        WriteJson(self.Path('settings.json'),
+                {'version':SETTINGS_VERSION, 'settng':settng})
+
+    ## Load the metadata without the filetype mappings. Returns None if not
+    #  found, of an older version, or stale. Checking the installation is
+    #  skipped if check is False.
+    def LoadMetadata(self, check=True):
+        meta = ReadJson(self.Path('metadata.json'))
+        if meta is None or meta.get('version') != METADATA_VERSION:
+            return None
+        if not check:
+            return meta
+
+        # highlight installation has changed
+        try:
+            if meta['stamp'] != ConfigStamp(self.exe, meta['paths']):
+                return None
+        except:
+            return None
+
+        return meta
+
+    ## Save the metadata discovered by DiscoverParams
+    def SaveMetadata(self, meta):
+        os.makedirs(self.folder, exist_ok=True)
+
+        # filetype mappings and file cache go to their own files
+        meta = dict(meta, version=METADATA_VERSION)
+        self.ftmaps = meta.pop('ftmaps')
+        WriteJson(self.Path('ftmaps.json'),
+                {'version':METADATA_VERSION, 'ftmaps':self.ftmaps})
+        files = meta.pop('files', None)
+        if files is not None:
+            WriteJson(self.Path('files.json'),
+                    {'version':METADATA_VERSION, 'files':files})
+        WriteJson(self.Path('metadata.json'), meta)
+
+    ## File cache of the previous scan, for DiscoverParams
+    def FileCache(self):
+        data = ReadJson(self.Path('files.json'))
+        if data is not None and data.get('version') == METADATA_VERSION:
+            return data['files']
+        return None
+
+    ## Filetype mappings, loaded on first use
+    def Ftmaps(self):
+        if self.ftmaps is None:
+            data = ReadJson(self.Path('ftmaps.json'))
+            if data is not None and data.get('version') == METADATA_VERSION:
+                self.ftmaps = data['ftmaps']
+            else:
+                self.ftmaps = {'Extensions':{},'Filenames':{}}
+        return self.ftmaps
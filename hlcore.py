@@ -0,0 +1,1238 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Highlight conversion core. This module does not depend on wx.
+# \see      http://www.andre-simon.de/doku/highlight/en/highlight.php
+#
+
+import codecs
+import hashlib
+import json
+import logging
+import math
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+from dataclasses import dataclass, fields, replace
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import CancelledError
+from subprocess import Popen, PIPE
+
+
+## Highlight executable
+if 'nt' in os.name:
+    HIGHLIGHT = 'c:\\Program Files\\Highlight\\highlight.exe'
+else:
+    HIGHLIGHT = '/usr/bin/highlight'
+
+
+## p-th percentile (0-100) of the values, nearest rank. 0 if empty.
+def Percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, math.ceil(p / 100.0 * len(values)) - 1))
+    return values[rank]
+
+
+## Structured log of the stage timings, one JSON object per message
+statlog = logging.getLogger('wxhighlight.stats')
+
+
+## Timing statistics of the conversion stages. The recent samples of each
+#  stage are kept for the summary, every sample is also logged.
+class Stats:
+
+    def __init__(self, size=200):
+        self.size = size
+        # stage -> deque of (seconds, bytes in, bytes out)
+        self.samples = OrderedDict()
+        self.lock = threading.Lock()
+
+    ## Record a sample
+    def Add(self, stage, seconds, nin=0, nout=0):
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.size)
+            self.samples[stage].append((seconds, nin, nout))
+
+        if statlog.isEnabledFor(logging.INFO):
+            statlog.info(json.dumps({'stage':stage,
+                'ms':round(seconds * 1000, 3), 'in':nin, 'out':nout}))
+
+    ## Context manager timing the block as the stage
+    @contextmanager
+    def Time(self, stage, nin=0, nout=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.Add(stage, time.perf_counter() - start, nin, nout)
+
+    ## Summary as a list of dicts with stage, count, last, mean, p95 (in
+    #  seconds) and the bytes in and out of the last sample
+    def Summary(self):
+        with self.lock:
+            items = [(stage, list(samples)) for stage, samples in
+                    self.samples.items()]
+
+        result = []
+        for stage, samples in items:
+            times = [t for t, nin, nout in samples]
+            result.append({'stage':stage, 'count':len(samples),
+                'last':times[-1], 'mean':sum(times) / len(times),
+                'p95':Percentile(times, 95), 'in':samples[-1][1],
+                'out':samples[-1][2]})
+        return result
+
+
+## Per-user cache folder
+def UserCacheDir():
+    if 'nt' in os.name:
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME',
+                os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'wxhighlight')
+
+
+## Content-addressed cache of highlight output. The key is a hash of the
+#  source text and the complete command line. Recently used results are kept
+#  in memory, and optionally on disk with the total size bounded. The disk
+#  tier outlives the installation it was filled with, so it is only used
+#  once SetStamp() has been given the stamp of the current one.
+class RenderCache:
+
+    def __init__(self, maxBytes=32<<20, cacheDir=None, maxDiskBytes=256<<20):
+        # memory tier: key -> output, in LRU order
+        self.mem = OrderedDict()
+        self.memBytes = 0
+        self.maxBytes = maxBytes
+        # disk tier
+        self.cacheDir = cacheDir
+        self.maxDiskBytes = maxDiskBytes
+        self.diskBytes = None
+        # stamp of the installation the disk tier holds the outputs of
+        self.stamp = None
+        # cache is shared by threads
+        self.lock = threading.Lock()
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+        if cacheDir is not None:
+            try:
+                os.makedirs(cacheDir, exist_ok=True)
+            except:
+                # run without disk tier
+                self.cacheDir = None
+
+    ## Make the cache key for the given options and source bytes
+    @staticmethod
+    def MakeKey(opts, data):
+        h = hashlib.sha256()
+        h.update(str(opts).encode('utf-8'))
+        h.update(b'\0')
+        h.update(data)
+        return h.hexdigest()
+
+    ## Look up the output, None if not cached
+    def Get(self, key):
+        with self.lock:
+            value = self.mem.get(key)
+            if value is not None:
+                self.mem.move_to_end(key)
+                self.hits += 1
+                return value
+
+        # try the disk tier
+        value = self.DiskGet(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.MemPut(key, value)
+        return value
+
+    ## Store the output
+    def Put(self, key, value):
+        with self.lock:
+            self.MemPut(key, value)
+        self.DiskPut(key, value)
+
+    ## Drop everything in the memory tier, and in the disk tier if any
+    def Clear(self):
+        with self.lock:
+            self.mem.clear()
+            self.memBytes = 0
+            if self.cacheDir is None:
+                return
+            for path, size, mtime in self.DiskEntries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.diskBytes = None
+
+    ## Start using the disk tier for the installation of the stamp. The
+    #  entries of another installation are dropped.
+    def SetStamp(self, stamp):
+        if self.cacheDir is None or stamp == self.stamp:
+            return
+
+        path = os.path.join(self.cacheDir, 'stamp')
+        try:
+            with open(path, encoding='utf-8') as f:
+                old = f.read()
+        except OSError:
+            old = None
+
+        if old != stamp:
+            self.Clear()
+            try:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(stamp)
+            except OSError:
+                return
+        self.stamp = stamp
+
+    ## Insert into the memory tier. Caller should hold the lock.
+    def MemPut(self, key, value):
+        size = len(value)
+        # too large to keep in memory
+        if size > self.maxBytes:
+            return
+
+        old = self.mem.pop(key, None)
+        if old is not None:
+            self.memBytes -= len(old)
+
+        self.mem[key] = value
+        self.memBytes += size
+
+        # evict least recently used ones
+        while self.memBytes > self.maxBytes:
+            k, v = self.mem.popitem(last=False)
+            self.memBytes -= len(v)
+
+    ## Path of the disk cache entry
+    def DiskPath(self, key):
+        return os.path.join(self.cacheDir, key + '.out')
+
+    ## Read from the disk tier
+    def DiskGet(self, key):
+        if self.cacheDir is None or self.stamp is None:
+            return None
+
+        path = self.DiskPath(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            # mark as recently used
+            os.utime(path)
+        except:
+            return None
+        else:
+            return value
+
+    ## Write to the disk tier and evict old entries if it grows too large
+    def DiskPut(self, key, value):
+        if self.cacheDir is None or self.stamp is None:
+            return
+
+        if len(value) > self.maxDiskBytes:
+            return
+
+        path = self.DiskPath(key)
+        # size of the entry replaced, if any
+        try:
+            old = os.path.getsize(path)
+        except OSError:
+            old = 0
+        try:
+            # write to a temporary file first, then move it into place
+            tmp = path + '.%d' % threading.get_ident()
+            with open(tmp, 'wb') as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except:
+            return
+
+        with self.lock:
+            if self.diskBytes is None:
+                self.diskBytes = sum(size for path, size, mtime in
+                        self.DiskEntries())
+            else:
+                self.diskBytes += len(value) - old
+
+            if self.diskBytes > self.maxDiskBytes:
+                self.DiskEvict()
+
+    ## List (path, size, mtime) of the disk cache entries
+    def DiskEntries(self):
+        entries = []
+        try:
+            names = os.listdir(self.cacheDir)
+        except:
+            return entries
+
+        for name in names:
+            if not name.endswith('.out'):
+                continue
+            path = os.path.join(self.cacheDir, name)
+            try:
+                st = os.stat(path)
+            except:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    ## Remove oldest disk entries down to 3/4 of the limit
+    def DiskEvict(self):
+        entries = sorted(self.DiskEntries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+
+        for path, size, mtime in entries:
+            if total <= self.maxDiskBytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except:
+                continue
+            total -= size
+
+        self.diskBytes = total
+
+
+## Stamp of the installed engines for the disk cache: the stamp of the
+#  highlight installation from the metadata, and the pygments version
+def CacheStamp(stamp):
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return '%s pygments-%s' % (stamp, version('pygments'))
+    except PackageNotFoundError:
+        return stamp
+
+
+## Size of the pieces in streaming conversion
+CHUNK = 64 << 10
+
+## Output file extensions of the formats
+OUTPUT_EXT = {'html':'.html', 'xhtml':'.xhtml', 'latex':'.tex', 'tex':'.tex',
+        'odt':'.fodt', 'rtf':'.rtf', 'ansi':'.ansi', 'svg':'.svg',
+        'xterm256':'.xterm256', 'truecolor':'.truecolor', 'pango':'.pango',
+        'bbcode':'.bbcode'}
+
+
+## Read the legacy pickled parameters. Returns (ftmaps, syntax, themes, plugin,
+#  output, astyle, settng) or raises an exception if the file cannot be read.
+def ReadParams(fname='wxhighlight.cfg'):
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
+
+
+## Syntax of the extensions missing in filetypes.conf
+EXTRA_EXTENSIONS = {'c':'c', 'md':'md', 'MD':'md'}
+
+## Syntax of the interpreters named on the shebang line, used when none of
+#  the Shebang patterns of filetypes.conf matches
+INTERPRETERS = {'sh':'sh', 'bash':'sh', 'dash':'sh', 'ksh':'sh', 'zsh':'sh',
+        'csh':'tcsh', 'tcsh':'tcsh', 'python':'python', 'perl':'perl',
+        'ruby':'ruby', 'node':'js', 'nodejs':'js', 'lua':'lua', 'php':'php',
+        'tclsh':'tcl', 'wish':'tcl', 'awk':'awk', 'gawk':'awk', 'make':'make',
+        'Rscript':'r', 'julia':'julia', 'groovy':'groovy', 'scala':'scala',
+        'pwsh':'ps1', 'escript':'erlang', 'guile':'lisp', 'sbcl':'lisp'}
+
+## Leading bytes of the content of some file types
+MAGIC = [('<?xml', 'xml'), ('<?php', 'php'), ('<!DOCTYPE html', 'html'),
+        ('<!doctype html', 'html'), ('<html', 'html'), ('<svg', 'svg'),
+        ('%!PS', 'ps'), ('diff --git', 'diff'), ('--- ', 'diff')]
+
+## Number of leading characters looked at in content sniffing
+SNIFF_SIZE = 512
+
+
+## Filetype index built from the filetype mappings. Extensions and file names
+#  are dict lookups, followed by the file name patterns and, for files with
+#  no match, the shebang line and leading bytes of the content.
+class FiletypeIndex:
+
+    ## ftmaps from the metadata, syntax maps description to syntax name
+    def __init__(self, ftmaps, syntax=None):
+        import fnmatch
+        import re
+
+        self.exts = dict(ftmaps.get('Extensions', {}))
+        for key, value in EXTRA_EXTENSIONS.items():
+            self.exts.setdefault(key, value)
+        # extensions in lower case for the case insensitive retry
+        self.lexts = {}
+        for key, value in self.exts.items():
+            self.lexts.setdefault(key.lower(), value)
+
+        # file names, the ones with wildcards become patterns
+        self.names = {}
+        self.globs = []
+        for key, value in ftmaps.get('Filenames', {}).items():
+            if any(c in key for c in '*?['):
+                self.globs.append((re.compile(fnmatch.translate(key)), value))
+            else:
+                self.names[key] = value
+
+        # shebang patterns
+        self.shebangs = []
+        for key, value in ftmaps.get('Shebangs', {}).items():
+            try:
+                self.shebangs.append((re.compile(key), value))
+            except re.error:
+                pass
+
+        # syntax name to description
+        self.desc = {}
+        for key, value in (syntax or {}).items():
+            self.desc.setdefault(value, key)
+
+    ## Syntax name of the file, '' if none found. head is the leading part
+    #  of the content, looked at only if the name gives no answer.
+    def Detect(self, fname, head=''):
+        # file name without the folder
+        fname = os.path.basename(fname)
+
+        # try filename match first
+        value = self.names.get(fname)
+        if value:
+            return value
+
+        # then the file extension
+        if '.' in fname:
+            ext = fname[fname.rfind('.')+1:]
+            value = self.exts.get(ext) or self.lexts.get(ext.lower())
+            if value:
+                return value
+
+        # file name patterns
+        for pattern, value in self.globs:
+            if pattern.match(fname):
+                return value
+
+        return self.Sniff(head)
+
+    ## Syntax name from the content, '' if unknown
+    def Sniff(self, head):
+        if not head:
+            return ''
+        head = head.lstrip('\ufeff')
+
+        # script with shebang line
+        if head.startswith('#!'):
+            line = head.splitlines()[0]
+            for pattern, value in self.shebangs:
+                if pattern.search(line):
+                    return value
+
+            # interpreter name, following env if any
+            words = line[2:].split()
+            if words and os.path.basename(words[0]) == 'env':
+                words = [w for w in words[1:] if not w.startswith('-')]
+            if words:
+                name = os.path.basename(words[0]).rstrip('0123456789.')
+                return INTERPRETERS.get(name, '')
+            return ''
+
+        for magic, value in MAGIC:
+            if head.startswith(magic):
+                return value
+
+        return ''
+
+    ## Syntax of the file on disk, reading the content only when needed
+    def DetectFile(self, path):
+        value = self.Detect(path)
+        if value:
+            return value
+
+        try:
+            with open(path, 'rb') as f:
+                head = f.read(SNIFF_SIZE)
+        except OSError:
+            return ''
+        return self.Sniff(head.decode('latin-1'))
+
+    ## Description of the syntax name, '' if unknown
+    def Describe(self, value):
+        return self.desc.get(value, '')
+
+
+## Conversion options from the settings dict, the counterpart of the controls
+#  for headless use. Descriptions in settng are mapped to highlight names,
+#  the plugin is kept by its file name. Returns a ConvertOptions.
+def SettingsOptions(settng, syntax, output, themes, astyle, plugin=None):
+    opts = {}
+
+    if settng.get('syntax') in syntax:
+        opts['syntax'] = syntax[settng['syntax']]
+    if settng.get('output') in output:
+        opts['output'] = output[settng['output']]
+    if settng.get('astyle') in astyle:
+        opts['reformat'] = astyle[settng['astyle']]
+    if settng.get('themes') in themes:
+        opts['style'] = themes[settng['themes']]
+    if plugin and settng.get('plugin') in plugin:
+        opts['plugin'] = settng['plugin']
+
+    # font
+    if settng.get('hlfont'):
+        opts['font'] = settng['hlfont']
+        if settng.get('fntsiz'):
+            opts['fontsize'] = settng['fntsiz']
+
+    # check box options
+    option = settng.get('option') or {}
+    if option.get('lineno'):
+        opts['lineno'] = True
+    if option.get('wrapln'):
+        opts['wrap'] = True
+    if option.get('inlcss'):
+        opts['inlcss'] = True
+
+    return ConvertOptions.Of(opts)
+
+
+## Encoding of the source bytes fed to the engines, by the encoding of the
+#  file. Highlight reads UTF-8 and the 8-bit encodings only, so the other
+#  unicode encodings are passed as UTF-8. Names are the ones of html.
+def SourceEncoding(encoding=None):
+    try:
+        name = codecs.lookup(encoding or 'utf-8').name
+    except LookupError:
+        return 'utf-8'
+
+    if name.startswith('utf'):
+        return 'utf-8'
+    if name.startswith('iso8859-'):
+        return 'iso-8859-' + name[8:]
+    if name.startswith('cp125'):
+        return 'windows-' + name[2:]
+    return name
+
+
+## Source text to bytes in the encoding. Returns (bytes, encoding), falling
+#  back to UTF-8 if the text has characters the encoding does not have.
+def EncodeSource(text, encoding='utf-8'):
+    try:
+        return text.encode(encoding), encoding
+    except UnicodeEncodeError:
+        return text.encode('utf-8'), 'utf-8'
+
+
+## Source bytes of a file for the engines. They are passed as they are,
+#  unless the encoding cannot be read by highlight. Returns (bytes, encoding).
+def TranscodeSource(data, encoding):
+    target = SourceEncoding(encoding)
+    try:
+        if codecs.lookup(encoding).name == codecs.lookup(target).name:
+            return data, target
+    except LookupError:
+        pass
+    return data.decode(encoding, 'replace').encode(target), target
+
+
+## Conversion options, typed and hashable. The options set are also readable
+#  as a mapping, so opts.get('lineno') and dict(opts) work as with a plain
+#  dict. Being immutable, they serve as the key of the cache.
+#    syntax, output, style, reformat : highlight names (not descriptions)
+#    plugin : file name of a lua plugin
+#    font, fontsize : font face and size
+#    lineno, linestart : line numbering and the starting line number
+#    wrap, inlcss : wrap lines, CSS within each tag
+#    encoding : encoding of the source bytes, which the output keeps
+@dataclass(frozen=True)
+class ConvertOptions(Mapping):
+
+    syntax: str = ''
+    output: str = ''
+    style: str = ''
+    reformat: str = ''
+    plugin: str = ''
+    font: str = ''
+    fontsize: str = ''
+    lineno: bool = False
+    linestart: int = 0
+    wrap: bool = False
+    inlcss: bool = False
+    encoding: str = ''
+
+    ## Options from a dict, or the options themselves. Values are converted
+    #  to the field types, unknown names raise TypeError.
+    @classmethod
+    def Of(cls, opts):
+        if isinstance(opts, cls):
+            return opts
+        types = {f.name:f.type for f in fields(cls)}
+        values = {}
+        for name, value in opts.items():
+            if name not in types:
+                raise TypeError('Unknown conversion option %s' % name)
+            kind = types[name]
+            values[name] = kind(value) if value is not None else kind()
+        return cls(**values)
+
+    ## Copy with some of the options changed
+    def Replace(self, **changes):
+        return replace(self, **changes)
+
+    ## Names of the options set, in the field order
+    def __iter__(self):
+        return (f.name for f in fields(self)
+                if getattr(self, f.name) != f.default)
+
+    def __getitem__(self, name):
+        if name not in self.__dataclass_fields__:
+            raise KeyError(name)
+        value = getattr(self, name)
+        if value == self.__dataclass_fields__[name].default:
+            raise KeyError(name)
+        return value
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    ## Highlight command line, as a list of arguments
+    def Argv(self, exe):
+        argv = [exe]
+
+        # syntax
+        if self.syntax:
+            argv.append('--syntax=' + self.syntax)
+
+        # output format
+        if self.output:
+            argv.append('--out-format=' + self.output)
+
+        # astyle
+        if self.reformat and self.reformat != ' ':
+            argv.append('--reformat=' + self.reformat)
+
+        # theme
+        if self.style:
+            argv.append('--style=' + self.style)
+
+        # lua plugin, by its file name
+        if self.plugin:
+            argv.append('--plugin=' + self.plugin)
+
+        # font
+        if self.font:
+            argv.append('--font=' + self.font)
+
+            # size
+            if self.fontsize:
+                argv.append('--font-size=' + self.fontsize)
+
+        # css option
+        argv.append('--include-style')
+
+        # line numbering
+        if self.lineno:
+            argv.append('--line-numbers')
+            # set the starting line number
+            if self.linestart:
+                argv.append('--line-number-start=' + str(self.linestart))
+
+        # wrap
+        if self.wrap:
+            argv.extend(['--wrap-simple', '--wrap-no-numbers'])
+
+        # inline CSS
+        if self.inlcss:
+            argv.append('--inline-css')
+
+        # tabs to space
+        argv.append('--replace-tabs=4')
+
+        # source and output encoding
+        if self.encoding:
+            argv.append('--encoding=' + self.encoding)
+
+        return argv
+
+
+## Construct the highlight command line from the conversion options, a
+#  ConvertOptions or a dict of the same names. Returns the argument list,
+#  which is run without a shell.
+def HighlightCommand(exe, opts):
+    return ConvertOptions.Of(opts).Argv(exe)
+
+
+## Running highlight process. The source and the output are bytes.
+class ProcessJob:
+
+    def __init__(self, argv, data):
+        # feed the source via stdin
+        self.data = data
+        # stage timings of the job
+        self.timing = {}
+        # reported by Wait() as the shell would, if highlight cannot be run
+        self.error = None
+        try:
+            self.proc = Popen(argv, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        except OSError as e:
+            self.proc = None
+            self.error = '%s: %s' % (argv[0], e.strerror or e)
+
+    ## Wait for the result, returns (stdout bytes, stderr text)
+    def Wait(self):
+        if self.proc is None:
+            return b'', self.error
+        try:
+            out, err = self.proc.communicate(self.data)
+        except Exception as e:
+            self.Kill()
+            return b'', str(e)
+
+        return out, err.decode('utf-8', 'replace')
+
+    ## Abort the conversion
+    def Kill(self):
+        try:
+            self.proc.kill()
+        except:
+            pass
+
+
+## Running highlight process with the source fed and the output read in
+#  chunks. The output is decoded and handed to onChunk(text) as it arrives
+#  instead of being collected.
+class StreamJob(ProcessJob):
+
+    def __init__(self, argv, data, onChunk, encoding='utf-8'):
+        ProcessJob.__init__(self, argv, data)
+        self.onChunk = onChunk
+        self.encoding = encoding
+
+    ## Wait for the end of the conversion, returns (None, stderr)
+    def Wait(self):
+        if self.proc is None:
+            return None, self.error
+        # feed stdin and drain stderr in the background
+        writer = threading.Thread(target=self.Feed, daemon=True)
+        writer.start()
+        errors = []
+        reader = threading.Thread(daemon=True,
+                target=lambda: errors.append(self.proc.stderr.read()))
+        reader.start()
+
+        decoder = codecs.getincrementaldecoder(self.encoding)('replace')
+        decode = 0.0
+        try:
+            while True:
+                chunk = self.proc.stdout.read(CHUNK)
+                start = time.perf_counter()
+                text = decoder.decode(chunk, not chunk)
+                decode += time.perf_counter() - start
+                if text:
+                    self.onChunk(text)
+                if not chunk:
+                    break
+        except Exception as e:
+            self.Kill()
+            errors.append(str(e).encode('utf-8'))
+
+        self.proc.wait()
+        writer.join()
+        reader.join()
+        self.timing['decode'] = decode
+        return None, b''.join(errors).decode('utf-8', 'replace')
+
+    ## Write the source in chunks
+    def Feed(self):
+        try:
+            for pos in range(0, len(self.data), CHUNK):
+                self.proc.stdin.write(self.data[pos:pos+CHUNK])
+            self.proc.stdin.close()
+        except (OSError, ValueError):
+            # process killed or exited early
+            self.Kill()
+
+
+## Conversion running in the engine pool
+class FutureJob:
+
+    def __init__(self, future):
+        self.future = future
+
+    ## Wait for the result, returns (stdout, stderr)
+    def Wait(self):
+        try:
+            return self.future.result()
+        except CancelledError:
+            return b'', 'Cancelled'
+        except Exception as e:
+            return b'', str(e)
+
+    ## Abort the conversion. Once started it runs to the end, the result
+    #  is discarded by the caller.
+    def Kill(self):
+        self.future.cancel()
+
+
+## Highlight executable backend. Every conversion is a new process.
+class HighlightBackend:
+
+    name = 'highlight'
+
+    def __init__(self, exe=HIGHLIGHT):
+        self.exe = exe
+
+    ## Canonical form of the options, used as the cache key
+    def Key(self, opts):
+        return (self.exe, ConvertOptions.Of(opts))
+
+    ## Start a conversion
+    def Start(self, opts, data):
+        return ProcessJob(HighlightCommand(self.exe, opts), data)
+
+    ## Start a streaming conversion
+    def Stream(self, opts, data, onChunk):
+        return StreamJob(HighlightCommand(self.exe, opts), data, onChunk,
+                opts.get('encoding') or 'utf-8')
+
+    ## Convert the source with each of the options, the processes running
+    #  concurrently. Returns a list of (stdout, stderr).
+    def RenderSet(self, optsList, data):
+        if not optsList:
+            return []
+        workers = min(len(optsList), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(lambda opts: self.Start(opts, data).Wait(),
+                optsList))
+
+    ## Release resources
+    def Close(self):
+        pass
+
+
+## Pygments lexer names for highlight syntax names that differ
+PYGMENTS_LEXERS = {'c':'cpp', 'js':'javascript', 'md':'markdown',
+        'sh':'bash', 'txt':'text', 'pas':'pascal', 'rs':'rust',
+        'ts':'typescript', 'vb':'vbnet', 'mod2':'modula2', 'ps1':'powershell',
+        'assembler':'nasm', 'fortran77':'fortran', 'fortran90':'fortran',
+        'make':'makefile', 'ms':'text', 'tex':'latex', 'conf':'ini'}
+
+## Pygments styles for highlight themes that differ
+PYGMENTS_STYLES = {'molokai':'monokai', 'github':'default',
+        'edit-emacs':'emacs', 'edit-vim':'vim', 'edit-vim-dark':'native',
+        'edit-xcode':'xcode', 'edit-msvs2008':'vs', 'print':'bw'}
+
+## Import pygments in the worker processes ahead of the first request
+def EngineWarmUp():
+    import pygments.formatters
+    import pygments.lexers
+    # force the lexer and formatter maps to load
+    pygments.lexers.find_lexer_class('C++')
+    pygments.formatters.find_formatter_class('html')
+
+## Pygments lexer and formatter for the options. Returns (lexer, formatter),
+#  formatter is None if the output format is not supported. Options not
+#  supported by pygments (reformat, wrap) are ignored.
+def EngineSetup(opts):
+    from pygments.lexers import get_lexer_by_name
+    from pygments.styles import get_all_styles
+    from pygments.util import ClassNotFound
+    from pygments import formatters
+
+    # lexer
+    syntax = opts.get('syntax') or 'text'
+    try:
+        lexer = get_lexer_by_name(PYGMENTS_LEXERS.get(syntax, syntax),
+                tabsize=4, stripnl=False, ensurenl=False)
+    except ClassNotFound:
+        lexer = get_lexer_by_name('text', tabsize=4)
+
+    # style
+    style = opts.get('style') or 'default'
+    style = PYGMENTS_STYLES.get(style, style)
+    if style not in get_all_styles():
+        style = 'default'
+
+    # font
+    font = opts.get('font') or 'monospace'
+    size = opts.get('fontsize') or '10'
+
+    # formatter
+    output = opts.get('output') or 'html'
+    if output in ('html', 'xhtml'):
+        fmt = formatters.HtmlFormatter(style=style, full=True,
+                encoding=opts.get('encoding') or 'utf-8',
+                noclasses=bool(opts.get('inlcss')),
+                linenos='inline' if opts.get('lineno') else False,
+                linenostart=opts.get('linestart') or 1,
+                prestyles='font-family:\'%s\'; font-size:%spt' % (font, size))
+    elif output in ('latex', 'tex'):
+        fmt = formatters.LatexFormatter(style=style, full=True,
+                linenos=bool(opts.get('lineno')),
+                linenostart=opts.get('linestart') or 1)
+    elif output == 'rtf':
+        fmt = formatters.RtfFormatter(style=style, fontface=font,
+                fontsize=int(size) * 2)
+    elif output == 'svg':
+        fmt = formatters.SvgFormatter(style=style, fontfamily=font,
+                fontsize=size + 'pt', linenos=bool(opts.get('lineno')),
+                linenostart=opts.get('linestart') or 1)
+    elif output == 'ansi':
+        fmt = formatters.TerminalFormatter(
+                linenos=bool(opts.get('lineno')))
+    elif output == 'xterm256':
+        fmt = formatters.Terminal256Formatter(style=style,
+                linenos=bool(opts.get('lineno')))
+    elif output == 'truecolor':
+        fmt = formatters.TerminalTrueColorFormatter(style=style,
+                linenos=bool(opts.get('lineno')))
+    elif output == 'bbcode':
+        fmt = formatters.BBCodeFormatter(style=style)
+    elif output == 'pango':
+        fmt = formatters.PangoMarkupFormatter(style=style)
+    else:
+        fmt = None
+
+    return lexer, fmt
+
+
+## Output of a formatter as bytes in the encoding
+def EngineBytes(out, encoding):
+    if isinstance(out, str):
+        out = out.encode(encoding, 'replace')
+    return out
+
+
+## Convert with the embedded pygments engine, returns (stdout bytes, stderr).
+#  The source bytes are in opts['encoding'], which the output keeps.
+def EngineRender(opts, data):
+    from pygments import highlight
+
+    lexer, fmt = EngineSetup(opts)
+    if fmt is None:
+        return b'', 'Output format %s is not supported by pygments' % (
+                opts.get('output'))
+
+    encoding = opts.get('encoding') or 'utf-8'
+    text = data.decode(encoding, 'replace')
+    return EngineBytes(highlight(text, lexer, fmt), encoding), ''
+
+
+## Convert with each of the options, lexing the source only once. The options
+#  should differ in the output and the style only. Returns a list of
+#  (stdout, stderr).
+def EngineRenderSet(optsList, data):
+    from pygments import format
+
+    tokens = None
+    results = []
+    for opts in optsList:
+        lexer, fmt = EngineSetup(opts)
+        if fmt is None:
+            results.append((b'', 'Output format %s is not supported by '
+                'pygments' % opts.get('output')))
+            continue
+
+        # token stream shared by the formatters
+        encoding = opts.get('encoding') or 'utf-8'
+        if tokens is None:
+            tokens = list(lexer.get_tokens(data.decode(encoding, 'replace')))
+        results.append((EngineBytes(format(tokens, fmt), encoding), ''))
+
+    return results
+
+
+## File-like object handing the written output over in chunks
+class ChunkWriter:
+
+    def __init__(self, onChunk):
+        self.onChunk = onChunk
+        self.parts = []
+        self.size = 0
+        # set to abort the conversion
+        self.cancelled = False
+
+    def write(self, data):
+        if self.cancelled:
+            raise CancelledError()
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= CHUNK:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.onChunk(''.join(self.parts))
+            self.parts = []
+            self.size = 0
+
+
+## Streaming conversion with the embedded engine. It runs in the thread
+#  calling Wait(), writing the output as it is produced.
+class EngineStreamJob:
+
+    def __init__(self, opts, data, onChunk):
+        self.opts = opts
+        self.data = data
+        self.writer = ChunkWriter(onChunk)
+
+    ## Run the conversion, returns (None, stderr)
+    def Wait(self):
+        from pygments import highlight
+
+        lexer, fmt = EngineSetup(self.opts)
+        if fmt is None:
+            return None, 'Output format %s is not supported by pygments' % (
+                    self.opts.get('output'))
+
+        # the chunks go to the widgets as text
+        fmt.encoding = None
+        text = self.data.decode(self.opts.get('encoding') or 'utf-8', 'replace')
+        try:
+            highlight(text, lexer, fmt, self.writer)
+            self.writer.flush()
+        except CancelledError:
+            return None, 'Cancelled'
+        except Exception as e:
+            return None, str(e)
+        return None, ''
+
+    ## Abort the conversion
+    def Kill(self):
+        self.writer.cancelled = True
+
+
+## Check if the embedded engine is available
+def EngineAvailable():
+    try:
+        import pygments
+    except ImportError:
+        return False
+    else:
+        return True
+
+
+## Embedded pygments backend. Conversions are fed over pipes to a pool of
+#  long-lived worker processes with the lexers already loaded.
+class PygmentsBackend:
+
+    name = 'pygments'
+
+    def __init__(self, workers=2):
+        # multiprocessing is slow to import, only the pygments engine needs it
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+
+        # forking the threaded GUI could leave the children with locks held,
+        # they start clean and the warm up hides the imports
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = multiprocessing.get_context('spawn')
+
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(max_workers=workers,
+                mp_context=context, initializer=EngineWarmUp)
+
+    ## Canonical form of the options, used as the cache key
+    def Key(self, opts):
+        return (self.name, ConvertOptions.Of(opts))
+
+    ## Start a conversion
+    def Start(self, opts, data):
+        return FutureJob(self.pool.submit(EngineRender, opts, data))
+
+    ## Start a streaming conversion. It runs in the calling thread, as the
+    #  output cannot be streamed back from the pool.
+    def Stream(self, opts, data, onChunk):
+        return EngineStreamJob(opts, data, onChunk)
+
+    ## Convert the source with each of the options. The options are split
+    #  among the pool processes, each lexing the source once. Returns a list
+    #  of (stdout, stderr).
+    def RenderSet(self, optsList, data):
+        groups = [optsList[i::self.workers] for i in range(self.workers)]
+        futures = [self.pool.submit(EngineRenderSet, group, data)
+                for group in groups if group]
+
+        # back in the original order
+        results = [None] * len(optsList)
+        for i, future in enumerate(futures):
+            results[i::self.workers] = future.result()
+        return results
+
+    ## Release resources
+    def Close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+## Engines of the conversion, the backend names
+ENGINES = ('highlight', 'pygments', 'tokens')
+
+## Create the backend by its name, with workers processes in the pool of
+#  the pygments engine. Raises ValueError for an unknown name, or an
+#  embedded engine without pygments installed.
+def MakeBackend(name, exe=HIGHLIGHT, themeDir=None, workers=2):
+    if name == HighlightBackend.name:
+        return HighlightBackend(exe)
+    if name not in ENGINES:
+        raise ValueError('unknown engine %s, use one of %s' % (name,
+            ', '.join(ENGINES)))
+    # the embedded engines lex with pygments
+    if not EngineAvailable():
+        raise ValueError('%s needs pygments, which is not installed' % name)
+    if name == PygmentsBackend.name:
+        return PygmentsBackend(workers)
+    # token stream engine
+    from hltoken import TokenBackend
+    return TokenBackend(themeDir)
+
+
+## Background conversion worker. Only the latest job is of interest: a new
+#  submission replaces the pending one and kills the conversion in flight.
+class ConvertWorker(threading.Thread):
+
+    ## callback(seq, stdout, stderr) is called from the worker thread. stdout
+    #  is bytes in the encoding of the source, None for the streaming
+    #  conversions.
+    def __init__(self, callback, backend, cache=None, stats=None):
+        threading.Thread.__init__(self, daemon=True)
+        # result callback
+        self.callback = callback
+        # HighlightBackend or PygmentsBackend
+        self.backend = backend
+        # RenderCache, optional
+        self.cache = cache
+        # Stats, optional
+        self.stats = stats or Stats()
+        # guards the fields below
+        self.cond = threading.Condition()
+        # pending job
+        self.job = None
+        # sequence number of the latest submission
+        self.seq = 0
+        # conversion in flight
+        self.running_job = None
+        # cleared to stop the thread
+        self.running = True
+        self.start()
+
+    ## Queue a conversion of the source bytes, in opts['encoding'], and
+    #  return its sequence number. With stream given, the output is decoded
+    #  and handed to stream(seq, text) in pieces instead.
+    def Submit(self, opts, data, stream=None):
+        with self.cond:
+            self.seq += 1
+            # supersede the pending job if any
+            self.job = (self.seq, opts, data, stream)
+            # and cancel the one in flight
+            self.Kill()
+            self.cond.notify()
+            return self.seq
+
+    ## Switch to another backend, returns the previous one
+    def SetBackend(self, backend):
+        with self.cond:
+            old = self.backend
+            self.backend = backend
+            return old
+
+    ## Cancel both the pending and the running job
+    def Cancel(self):
+        with self.cond:
+            self.seq += 1
+            self.job = None
+            self.Kill()
+
+    ## Stop the worker thread
+    def Stop(self):
+        with self.cond:
+            self.running = False
+            self.job = None
+            self.Kill()
+            self.cond.notify()
+
+    ## Kill the conversion in flight. Caller should hold the lock.
+    def Kill(self):
+        if self.running_job is not None:
+            self.running_job.Kill()
+
+    ## Thread main loop
+    def run(self):
+        while True:
+            with self.cond:
+                # wait for a job
+                while self.job is None and self.running:
+                    self.cond.wait()
+
+                if not self.running:
+                    return
+
+                seq, opts, data, stream = self.job
+                self.job = None
+                backend = self.backend
+
+            # previously rendered, streamed output is not kept
+            if self.cache is not None and stream is None:
+                with self.stats.Time('cache lookup'):
+                    key = self.cache.MakeKey(backend.Key(opts), data)
+                    out = self.cache.Get(key)
+                if out is not None:
+                    with self.cond:
+                        if seq != self.seq:
+                            continue
+                    self.callback(seq, out, '')
+                    continue
+
+            with self.cond:
+                # superseded while looking up the cache
+                if seq != self.seq or not self.running:
+                    continue
+
+                # start the conversion
+                start = time.perf_counter()
+                try:
+                    if stream is None:
+                        self.running_job = backend.Start(opts, data)
+                    else:
+                        self.running_job = backend.Stream(opts, data,
+                                lambda chunk, seq=seq: stream(seq, chunk))
+                except Exception as e:
+                    self.running_job = None
+                    err = str(e)
+                job = self.running_job
+                # process creation
+                self.stats.Add('spawn', time.perf_counter() - start)
+
+            if job is None:
+                out = b''
+            else:
+                start = time.perf_counter()
+                out, err = job.Wait()
+                timing = getattr(job, 'timing', {})
+                # highlight execution, without the decode
+                self.stats.Add('highlight', time.perf_counter() - start -
+                        timing.get('decode', 0), len(data), len(out or b''))
+                if 'decode' in timing:
+                    self.stats.Add('decode', timing['decode'])
+
+            with self.cond:
+                self.running_job = None
+                # superseded or cancelled meanwhile
+                if seq != self.seq:
+                    continue
+
+            # keep successful results
+            if self.cache is not None and stream is None and err == '':
+                self.cache.Put(key, out)
+
+            self.callback(seq, out, err)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Open source documents and their renders. No wx dependency.
+#
+# Each document keeps the settings it was last shown with and the output of
+# its last conversion. The outputs of the documents viewed least recently are
+# dropped when the total grows over the limit. Files are loaded into the
+# documents in the background, in chunks.
+#
+
+import codecs
+import io
+import itertools
+import mmap
+import os
+import queue
+import threading
+
+
+## Untitled document name
+UNTITLED = 'Untitled'
+
+
+## One open source document
+class Document:
+
+    def __init__(self, name='', path=None, settng=None):
+        # file name shown, and the full path if loaded from a file
+        self.name = name
+        self.path = path
+        # snapshot of the settings of the document
+        self.settng = settng
+        # widget holding the text, set by the frontend
+        self.view = None
+        # encoding of the file
+        self.encoding = None
+        # key of the file load in progress, None if none
+        self.loading = None
+        # output bytes of the last conversion of the whole document, and
+        # their encoding
+        self.render = None
+        self.renderEncoding = None
+        # incremented on each edit, a render of an older version is stale
+        self.version = 0
+        # version last rendered in the background, successfully or not
+        self.tried = None
+        # order of the last view
+        self.viewed = 0
+
+    ## Name for the tab
+    def Title(self):
+        return self.name or UNTITLED
+
+    ## Source text or settings changed, the render is stale
+    def Touch(self):
+        self.version += 1
+        self.render = None
+
+
+## Open documents with the renders bounded in size
+class DocumentSet:
+
+    def __init__(self, maxBytes=64<<20):
+        self.docs = []
+        self.maxBytes = maxBytes
+        self.counter = itertools.count(1)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    ## Add a document
+    def Add(self, doc):
+        self.docs.append(doc)
+        return doc
+
+    ## Remove a document
+    def Remove(self, doc):
+        self.docs.remove(doc)
+
+    ## Document is shown
+    def View(self, doc):
+        doc.viewed = next(self.counter)
+
+    ## Total size of the renders kept
+    def RenderBytes(self):
+        return sum(len(d.render) for d in self.docs if d.render is not None)
+
+    ## Keep the render of the document if it is still of the version given
+    #  and within the limit, then evict the others as needed. Returns True if
+    #  kept.
+    def SetRender(self, doc, version, render, encoding='utf-8'):
+        if doc not in self.docs or doc.version != version:
+            return False
+        # never evicted while the document is viewed, made again on demand
+        if len(render) > self.maxBytes:
+            return False
+        doc.render = render
+        doc.renderEncoding = encoding
+        self.Evict(doc)
+        return True
+
+    ## Drop the renders of the least recently viewed documents, except the
+    #  one given, until the total is within the limit
+    def Evict(self, keep=None):
+        total = self.RenderBytes()
+        for doc in sorted(self.docs, key=lambda d: d.viewed):
+            if total <= self.maxBytes:
+                break
+            if doc is keep or doc.render is None:
+                continue
+            total -= len(doc.render)
+            doc.render = None
+
+    ## Next document to be rendered in the background, the most recently
+    #  viewed one without a render and not tried yet. None if there is
+    #  nothing to do.
+    def Pending(self, current=None):
+        # rendering more would only evict what was rendered
+        if self.RenderBytes() >= self.maxBytes:
+            return None
+        for doc in sorted(self.docs, key=lambda d: -d.viewed):
+            if (doc is not current and doc.render is None and
+                    doc.tried != doc.version and doc.loading is None):
+                return doc
+        return None
+
+
+## Size of the chunks a file is loaded in
+LOAD_CHUNK = 1 << 20
+
+## Bytes looked at to detect the encoding
+ENCODING_SAMPLE = 64 << 10
+
+## Byte order marks, longer ones first
+BOMS = [(codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+        (codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16')]
+
+
+## Guess the encoding from the first bytes of the file
+def DetectEncoding(data):
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+
+    # utf-16 without bom, zero bytes on one side of ascii characters
+    if data.count(0) > len(data) // 4:
+        even = data[0::2].count(0)
+        odd = data[1::2].count(0)
+        if odd > even * 4:
+            return 'utf-16-le'
+        if even > odd * 4:
+            return 'utf-16-be'
+
+    # a multibyte character may be cut at the end of the sample
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(data, False)
+    except UnicodeDecodeError:
+        return 'cp1252'
+    return 'utf-8'
+
+
+## Background file loader. The queued files are read through a memory map
+#  and decoded in chunks, with the line ends translated. Chunks are handed
+#  over with onChunk(key, text, done, total), and Release() must be called
+#  once each has been consumed. At most backlog chunks are handed over ahead.
+#  onDone(key, encoding, error) reports the end of each file.
+class FileLoader(threading.Thread):
+
+    def __init__(self, onChunk, onDone, chunkSize=LOAD_CHUNK, backlog=4):
+        threading.Thread.__init__(self, daemon=True)
+        self.onChunk = onChunk
+        self.onDone = onDone
+        self.chunkSize = chunkSize
+        # chunks handed over and not consumed yet
+        self.slots = threading.Semaphore(backlog)
+        # queued (key, path)
+        self.queue = queue.Queue()
+        # keys of the cancelled loads
+        self.cancelled = set()
+        self.lock = threading.Lock()
+        self.running = True
+        self.start()
+
+    ## Queue a file
+    def Load(self, key, path):
+        with self.lock:
+            self.cancelled.discard(key)
+        self.queue.put((key, path))
+
+    ## Drop the load of the key, queued or in progress
+    def Cancel(self, key):
+        with self.lock:
+            self.cancelled.add(key)
+
+    ## Chunk consumed
+    def Release(self):
+        self.slots.release()
+
+    ## Stop the thread
+    def Stop(self):
+        self.running = False
+        self.queue.put(None)
+
+    ## Load of the key has been cancelled or the thread stopped
+    def IsCancelled(self, key):
+        with self.lock:
+            return not self.running or key in self.cancelled
+
+    ## Thread main loop
+    def run(self):
+        while self.running:
+            item = self.queue.get()
+            if item is None:
+                return
+            key, path = item
+            if self.IsCancelled(key):
+                continue
+
+            try:
+                encoding = self.Read(key, path)
+            except Exception as e:
+                self.onDone(key, None, str(e))
+            else:
+                self.onDone(key, encoding, '')
+
+    ## Read one file
+    def Read(self, key, path):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # an empty file cannot be mapped
+            if size == 0:
+                return 'utf-8'
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            encoding = DetectEncoding(data[:ENCODING_SAMPLE])
+            decoder = io.IncrementalNewlineDecoder(
+                    codecs.getincrementaldecoder(encoding)('replace'), True)
+
+            pos = 0
+            while pos < size:
+                chunk = data[pos:pos + self.chunkSize]
+                pos += len(chunk)
+                text = decoder.decode(chunk, pos >= size)
+
+                # wait for the consumer to catch up
+                while not self.slots.acquire(timeout=0.1):
+                    if self.IsCancelled(key):
+                        return encoding
+                if self.IsCancelled(key):
+                    self.slots.release()
+                    return encoding
+                self.onChunk(key, text, pos, size)
+        finally:
+            data.close()
+
+        return encoding
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Export of one source into a set of formats and themes. No wx
+#           dependency.
+#
+# Each combination of the output formats and the themes is rendered by the
+# backend in one go, and the results written into a folder or a zip file:
+#
+#   results = ExportSet(backend, opts, data, ['html', 'latex'], ['edit-vim'])
+#   WriteExport(results, 'snippet.zip', 'snippet')
+#
+
+import os
+import re
+import zipfile
+
+from hlcore import OUTPUT_EXT, ConvertOptions
+
+
+## Render the source bytes in every format and theme. Outputs found in the
+#  cache, if given, are not rendered again. Returns a list of
+#  (output, style, stdout bytes, stderr).
+def ExportSet(backend, opts, data, formats, themes, cache=None):
+    variants = [(fmt, theme) for fmt in formats for theme in themes]
+    opts = ConvertOptions.Of(opts)
+    optsList = [opts.Replace(output=fmt, style=theme)
+            for fmt, theme in variants]
+
+    results = [None] * len(variants)
+    missing = []
+    for idx, vopts in enumerate(optsList):
+        out = None
+        if cache is not None:
+            key = cache.MakeKey(backend.Key(vopts), data)
+            out = cache.Get(key)
+        if out is not None:
+            results[idx] = (out, '')
+        else:
+            missing.append(idx)
+
+    # render the rest together
+    rendered = backend.RenderSet([optsList[i] for i in missing], data)
+    for idx, (out, err) in zip(missing, rendered):
+        results[idx] = (out, err)
+        if cache is not None and err == '':
+            cache.Put(cache.MakeKey(backend.Key(optsList[idx]), data), out)
+
+    return [(fmt, theme, out, err)
+            for (fmt, theme), (out, err) in zip(variants, results)]
+
+
+## File name of an exported output. The theme is added when more than one is
+#  exported.
+def ExportName(base, output, style, withStyle):
+    ext = OUTPUT_EXT.get(output, '.' + output)
+    if withStyle:
+        # themes may be in sub folders
+        base = base + '-' + re.sub(r'[^\w.-]+', '-', style)
+    # formats sharing the extension
+    if list(OUTPUT_EXT.values()).count(ext) > 1 and output != ext[1:]:
+        base = base + '-' + output
+    return base + ext
+
+
+## Write the successful results into the folder, or the zip file if the path
+#  ends with .zip. Returns the list of file names written.
+def WriteExport(results, path, base):
+    withStyle = len(set(r[1] for r in results)) > 1
+    files = [(ExportName(base, fmt, theme, withStyle), out)
+            for fmt, theme, out, err in results if err == '']
+
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, out in files:
+                zf.writestr(name, out)
+    else:
+        os.makedirs(path, exist_ok=True)
+        for name, out in files:
+            with open(os.path.join(path, name), 'wb') as f:
+                f.write(out)
+
+    return [name for name, out in files]
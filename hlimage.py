@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Offscreen image export of the highlighted output
+#
+# The html output of highlight or pygments is read back into lines of styled
+# runs, which are drawn into an SVG document or, with wx, into a bitmap of the
+# whole file at the requested resolution. Nothing is taken from the screen.
+#
+#   doc = ParseHtml(html)
+#   SaveImage(doc, 'out.png', dpi=192)
+#
+
+import html
+import io
+import re
+import unicodedata
+from html.parser import HTMLParser
+
+
+## Resolution of the CSS pixel
+CSS_DPI = 96
+
+## Padding around the text in CSS pixels
+PADDING = 8
+
+## Line height relative to the font size
+LINE_HEIGHT = 1.25
+
+## Advance of a monospace character relative to the font size
+CHAR_WIDTH = 0.6
+
+## Tab stops of the output, same as --replace-tabs
+TAB_SIZE = 4
+
+## Largest side of a bitmap. Longer files can be exported as SVG.
+MAX_BITMAP = 32000
+
+## Properties passed from an element to its children
+INHERITED = ('color', 'font-weight', 'font-style', 'font-size', 'font-family')
+
+
+## Declarations of a CSS block as a dict
+def ParseDeclarations(text):
+    props = {}
+    for item in text.split(';'):
+        name, sep, value = item.partition(':')
+        if sep:
+            props[name.strip().lower()] = value.strip()
+
+    # shorthand used by pygments
+    if 'background' in props and 'background-color' not in props:
+        props['background-color'] = props['background'].split()[0]
+    return props
+
+
+## Rules of a style sheet. Returns a list of (specificity, tag, classes, props)
+#  in the order they apply. Only the last compound of each selector is
+#  matched, which is what the highlighters generate.
+def ParseCss(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    rules = []
+    for order, (selectors, body) in enumerate(
+            re.findall(r'([^{}]+)\{([^{}]*)\}', text)):
+        props = ParseDeclarations(body)
+        for sel in selectors.split(','):
+            parts = re.split(r'[\s>+~]+', sel.strip())
+            last = parts[-1] if parts else ''
+            # ids, attributes and pseudo classes are not used
+            if last == '' or re.search(r'[#\[:*]', last):
+                continue
+            names = last.split('.')
+            tag = names[0].lower() or None
+            classes = frozenset(n for n in names[1:] if n)
+            rules.append(((len(classes), tag is not None, order), tag,
+                classes, props))
+
+    rules.sort(key=lambda r: r[0])
+    return rules
+
+
+## Normalized colour, None if not set
+def ParseColour(value):
+    if not value:
+        return None
+    value = value.split()[0].lower()
+    if value in ('transparent', 'inherit', 'none'):
+        return None
+    # #rgb to #rrggbb
+    if re.match(r'^#[0-9a-f]{3}$', value):
+        value = '#' + ''.join(c * 2 for c in value[1:])
+    return value
+
+
+## Font size in points
+def ParseSize(value, default=10.0):
+    m = re.match(r'^\s*([0-9.]+)\s*(pt|px)?', value or '')
+    if not m:
+        return default
+    size = float(m.group(1))
+    if m.group(2) == 'px':
+        size = size * 72 / CSS_DPI
+    return size
+
+
+## First family of a font-family list
+def ParseFamily(value):
+    for name in (value or '').split(','):
+        name = name.strip().strip('\'"')
+        if name != '':
+            return name
+    return 'monospace'
+
+
+## Highlighted document as lines of styled runs. Each run is
+#  (text, colour, bold, italic, background).
+class TextImage:
+
+    def __init__(self):
+        self.lines = []
+        self.foreground = '#000000'
+        self.background = '#ffffff'
+        self.font = 'monospace'
+        self.size = 10.0
+
+    ## Width in character cells of the longest line
+    def Columns(self):
+        return max([sum(TextWidth(r[0]) for r in line)
+            for line in self.lines] or [0])
+
+
+## Width of the text in character cells, wide characters take two
+def TextWidth(text):
+    if text.isascii():
+        return len(text)
+    return sum(2 if unicodedata.east_asian_width(c) in 'WF' else 1
+            for c in text)
+
+
+## Collects the styled runs inside <pre>
+class RunParser(HTMLParser):
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.rules = []
+        self.css = []
+        self.inStyle = False
+        # (tag, computed style) of the open elements
+        self.stack = [('', {})]
+        self.pre = 0
+        self.found = False
+        self.runs = []
+        self.doc = TextImage()
+
+    ## Style of an element from the rules and its style attribute
+    def Compute(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = set((attrs.get('class') or '').split())
+        parent = self.stack[-1][1]
+        style = {k:v for k, v in parent.items() if k in INHERITED}
+        # background shows through unless set
+        if 'background-color' in parent:
+            style['background-color'] = parent['background-color']
+
+        for spec, rtag, rclasses, props in self.rules:
+            if (rtag is None or rtag == tag) and rclasses <= classes:
+                style.update(props)
+        if attrs.get('style'):
+            style.update(ParseDeclarations(attrs['style']))
+        return style
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'style':
+            self.inStyle = True
+            return
+        if tag in ('br', 'meta', 'link', 'img', 'hr', 'input'):
+            return
+
+        style = self.Compute(tag, attrs)
+        self.stack.append((tag, style))
+
+        if tag == 'body':
+            bg = ParseColour(style.get('background-color'))
+            if bg:
+                self.doc.background = bg
+        elif tag == 'pre':
+            self.pre += 1
+            if not self.found:
+                self.found = True
+                doc = self.doc
+                doc.background = (ParseColour(style.get('background-color'))
+                        or doc.background)
+                doc.foreground = (ParseColour(style.get('color'))
+                        or doc.foreground)
+                doc.font = ParseFamily(style.get('font-family'))
+                doc.size = ParseSize(style.get('font-size'))
+
+    def handle_endtag(self, tag):
+        if tag == 'style':
+            self.inStyle = False
+            self.rules = ParseCss(''.join(self.css))
+            return
+
+        # close up to the matching element
+        for idx in range(len(self.stack) - 1, 0, -1):
+            if self.stack[idx][0] == tag:
+                for item in self.stack[idx:]:
+                    if item[0] == 'pre':
+                        self.pre -= 1
+                del self.stack[idx:]
+                break
+
+    def handle_data(self, data):
+        if self.inStyle:
+            self.css.append(data)
+        elif self.pre > 0:
+            style = self.stack[-1][1]
+            colour = ParseColour(style.get('color')) or self.doc.foreground
+            bg = ParseColour(style.get('background-color'))
+            self.runs.append((data, colour,
+                style.get('font-weight', '') in ('bold', 'bolder', '700',
+                    '800', '900'),
+                style.get('font-style', '') in ('italic', 'oblique'),
+                bg))
+
+    ## Split the runs into lines, expand the tabs and merge the runs of the
+    #  same style
+    def Lines(self):
+        lines = []
+        line = []
+        col = 0
+        for text, colour, bold, italic, bg in self.runs:
+            attrs = (colour, bold, italic,
+                    None if bg == self.doc.background else bg)
+            parts = text.split('\n')
+            for idx, part in enumerate(parts):
+                if idx > 0:
+                    lines.append(line)
+                    line = []
+                    col = 0
+                if part == '':
+                    continue
+                # tab stops count from the start of the line
+                if '\t' in part:
+                    part = (' ' * col + part).expandtabs(TAB_SIZE)[col:]
+                if line and line[-1][1:] == attrs:
+                    line[-1] = (line[-1][0] + part,) + attrs
+                else:
+                    line.append((part,) + attrs)
+                col += TextWidth(part)
+
+        # the output ends with a new line
+        if line:
+            lines.append(line)
+        return lines
+
+
+## Read the html output into a TextImage. Returns None if there is no <pre>.
+def ParseHtml(text):
+    parser = RunParser()
+    parser.feed(text)
+    parser.close()
+    if not parser.found:
+        return None
+
+    parser.doc.lines = parser.Lines()
+    return parser.doc
+
+
+## SVG document of the image. The size is given for the resolution, the
+#  drawing itself is in CSS pixels.
+def RenderSvg(doc, dpi=CSS_DPI):
+    px = doc.size * CSS_DPI / 72
+    lineh = px * LINE_HEIGHT
+    width = int(doc.Columns() * px * CHAR_WIDTH + 2 * PADDING + 0.5)
+    height = int(len(doc.lines) * lineh + 2 * PADDING + 0.5)
+    ratio = dpi / CSS_DPI
+
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" '
+            'viewBox="0 0 %d %d">\n' % (int(width * ratio + 0.5),
+                int(height * ratio + 0.5), width, height),
+            '<rect width="100%%" height="100%%" fill="%s"/>\n'
+            % doc.background,
+            '<g font-family="%s, monospace" font-size="%.2fpx" fill="%s" '
+            'xml:space="preserve" style="white-space:pre">\n'
+            % (html.escape(doc.font), px, doc.foreground)]
+
+    for idx, line in enumerate(doc.lines):
+        y = PADDING + idx * lineh
+        # backgrounds of the runs first
+        col = 0
+        for text, colour, bold, italic, bg in line:
+            cols = TextWidth(text)
+            if bg is not None:
+                out.append('<rect x="%.2f" y="%.2f" width="%.2f" '
+                        'height="%.2f" fill="%s"/>\n' % (PADDING +
+                            col * px * CHAR_WIDTH, y, cols * px * CHAR_WIDTH,
+                            lineh, bg))
+            col += cols
+
+        if not line:
+            continue
+        out.append('<text x="%d" y="%.2f">' % (PADDING, y + px))
+        for text, colour, bold, italic, bg in line:
+            attrs = ''
+            if colour != doc.foreground:
+                attrs += ' fill="%s"' % colour
+            if bold:
+                attrs += ' font-weight="bold"'
+            if italic:
+                attrs += ' font-style="italic"'
+            text = html.escape(text, False)
+            out.append('<tspan%s>%s</tspan>' % (attrs, text) if attrs
+                    else text)
+        out.append('</text>\n')
+
+    out.append('</g>\n</svg>\n')
+    return ''.join(out)
+
+
+## Bitmap of the image at the resolution. Needs wx and a running wx.App.
+#  Raises ValueError if the image would be too large.
+def RenderBitmap(doc, dpi=CSS_DPI):
+    import wx
+
+    ratio = dpi / CSS_DPI
+    pxsize = wx.Size(0, max(1, int(doc.size * dpi / 72 + 0.5)))
+    base = wx.Font(wx.FontInfo(pxsize).Family(wx.FONTFAMILY_TELETYPE)
+            .FaceName(doc.font))
+    fonts = {(False, False):base, (True, False):base.Bold(),
+            (False, True):base.Italic(), (True, True):base.Bold().Italic()}
+
+    dc = wx.MemoryDC(wx.Bitmap(1, 1))
+    dc.SetFont(base)
+    lineh = int(dc.GetCharHeight() * LINE_HEIGHT + 0.5)
+    charw = dc.GetTextExtent('M')[0]
+    pad = int(PADDING * ratio + 0.5)
+
+    # line widths, counted in cells for a fixed width font
+    if base.IsFixedWidth():
+        widths = None
+        width = doc.Columns() * charw
+    else:
+        widths = []
+        for line in doc.lines:
+            w = 0
+            for text, colour, bold, italic, bg in line:
+                dc.SetFont(fonts[bold, italic])
+                w += dc.GetTextExtent(text)[0]
+            widths.append(w)
+        width = max(widths or [0])
+
+    width = width + 2 * pad
+    height = len(doc.lines) * lineh + 2 * pad
+    if width > MAX_BITMAP or height > MAX_BITMAP:
+        raise ValueError('The image of %dx%d pixels is too large for a '
+                'bitmap, export it as SVG instead.' % (width, height))
+
+    bmp = wx.Bitmap(width, height, 24)
+    dc.SelectObject(bmp)
+    dc.SetBackground(wx.Brush(wx.Colour(doc.background)))
+    dc.Clear()
+    dc.SetBackgroundMode(wx.TRANSPARENT)
+    dc.SetPen(wx.TRANSPARENT_PEN)
+
+    for idx, line in enumerate(doc.lines):
+        x = pad
+        y = pad + idx * lineh
+        for text, colour, bold, italic, bg in line:
+            dc.SetFont(fonts[bold, italic])
+            if widths is None:
+                w = TextWidth(text) * charw
+            else:
+                w = dc.GetTextExtent(text)[0]
+            if bg is not None:
+                dc.SetBrush(wx.Brush(wx.Colour(bg)))
+                dc.DrawRectangle(x, y, w, lineh)
+            dc.SetTextForeground(wx.Colour(colour))
+            dc.DrawText(text, x, y)
+            x += w
+
+    dc.SelectObject(wx.NullBitmap)
+    return bmp
+
+
+## wx.App of a headless export
+app = None
+
+## Save the image to the file, SVG or PNG by the extension
+def SaveImage(doc, path, dpi=CSS_DPI):
+    global app
+
+    if path.lower().endswith('.svg'):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(RenderSvg(doc, dpi))
+        return
+
+    import wx
+    # batch jobs have no application object
+    if wx.GetApp() is None:
+        app = wx.App(False)
+
+    if not PngImage(doc, dpi).SaveFile(path, wx.BITMAP_TYPE_PNG):
+        raise OSError('Failed to write %s' % path)
+
+
+## wx.Image of the bitmap with the resolution set for the PNG encoder
+def PngImage(doc, dpi=CSS_DPI):
+    import wx
+
+    img = RenderBitmap(doc, dpi).ConvertToImage()
+    img.SetOption(wx.IMAGE_OPTION_RESOLUTIONUNIT, wx.IMAGE_RESOLUTION_INCHES)
+    img.SetOption(wx.IMAGE_OPTION_RESOLUTIONX, int(dpi))
+    img.SetOption(wx.IMAGE_OPTION_RESOLUTIONY, int(dpi))
+    return img
+
+
+## PNG file of the image as bytes. Needs a running wx.App.
+def PngBytes(doc, dpi=CSS_DPI):
+    import wx
+
+    out = io.BytesIO()
+    if not PngImage(doc, dpi).SaveFile(out, wx.BITMAP_TYPE_PNG):
+        raise ValueError('Failed to encode the image as PNG')
+    return out.getvalue()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Rendering library for scripts and the GUI. No wx dependency.
+#
+# Sources are converted with the options given, the syntax found from the
+# file name if not given, through the highlight executable or the embedded
+# engines:
+#
+#   import hlrender
+#   html = hlrender.Render(text, filename='main.c', style='edit-vim')
+#   outs = asyncio.run(hlrender.RenderMany(texts, jobs=8, syntax='py'))
+#
+# Only the standard modules are imported until the first render, so a short
+# script pays for nothing it does not use. The pygments engine renders in
+# worker processes, which import the main module again: scripts using it need
+# the usual if __name__ == '__main__' guard.
+#
+
+import os
+import threading
+import time
+
+
+## Conversion failed, with the error message of the engine
+class RenderError(Exception):
+    pass
+
+
+## Conversion of sources with one engine. The engine is created, and the
+#  syntax metadata saved by wxhighlight read, on first use.
+class Renderer:
+
+    ## engine is highlight, pygments or tokens. If None, highlight is used
+    #  if installed and pygments otherwise.
+    def __init__(self, engine=None, exe=None, themeDir=None, cache=None,
+            stats=None):
+        self.engine = engine
+        self.exe = exe
+        self.themeDir = themeDir
+        # RenderCache and Stats of hlcore, if any
+        self.cache = cache
+        self.stats = stats
+        self.backend = None
+        self.store = None
+        # syntax descriptions to names, and the filetype index built from
+        # them
+        self.syntax = None
+        self.index = None
+        self.lock = threading.Lock()
+
+    ## Highlight executable
+    def Exe(self):
+        if self.exe is None:
+            import hlcore
+            self.exe = hlcore.HIGHLIGHT
+        return self.exe
+
+    ## Backend of the engine, created on first use. Raises ValueError for an
+    #  engine that is unknown or not installed.
+    def Backend(self):
+        with self.lock:
+            if self.backend is None:
+                import hlcore
+                engine = self.engine
+                if engine is None:
+                    engine = ('highlight' if os.path.exists(self.Exe()) else
+                            'pygments')
+                self.backend = hlcore.MakeBackend(engine, self.Exe(),
+                        self.themeDir)
+            return self.backend
+
+    ## Switch to the engine and return its backend. The old backend is left
+    #  to the caller to close, it may still be rendering.
+    def SetEngine(self, engine, themeDir=None):
+        with self.lock:
+            self.engine = engine
+            self.themeDir = themeDir
+            self.backend = None
+        return self.Backend()
+
+    ## Release the backend
+    def Close(self):
+        with self.lock:
+            backend, self.backend = self.backend, None
+        if backend is not None:
+            backend.Close()
+
+    ## Settings and metadata store of wxhighlight
+    def Store(self):
+        if self.store is None:
+            import hlconfig
+            self.store = hlconfig.ConfigStore(exe=self.Exe())
+        return self.store
+
+    ## Take the syntax descriptions of the metadata, scanned by the caller
+    def SetMetadata(self, meta):
+        self.syntax = meta['syntax']
+        self.index = None
+
+    ## Filetype index, from the metadata of the last scan if none was set.
+    #  The installation is not scanned here, which would run highlight.
+    def Index(self):
+        if self.index is None:
+            import hlcore
+            if self.syntax is None:
+                meta = self.Store().LoadMetadata(check=False)
+                self.syntax = meta['syntax'] if meta is not None else {}
+            self.index = hlcore.FiletypeIndex(self.Store().Ftmaps(),
+                    self.syntax)
+        return self.index
+
+    ## Syntax name of the file from its name, or its leading text head. ''
+    #  if none found.
+    def Detect(self, fname, head=''):
+        return self.Index().Detect(fname, head)
+
+    ## Description of the syntax name, '' if unknown
+    def Describe(self, value):
+        return self.Index().Describe(value)
+
+    ## Source as bytes for the engines. Text is encoded in the encoding
+    #  given, bytes are taken to be in it. Returns the ConvertOptions with
+    #  the encoding set, and the bytes.
+    def Prepare(self, source, opts=None, encoding=None):
+        import hlcore
+        if isinstance(source, str):
+            data, encoding = hlcore.EncodeSource(source,
+                    hlcore.SourceEncoding(encoding))
+        else:
+            data, encoding = hlcore.TranscodeSource(bytes(source),
+                    encoding or 'utf-8')
+        opts = hlcore.ConvertOptions.Of(opts or {})
+        return opts.Replace(encoding=encoding), data
+
+    ## Convert the bytes prepared, through the cache if any. Returns the
+    #  output bytes in the encoding of the source. Raises RenderError.
+    def RenderBytes(self, opts, data):
+        backend = self.Backend()
+        key = None
+        if self.cache is not None:
+            key = self.cache.MakeKey(backend.Key(opts), data)
+            out = self.cache.Get(key)
+            if out is not None:
+                return out
+
+        start = time.perf_counter()
+        out, err = backend.Start(opts, data).Wait()
+        if err != '':
+            raise RenderError(err.strip())
+        if self.stats is not None:
+            self.stats.Add('render', time.perf_counter() - start, len(data),
+                    len(out))
+        if key is not None:
+            self.cache.Put(key, out)
+        return out
+
+    ## Convert the source, text or bytes in the encoding. The syntax is
+    #  found from the file name or the content if not given, the other
+    #  options are the ones of ConvertOptions. Returns the output as text.
+    #  Raises RenderError, TypeError for an unknown option, or ValueError for
+    #  an engine that is unknown or not installed.
+    def Render(self, source, filename=None, encoding=None, **opts):
+        opts, data = self.Prepare(source, opts, encoding)
+        if not opts.syntax and filename:
+            import hlcore
+            head = data[:hlcore.SNIFF_SIZE].decode(opts.encoding, 'replace')
+            # highlight takes the extension as the syntax name as well
+            syntax = (self.Detect(filename, head) or
+                    os.path.splitext(filename)[1][1:])
+            opts = opts.Replace(syntax=syntax)
+
+        out = self.RenderBytes(opts, data)
+        return out.decode(opts.encoding or 'utf-8', 'replace')
+
+    ## Convert the sources, at most jobs at a time. Each item is a source,
+    #  or a (source, dict) pair of the arguments of Render for it, which
+    #  take precedence over the ones given here. Returns the outputs in the
+    #  order of the sources. The first error is raised, unless returnErrors
+    #  is set, in which case the exceptions are returned in their places.
+    async def RenderMany(self, sources, jobs=4, returnErrors=False, **kwgs):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        try:
+            tasks = []
+            for item in sources:
+                if isinstance(item, tuple):
+                    source, args = item
+                    args = dict(kwgs, **args)
+                else:
+                    source, args = item, kwgs
+                tasks.append(loop.run_in_executor(executor,
+                    lambda source=source, args=args:
+                        self.Render(source, **args)))
+            return await asyncio.gather(*tasks,
+                    return_exceptions=returnErrors)
+        finally:
+            # the loop is not held up by the renders left after an error
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+## Renderer of the module functions, created on first use
+renderer = None
+
+## Renderer of the module functions
+def Default():
+    global renderer
+    if renderer is None:
+        renderer = Renderer()
+    return renderer
+
+
+## Convert the source with the default renderer, see Renderer.Render
+def Render(source, **kwgs):
+    return Default().Render(source, **kwgs)
+
+
+## Convert the sources with the default renderer, see Renderer.RenderMany
+async def RenderMany(sources, jobs=4, returnErrors=False, **kwgs):
+    return await Default().RenderMany(sources, jobs, returnErrors, **kwgs)
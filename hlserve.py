@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Local HTTP rendering service
+#
+# Runs the conversion headless behind a small asyncio HTTP server, so that
+# tools can render many sources without starting highlight themselves:
+#
+#   python3 hlserve.py --port 8765 --jobs 8
+#   curl --data-binary @main.c 'http://127.0.0.1:8765/render?syntax=c'
+#   curl http://127.0.0.1:8765/metrics
+#
+# POST /render takes the source bytes as the body and the fields of
+# ConvertOptions as query parameters, or a JSON body of the form
+# {"source": "...", "options": {...}}. The output comes back in the encoding
+# of the source. At most --jobs renders run at a time, up to --queue more
+# wait, and further requests are refused with 503.
+#
+
+import argparse
+import asyncio
+import http.client
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import fields
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import hlconfig
+import hlcore
+
+
+## Default port
+PORT = 8765
+
+## Options accepted, with their types
+OPTIONS = {f.name:f.type for f in fields(hlcore.ConvertOptions)}
+
+## Options naming the data files of the engines, which must not be paths
+FILE_OPTIONS = ('syntax', 'style', 'reformat', 'plugin')
+
+## Content types of the output formats, text/plain for the others
+CONTENT_TYPES = {'html':'text/html', 'xhtml':'application/xhtml+xml',
+        'latex':'application/x-latex', 'tex':'application/x-tex',
+        'rtf':'application/rtf', 'svg':'image/svg+xml'}
+
+log = logging.getLogger('wxhighlight.serve')
+
+
+## Request refused. args are (status, message).
+class RequestError(Exception):
+    pass
+
+
+## ConvertOptions from (name, value) pairs of the query string or the JSON
+#  body. Raises RequestError if any is unknown or not valid.
+def ParseOptions(items):
+    opts = {}
+    for name, value in items:
+        kind = OPTIONS.get(name)
+        if kind is None:
+            raise RequestError(400, 'Unknown option %s' % name)
+
+        if kind is bool:
+            if isinstance(value, str):
+                value = value.lower() in ('1', 'true', 'yes', 'on')
+            opts[name] = bool(value)
+        elif kind is int:
+            try:
+                opts[name] = int(value)
+            except (TypeError, ValueError):
+                raise RequestError(400, 'Option %s should be a number' % name)
+        else:
+            # passed as one argument each, no quoting needed
+            value = str(value)
+            if name in FILE_OPTIONS and (os.sep in value or '/' in value or
+                    value.startswith('.')):
+                raise RequestError(400, 'Option %s should be a name' % name)
+            opts[name] = value
+    return hlcore.ConvertOptions.Of(opts)
+
+
+## Rendering service state, shared by the connections
+class RenderService:
+
+    def __init__(self, backend, cache=None, jobs=4, maxQueue=64,
+            maxBody=16<<20):
+        self.backend = backend
+        self.cache = cache
+        self.jobs = jobs
+        self.maxQueue = maxQueue
+        self.maxBody = maxBody
+        # renders run in these threads, highlight or the engine pool behind
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.slots = None
+        # requests waiting for a slot, and renders running
+        self.waiting = 0
+        self.running = 0
+        # counters
+        self.served = 0
+        self.rejected = 0
+        self.failed = 0
+        self.started = time.time()
+        self.stats = hlcore.Stats(size=1000)
+
+    ## Render the source, waiting for a free slot. Returns (stdout, stderr).
+    async def Render(self, opts, data):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.jobs)
+
+        # queue full
+        if self.waiting >= self.maxQueue and self.slots.locked():
+            self.rejected += 1
+            raise RequestError(503, 'Too many requests queued')
+
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.stats.Add('queue', time.perf_counter() - start)
+
+        self.running += 1
+        try:
+            start = time.perf_counter()
+            out, err = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.RenderSync, opts, data)
+            self.stats.Add('render', time.perf_counter() - start, len(data),
+                    len(out))
+        finally:
+            self.running -= 1
+            self.slots.release()
+        return out, err
+
+    ## Render in the executor thread, through the cache
+    def RenderSync(self, opts, data):
+        if self.cache is not None:
+            key = self.cache.MakeKey(self.backend.Key(opts), data)
+            out = self.cache.Get(key)
+            if out is not None:
+                return out, ''
+
+        out, err = self.backend.Start(opts, data).Wait()
+        if self.cache is not None and err == '':
+            self.cache.Put(key, out)
+        return out, err
+
+    ## Metrics of the service
+    def Metrics(self):
+        metrics = {'uptime':time.time() - self.started,
+                'engine':self.backend.name, 'jobs':self.jobs,
+                'queue_limit':self.maxQueue, 'queue_depth':self.waiting,
+                'running':self.running, 'served':self.served,
+                'rejected':self.rejected, 'failed':self.failed,
+                'stages':self.stats.Summary()}
+        if self.cache is not None:
+            metrics['cache_hits'] = self.cache.hits
+            metrics['cache_misses'] = self.cache.misses
+            metrics['cache_bytes'] = self.cache.memBytes
+        return metrics
+
+    ## Handle the requests of a connection, kept alive as asked
+    async def Handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self.ReadRequest(reader)
+                except RequestError as e:
+                    await self.Respond(writer, e.args[0],
+                            e.args[1].encode('utf-8'), 'text/plain', False)
+                    break
+                if request is None:
+                    break
+
+                method, target, version, headers, body = request
+                keep = (headers.get('connection', '').lower() != 'close' and
+                        version == 'HTTP/1.1')
+
+                start = time.perf_counter()
+                try:
+                    status, ctype, data = await self.Dispatch(method, target,
+                            headers, body)
+                except RequestError as e:
+                    status, ctype = e.args[0], 'text/plain'
+                    data = e.args[1].encode('utf-8')
+                except Exception as e:
+                    log.exception('request failed')
+                    status, ctype = 500, 'text/plain'
+                    data = str(e).encode('utf-8')
+
+                await self.Respond(writer, status, data, ctype, keep)
+                self.stats.Add('request', time.perf_counter() - start,
+                        len(body), len(data))
+                log.info('%s %s %d %d', method, target, status, len(data))
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    ## Read a request. Returns (method, target, version, headers, body), or
+    #  None at the end of the connection.
+    async def ReadRequest(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise RequestError(400, 'Bad request line')
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, sep, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', '0'))
+        except ValueError:
+            raise RequestError(400, 'Bad Content-Length')
+        if length > self.maxBody:
+            raise RequestError(413, 'Request body too large')
+
+        body = await reader.readexactly(length) if length else b''
+        return method, target, version, headers, body
+
+    ## Write a response
+    async def Respond(self, writer, status, data, ctype, keep):
+        head = ('HTTP/1.1 %d %s\r\nContent-Type: %s\r\n'
+                'Content-Length: %d\r\nConnection: %s\r\n' % (status,
+                    HTTPStatus(status).phrase, ctype, len(data),
+                    'keep-alive' if keep else 'close'))
+        if status == 503:
+            head = head + 'Retry-After: 1\r\n'
+        writer.write(head.encode('latin-1') + b'\r\n' + data)
+        await writer.drain()
+
+    ## Serve a request. Returns (status, content type, body).
+    async def Dispatch(self, method, target, headers, body):
+        url = urlsplit(target)
+
+        if url.path == '/metrics':
+            if method != 'GET':
+                raise RequestError(405, 'Use GET')
+            return 200, 'application/json', json.dumps(self.Metrics(),
+                    indent=1).encode('utf-8')
+
+        if url.path != '/render':
+            raise RequestError(404, 'Not found')
+        if method != 'POST':
+            raise RequestError(405, 'Use POST')
+
+        if headers.get('content-type', '').startswith('application/json'):
+            # source as text, options in the body
+            try:
+                request = json.loads(body)
+                source = request['source']
+                options = request.get('options', {})
+                opts = ParseOptions(options.items())
+                data = source.encode(opts.get('encoding', 'utf-8'))
+            except RequestError:
+                raise
+            except Exception as e:
+                raise RequestError(400, 'Bad JSON request: %s' % e)
+        else:
+            # source bytes, options in the query string
+            opts = ParseOptions(parse_qsl(url.query))
+            data = body
+
+        # source bytes as highlight reads them
+        try:
+            data, encoding = hlcore.TranscodeSource(data,
+                    opts.get('encoding', 'utf-8'))
+        except LookupError:
+            raise RequestError(400, 'Unknown encoding')
+
+        opts = opts.Replace(encoding=encoding)
+        out, err = await self.Render(opts, data)
+        if err != '':
+            self.failed += 1
+            raise RequestError(422, err)
+
+        self.served += 1
+        ctype = CONTENT_TYPES.get(opts.get('output', 'html'), 'text/plain')
+        return 200, '%s; charset=%s' % (ctype, opts['encoding']), out
+
+
+## Client of the service. The connection is kept open between the requests.
+class Client:
+
+    def __init__(self, host='127.0.0.1', port=PORT, timeout=60):
+        self.conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    ## Render the source bytes with the options. Returns the output bytes,
+    #  raises RuntimeError with the message of the service on failure.
+    def Render(self, data, **opts):
+        self.conn.request('POST', '/render?' + urlencode(opts), data,
+                {'Content-Type':'application/octet-stream'})
+        resp = self.conn.getresponse()
+        body = resp.read()
+        if resp.status != 200:
+            raise RuntimeError('%d %s' % (resp.status,
+                body.decode('utf-8', 'replace')))
+        return body
+
+    ## Metrics of the service
+    def Metrics(self):
+        self.conn.request('GET', '/metrics')
+        resp = self.conn.getresponse()
+        return json.loads(resp.read())
+
+    def Close(self):
+        self.conn.close()
+
+
+## Run the server until interrupted
+async def Serve(service, host, port):
+    server = await asyncio.start_server(service.Handle, host, port)
+    log.warning('serving on http://%s:%d with %s', host, port,
+            service.backend.name)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Serve highlight conversions over local HTTP.')
+    parser.add_argument('--host', default='127.0.0.1',
+            help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=PORT,
+            help='port to listen on (default: %(default)s)')
+    parser.add_argument('-e', '--engine', default='highlight',
+            choices=hlcore.ENGINES,
+            help='conversion engine (default: %(default)s)')
+    parser.add_argument('-x', '--exe', default=hlcore.HIGHLIGHT,
+            help='highlight executable (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+            help='renders running at a time (default: %(default)s)')
+    parser.add_argument('-q', '--queue', type=int, default=64,
+            help='requests waiting at most (default: %(default)s)')
+    parser.add_argument('--max-body', type=int, default=16,
+            help='largest source in MB (default: %(default)s)')
+    parser.add_argument('--no-disk-cache', action='store_true',
+            help='keep the render cache in memory only')
+    parser.add_argument('--clear-cache', action='store_true',
+            help='empty the render cache on disk before serving')
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help='log every request')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else
+            logging.WARNING, format='%(asctime)s %(name)s: %(message)s')
+
+    jobs = max(1, args.jobs)
+    store = hlconfig.ConfigStore(exe=args.exe)
+    # theme files of the token engine, from the last scan of wxhighlight
+    themeDir = None
+    meta = store.LoadMetadata(check=False)
+    if meta is not None and (meta.get('paths') or {}).get('config'):
+        themeDir = os.path.join(meta['paths']['config'], 'themes')
+    try:
+        backend = hlcore.MakeBackend(args.engine, args.exe, themeDir, jobs)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    if args.no_disk_cache:
+        cache = hlcore.RenderCache()
+    else:
+        cache = hlcore.RenderCache(cacheDir=hlcore.UserCacheDir())
+        if args.clear_cache:
+            cache.Clear()
+        # outputs on disk are of the installation they were made with
+        meta = store.LoadMetadata()
+        if meta is not None:
+            cache.SetStamp(hlcore.CacheStamp(meta['stamp']))
+        # the embedded engines, unless the tokens read the theme files
+        elif args.engine != hlcore.HighlightBackend.name and not (
+                args.engine == 'tokens' and themeDir):
+            cache.SetStamp(hlcore.CacheStamp(''))
+        else:
+            log.warning('highlight metadata missing or stale, the render '
+                    'cache is kept in memory until wxhighlight scans it')
+
+    service = RenderService(backend, cache, jobs, args.queue,
+            args.max_body << 20)
+    try:
+        asyncio.run(Serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.executor.shutdown(wait=False)
+        backend.Close()
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
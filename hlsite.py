@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Compact html output for sites. No wx dependency.
+#
+# The theme css that each html output embeds is moved to one stylesheet
+# shared by the pages, which link to it instead. Adjacent spans of the same
+# class are merged and the blank ones unwrapped, keeping the spaces of the
+# classes with a background where they are:
+#
+#   css, page = SplitStyle(page)
+#   page = CompactPage(page, '../highlight.css')
+#
+
+import re
+
+
+## Embedded stylesheet of the html output
+STYLE_RE = re.compile(r'<style type="text/css">\s*(.*?)\s*</style>\s*', re.S)
+
+## Span followed by another one of the same class, spaces in between
+MERGE_RE = re.compile(r'(<span class="([^"]*)">[^<]*)</span>([ \t]*)'
+        r'<span class="\2">')
+
+## Span followed right away by another one of the same class
+ADJACENT_RE = re.compile(r'(<span class="([^"]*)">[^<]*)</span>()'
+        r'<span class="\2">')
+
+## Span with nothing in it, or only spaces
+EMPTY_RE = re.compile(r'<span class="([^"]*)">([ \t]*)</span>')
+
+## Rule of a stylesheet, selectors and declarations
+RULE_RE = re.compile(r'([^{}]+)\{([^}]*)\}')
+
+## Comment of a stylesheet
+COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+
+## Last part of a selector, the element and the classes
+COMPOUND_RE = re.compile(r'(\w*)((?:\.[\w-]+)+)$')
+
+
+## Split the html output into the embedded stylesheet and the page without
+#  it. The stylesheet is '' if there is none.
+def SplitStyle(page):
+    m = STYLE_RE.search(page)
+    if m is None:
+        return '', page
+    return m.group(1) + '\n', page[:m.start()] + page[m.end():]
+
+
+## Class sets of the spans given a background by the stylesheet. The spaces
+#  in such a span show, so they are kept where they are.
+def FilledClasses(css):
+    filled = []
+    for m in RULE_RE.finditer(COMMENT_RE.sub('', css)):
+        if 'background' not in m.group(2):
+            continue
+        for selector in m.group(1).split(','):
+            c = COMPOUND_RE.search(selector.strip())
+            if c is not None and c.group(1) in ('', 'span'):
+                filled.append(frozenset(c.group(2)[1:].split('.')))
+    return filled
+
+
+## Merge the adjacent spans of the same class. Each pass joins pairs, so
+#  a run of n spans takes about log2(n) passes. The spaces of the classes
+#  with a background, from FilledClasses, are not moved in or out of spans.
+def MergeSpans(page, filled=()):
+    def IsFilled(cls):
+        words = set(cls.split())
+        return any(f <= words for f in filled)
+
+    def Unwrap(m):
+        if m.group(2) and IsFilled(m.group(1)):
+            return m.group(0)
+        return m.group(2)
+
+    def Merge(m):
+        if m.group(3) and IsFilled(m.group(2)):
+            return m.group(0)
+        return m.group(1) + m.group(3)
+
+    page = EMPTY_RE.sub(Unwrap, page)
+    # the spans with nothing in between first, as a pair kept apart by its
+    # spaces hides the pair after it from MERGE_RE
+    for regex in (ADJACENT_RE, MERGE_RE):
+        while True:
+            merged = regex.sub(Merge, page)
+            if merged == page:
+                break
+            page = merged
+    return page
+
+
+## Page linking to the shared stylesheet at href, with the spans merged.
+#  The embedded stylesheet, if still there, is replaced by the link.
+def CompactPage(page, href):
+    link = '<link rel="stylesheet" type="text/css" href="%s" />\n' % (
+            href.replace('\\', '/'))
+    # in place of the embedded stylesheet, else at the end of the head
+    filled = ()
+    m = STYLE_RE.search(page)
+    if m is not None:
+        filled = FilledClasses(m.group(1))
+        page = page[:m.start()] + link + page[m.end():]
+    else:
+        pos = page.find('</head>')
+        if pos >= 0:
+            page = page[:pos] + link + page[pos:]
+    return MergeSpans(page, filled)
@@ -0,0 +1,719 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Token stream of a source and fast renderers over it. No wx
+#           dependency.
+#
+# The source is lexed once with the embedded pygments lexer into arrays of
+# token offsets and highlight token classes. Themes and output formats are
+# then applied by the renderers below, so that switching either costs one
+# pass over the tokens instead of a new conversion:
+#
+#   stream = Tokenize(text, 'c')
+#   theme = LoadTheme('edit-vim', themeDir)
+#   page = ''.join(Render(stream, theme, {'output':'html', 'lineno':True}))
+#
+
+import codecs
+import hashlib
+import html
+import os
+import re
+import threading
+from array import array
+from collections import OrderedDict
+
+from hlcore import ConvertOptions, PYGMENTS_LEXERS, PYGMENTS_STYLES, CHUNK
+
+
+## Highlight token classes, as used in the css of its html output. The
+#  keyword groups kwa to kwf follow.
+CLASSES = ['', 'num', 'esc', 'str', 'pps', 'com', 'slc', 'ppc', 'opt', 'ipl',
+        'lin', 'kwa', 'kwb', 'kwc', 'kwd', 'kwe', 'kwf']
+
+## Class of the line ends, not a highlight one
+NEWLINE = len(CLASSES)
+
+## Highlight theme entries of the classes
+THEME_KEYS = {'Number':'num', 'Escape':'esc', 'String':'str',
+        'StringPreProc':'pps', 'BlockComment':'com', 'LineComment':'slc',
+        'PreProcessor':'ppc', 'Operator':'opt', 'Interpolation':'ipl',
+        'LineNum':'lin'}
+
+## Classes of the pygments token types, the nearest parent applies
+PYGMENTS_CLASSES = {'Comment.Preproc':'ppc', 'Comment.PreprocFile':'pps',
+        'Comment.Single':'slc', 'Comment.Hashbang':'slc', 'Comment':'com',
+        'Literal.String.Escape':'esc', 'Literal.String.Interpol':'ipl',
+        'Literal.String':'str', 'Literal.Number':'num', 'Operator.Word':'kwa',
+        'Operator':'opt', 'Punctuation':'opt', 'Keyword.Type':'kwb',
+        'Keyword':'kwa', 'Name.Builtin':'kwb', 'Name.Tag':'kwa',
+        'Name.Attribute':'kwb', 'Name.Class':'kwc', 'Name.Decorator':'kwc',
+        'Name.Function':'kwd'}
+
+## Token streams kept by the backend, most recent first
+STREAMS = 4
+
+
+## Source lexed into tokens. starts holds the offset of each token in text,
+#  kinds its class, an index into CLASSES or NEWLINE. A token ends where the
+#  next one starts, and adjacent tokens of the same class are merged.
+class TokenStream:
+
+    def __init__(self, text='', syntax=''):
+        self.text = text
+        self.syntax = syntax
+        self.starts = array('L')
+        self.kinds = array('B')
+
+    def __len__(self):
+        return len(self.starts)
+
+    ## (start, end, kind) of each token
+    def Tokens(self):
+        ends = self.starts[1:]
+        ends.append(len(self.text))
+        return zip(self.starts, ends, self.kinds)
+
+    ## Number of lines, the one after a final line end not counted
+    def Lines(self):
+        return self.kinds.count(NEWLINE) + (not self.text.endswith('\n'))
+
+
+## Class index of the pygments token type
+def TokenClass(ttype, cache={}):
+    kind = cache.get(ttype)
+    if kind is None:
+        kind = 0
+        t = ttype
+        while t is not None and len(t):
+            name = '.'.join(t)
+            if name in PYGMENTS_CLASSES:
+                kind = CLASSES.index(PYGMENTS_CLASSES[name])
+                break
+            t = t.parent
+        cache[ttype] = kind
+    return kind
+
+
+## Lex the source text with the pygments lexer of the highlight syntax name.
+#  Tabs are expanded to 4 spaces, as highlight is told to.
+def Tokenize(text, syntax):
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+
+    try:
+        lexer = get_lexer_by_name(PYGMENTS_LEXERS.get(syntax, syntax),
+                tabsize=4, stripnl=False, ensurenl=False)
+    except ClassNotFound:
+        lexer = get_lexer_by_name('text', tabsize=4, stripnl=False,
+                ensurenl=False)
+
+    stream = TokenStream(syntax=syntax)
+    starts = stream.starts
+    kinds = stream.kinds
+    parts = []
+    pos = 0
+    last = -1
+    for ttype, value in lexer.get_tokens(text):
+        parts.append(value)
+        kind = TokenClass(ttype)
+        # line ends are tokens of their own
+        for idx, piece in enumerate(value.split('\n')):
+            if idx:
+                starts.append(pos)
+                kinds.append(NEWLINE)
+                last = NEWLINE
+                pos += 1
+            if piece:
+                if kind != last:
+                    starts.append(pos)
+                    kinds.append(kind)
+                    last = kind
+                pos += len(piece)
+
+    # text as lexed, tabs expanded
+    stream.text = ''.join(parts)
+    return stream
+
+
+## Colours and font styles of a theme. styles maps the class names to
+#  (colour, bold, italic, underline), colours being '#rrggbb' or None.
+class Theme:
+
+    def __init__(self, name, foreground='#000000', background='#ffffff',
+            styles=None):
+        self.name = name
+        self.foreground = foreground
+        self.background = background
+        self.styles = styles or {}
+
+    ## Style of the class index, None for the default text
+    def Style(self, kind):
+        return self.styles.get(CLASSES[kind]) if kind < NEWLINE else None
+
+    ## CSS declarations of the class index
+    def Css(self, kind):
+        style = self.Style(kind)
+        if style is None:
+            return ''
+        colour, bold, italic, underline = style
+        decl = []
+        if colour:
+            decl.append('color:%s' % colour)
+        if bold:
+            decl.append('font-weight:bold')
+        if italic:
+            decl.append('font-style:italic')
+        if underline:
+            decl.append('text-decoration:underline')
+        return '; '.join(decl)
+
+
+## Attributes of a highlight theme entry: Colour, Bold, Italic, Underline
+def ParseEntry(body):
+    attrs = dict((m.group(1), m.group(2) or m.group(3)) for m in
+            re.finditer(r'(\w+)\s*=\s*(?:"([^"]*)"|(\w+))', body))
+    colour = attrs.get('Colour')
+    return (colour if colour and colour.startswith('#') else None,
+            attrs.get('Bold') == 'true', attrs.get('Italic') == 'true',
+            attrs.get('Underline') == 'true')
+
+
+## Parse a highlight .theme file (Lua tables)
+def ParseTheme(name, text):
+    # lua comments
+    text = re.sub(r'--\[\[.*?\]\]|--[^\n]*', '', text, flags=re.S)
+    theme = Theme(name)
+
+    for m in re.finditer(r'\b(\w+)\s*=\s*\{([^{}]*)\}', text):
+        key, body = m.group(1), m.group(2)
+        colour, bold, italic, underline = ParseEntry(body)
+        if key == 'Default':
+            theme.foreground = colour or theme.foreground
+        elif key == 'Canvas':
+            theme.background = colour or theme.background
+        elif key in THEME_KEYS:
+            theme.styles[THEME_KEYS[key]] = (colour, bold, italic, underline)
+
+    # keyword groups, a list of tables
+    m = re.search(r'\bKeywords\s*=\s*\{((?:\s*\{[^{}]*\}\s*,?)*)\s*\}', text)
+    if m:
+        for idx, body in enumerate(re.findall(r'\{([^{}]*)\}', m.group(1))):
+            if idx < NEWLINE - CLASSES.index('kwa'):
+                theme.styles['kw' + chr(ord('a') + idx)] = ParseEntry(body)
+
+    return theme
+
+
+## Theme from a pygments style, for the highlight themes not found
+def PygmentsTheme(name):
+    from pygments.styles import get_style_by_name, get_all_styles
+    from pygments.token import string_to_tokentype
+
+    style = PYGMENTS_STYLES.get(name, name)
+    if style not in get_all_styles():
+        style = 'default'
+    style = get_style_by_name(style)
+
+    def Colour(value):
+        return '#' + value if value else None
+
+    theme = Theme(name, Colour(style.style_for_token(
+        string_to_tokentype('Text'))['color']) or '#000000',
+        style.background_color or '#ffffff')
+
+    # first pygments type of each class
+    for ttype, cls in PYGMENTS_CLASSES.items():
+        if cls in theme.styles:
+            continue
+        s = style.style_for_token(string_to_tokentype(ttype))
+        theme.styles[cls] = (Colour(s['color']), s['bold'], s['italic'],
+                s['underline'])
+    theme.styles['lin'] = (Colour(style.line_number_color) if
+            style.line_number_color != 'inherit' else None, False, False,
+            False)
+    return theme
+
+
+## Theme of the highlight name, read from the theme folder if found there,
+#  else the nearest pygments style
+def LoadTheme(name, themeDir=None):
+    if themeDir and name:
+        try:
+            path = os.path.join(themeDir, name + '.theme')
+            with open(path, encoding='utf-8', errors='replace') as f:
+                return ParseTheme(name, f.read())
+        except OSError:
+            pass
+    return PygmentsTheme(name or 'default')
+
+
+## (r, g, b) of a '#rrggbb' colour
+def Rgb(colour):
+    try:
+        return int(colour[1:3], 16), int(colour[3:5], 16), int(colour[5:7], 16)
+    except (TypeError, ValueError):
+        return 0, 0, 0
+
+
+## Start of each line number, as highlight pads them
+def LineNumbers(stream, opts):
+    first = opts.get('linestart') or 1
+    width = len(str(first + max(stream.Lines(), 1) - 1))
+    return first, '%' + str(width) + 'd '
+
+
+## Drop the line number appended after the final line end
+def DropLastNumber(stream, parts, number):
+    if stream.text.endswith('\n') and parts[-1] == number:
+        parts.pop()
+
+
+## Html and xhtml, with the classes or the styles inline
+def RenderHtml(stream, theme, opts):
+    text = stream.text
+    esc = html.escape
+    encoding = opts.get('encoding') or 'utf-8'
+    font = opts.get('font') or 'Courier New'
+    size = opts.get('fontsize') or '10'
+
+    if opts.get('inlcss'):
+        opens = ['<span style="%s">' % theme.Css(k) if theme.Css(k) else ''
+                for k in range(NEWLINE)]
+    else:
+        opens = ['<span class="hl %s">' % CLASSES[k] if theme.Css(k) else ''
+                for k in range(NEWLINE)]
+
+    parts = []
+    if opts.get('output') == 'xhtml':
+        parts.append('<?xml version="1.0" encoding="%s"?>\n<!DOCTYPE html '
+                'PUBLIC "-//W3C//DTD XHTML 1.1//EN" '
+                '"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n'
+                '<html xmlns="http://www.w3.org/1999/xhtml">\n' % encoding)
+    else:
+        parts.append('<!DOCTYPE html>\n<html>\n')
+    parts.append('<head>\n<meta charset="%s" />\n<title>Source file</title>\n'
+            '<style type="text/css">\n' % encoding)
+    parts.append('body.hl\t{ background-color:%s; }\n' % theme.background)
+    parts.append("pre.hl\t{ color:%s; background-color:%s; font-size:%spt; "
+            "font-family:'%s',monospace;}\n" % (theme.foreground,
+                theme.background, size, font))
+    if not opts.get('inlcss'):
+        for k in range(1, NEWLINE):
+            if theme.Css(k):
+                parts.append('.hl.%s\t{ %s; }\n' % (CLASSES[k], theme.Css(k)))
+    parts.append('</style>\n</head>\n<body class="hl">\n<pre class="hl">')
+
+    # line numbers after each line end
+    lineno = bool(opts.get('lineno'))
+    if lineno:
+        line, form = LineNumbers(stream, opts)
+        lin = opens[CLASSES.index('lin')] or '<span>'
+        parts.append(lin + form % line + '</span>')
+
+    for start, end, kind in stream.Tokens():
+        if kind == NEWLINE:
+            parts.append('\n')
+            if lineno:
+                line += 1
+                parts.append(lin + form % line + '</span>')
+        elif opens[kind]:
+            parts.append(opens[kind] + esc(text[start:end], False) + '</span>')
+        else:
+            parts.append(esc(text[start:end], False))
+
+    if lineno:
+        DropLastNumber(stream, parts, lin + form % line + '</span>')
+    parts.append('</pre>\n</body>\n</html>\n')
+    return parts
+
+
+## Escape text for latex
+LATEX_ESCAPE = str.maketrans({'\\':'\\textbackslash{}', '{':'\\{',
+    '}':'\\}', '$':'\\$', '&':'\\&', '#':'\\#', '^':'\\^{}', '_':'\\_',
+    '%':'\\%', '~':'\\~{}', ' ':'\\ ', '-':'{-}'})
+
+
+## Latex document
+def RenderLatex(stream, theme, opts):
+    text = stream.text
+
+    # (opening, closing) of each class
+    def Groups(kind):
+        style = theme.Style(kind)
+        if style is None:
+            return '', ''
+        colour, bold, italic, underline = style
+        groups = []
+        if colour:
+            groups.append('\\textcolor[rgb]{%.2f,%.2f,%.2f}{' % tuple(
+                c / 255 for c in Rgb(colour)))
+        if bold:
+            groups.append('\\textbf{')
+        if italic:
+            groups.append('\\textit{')
+        if underline:
+            groups.append('\\underline{')
+        return ''.join(groups), '}' * len(groups)
+
+    opens, closes = zip(*[Groups(k) for k in range(NEWLINE)])
+    fg = tuple(c / 255 for c in Rgb(theme.foreground))
+
+    parts = ['\\documentclass{article}\n\\usepackage{color}\n'
+            '\\usepackage[T1]{fontenc}\n\\usepackage[utf8]{inputenc}\n'
+            '\\begin{document}\n\\pagecolor[rgb]{%.2f,%.2f,%.2f}\n'
+            '\\ttfamily\n\\noindent\n\\color[rgb]{%.2f,%.2f,%.2f}'
+            % (tuple(c / 255 for c in Rgb(theme.background)) + fg)]
+
+    lineno = bool(opts.get('lineno'))
+    if lineno:
+        line, form = LineNumbers(stream, opts)
+        parts.append((form % line).translate(LATEX_ESCAPE))
+
+    for start, end, kind in stream.Tokens():
+        if kind == NEWLINE:
+            parts.append('\\\\\n')
+            if lineno:
+                line += 1
+                parts.append((form % line).translate(LATEX_ESCAPE))
+        else:
+            parts.append(opens[kind] + text[start:end].translate(
+                LATEX_ESCAPE) + closes[kind])
+
+    if lineno:
+        DropLastNumber(stream, parts, (form % line).translate(LATEX_ESCAPE))
+    parts.append('\n\\end{document}\n')
+    return parts
+
+
+## Rtf document
+def RenderRtf(stream, theme, opts):
+    text = stream.text
+    font = opts.get('font') or 'Courier New'
+    size = int(opts.get('fontsize') or '10') * 2
+
+    # colour table, foreground first
+    colours = [theme.foreground]
+    for k in range(1, NEWLINE):
+        style = theme.Style(k)
+        if style is not None and style[0] and style[0] not in colours:
+            colours.append(style[0])
+
+    def Open(kind):
+        style = theme.Style(kind)
+        if style is None:
+            return ''
+        colour, bold, italic, underline = style
+        s = '{\\cf%d' % (colours.index(colour) + 1 if colour else 1)
+        if bold:
+            s += '\\b'
+        if italic:
+            s += '\\i'
+        if underline:
+            s += '\\ul'
+        return s + ' '
+
+    opens = [Open(k) for k in range(NEWLINE)]
+
+    def Escape(s):
+        s = s.replace('\\', '\\\\').replace('{', '\\{').replace('}', '\\}')
+        if not s.isascii():
+            s = ''.join(c if ord(c) < 128 else '\\u%d?' % (ord(c) if
+                ord(c) < 32768 else ord(c) - 65536) for c in s)
+        return s
+
+    parts = ['{\\rtf1\\ansi\\deff0{\\fonttbl{\\f0\\fmodern %s;}}{\\colortbl;'
+            % font]
+    parts.extend('\\red%d\\green%d\\blue%d;' % Rgb(c) for c in colours)
+    parts.append('}\n\\f0\\fs%d\\cf1 ' % size)
+
+    lineno = bool(opts.get('lineno'))
+    if lineno:
+        line, form = LineNumbers(stream, opts)
+        parts.append(form % line)
+
+    for start, end, kind in stream.Tokens():
+        if kind == NEWLINE:
+            parts.append('\\par\n')
+            if lineno:
+                line += 1
+                parts.append(form % line)
+        elif opens[kind]:
+            parts.append(opens[kind] + Escape(text[start:end]) + '}')
+        else:
+            parts.append(Escape(text[start:end]))
+
+    if lineno:
+        DropLastNumber(stream, parts, form % line)
+    parts.append('\n}\n')
+    return parts
+
+
+## Nearest xterm 256 colour index of the rgb colour
+def Xterm256(rgb):
+    cube = [min(5, max(0, (c - 35) // 40)) for c in rgb]
+    return 16 + cube[0] * 36 + cube[1] * 6 + cube[2]
+
+
+## Nearest of the 8 basic ansi colours
+def Ansi8(rgb):
+    r, g, b = [c > 127 for c in rgb]
+    return 30 + r + g * 2 + b * 4
+
+
+## Terminal escape sequences: ansi, xterm256 or truecolor
+def RenderTerminal(stream, theme, opts):
+    text = stream.text
+    output = opts.get('output')
+
+    def Open(kind):
+        style = theme.Style(kind)
+        if style is None:
+            return ''
+        colour, bold, italic, underline = style
+        codes = []
+        if bold:
+            codes.append('1')
+        if italic:
+            codes.append('3')
+        if underline:
+            codes.append('4')
+        if colour:
+            rgb = Rgb(colour)
+            if output == 'truecolor':
+                codes.append('38;2;%d;%d;%d' % rgb)
+            elif output == 'xterm256':
+                codes.append('38;5;%d' % Xterm256(rgb))
+            else:
+                codes.append('%d' % Ansi8(rgb))
+        return '\x1b[%sm' % ';'.join(codes) if codes else ''
+
+    opens = [Open(k) for k in range(NEWLINE)]
+    lineno = bool(opts.get('lineno'))
+    parts = []
+    if lineno:
+        line, form = LineNumbers(stream, opts)
+        lin = opens[CLASSES.index('lin')]
+        parts.append(lin + form % line + '\x1b[m')
+
+    for start, end, kind in stream.Tokens():
+        if kind == NEWLINE:
+            parts.append('\n')
+            if lineno:
+                line += 1
+                parts.append(lin + form % line + '\x1b[m')
+        elif opens[kind]:
+            parts.append(opens[kind] + text[start:end] + '\x1b[m')
+        else:
+            parts.append(text[start:end])
+
+    if lineno:
+        DropLastNumber(stream, parts, lin + form % line + '\x1b[m')
+    return parts
+
+
+## BBCode
+def RenderBBCode(stream, theme, opts):
+    text = stream.text
+
+    def Tags(kind):
+        style = theme.Style(kind)
+        if style is None:
+            return '', ''
+        colour, bold, italic, underline = style
+        tags = [t for t, on in (('b', bold), ('i', italic), ('u', underline))
+                if on]
+        head = ''.join('[%s]' % t for t in tags)
+        tail = ''.join('[/%s]' % t for t in reversed(tags))
+        if colour:
+            head = '[color=%s]' % colour + head
+            tail = tail + '[/color]'
+        return head, tail
+
+    tags = [Tags(k) for k in range(NEWLINE)]
+    parts = ['[code]']
+    for start, end, kind in stream.Tokens():
+        if kind == NEWLINE:
+            parts.append('\n')
+        else:
+            head, tail = tags[kind]
+            parts.append(head + text[start:end] + tail)
+    parts.append('[/code]\n')
+    return parts
+
+
+## Pango markup
+def RenderPango(stream, theme, opts):
+    text = stream.text
+    esc = html.escape
+
+    def Open(kind):
+        style = theme.Style(kind)
+        if style is None:
+            return ''
+        colour, bold, italic, underline = style
+        attrs = ''
+        if colour:
+            attrs += ' foreground="%s"' % colour
+        if bold:
+            attrs += ' weight="bold"'
+        if italic:
+            attrs += ' style="italic"'
+        if underline:
+            attrs += ' underline="single"'
+        return '<span%s>' % attrs if attrs else ''
+
+    opens = [Open(k) for k in range(NEWLINE)]
+    parts = ['<span foreground="%s" background="%s"><tt>' % (
+        theme.foreground, theme.background)]
+    for start, end, kind in stream.Tokens():
+        if kind == NEWLINE:
+            parts.append('\n')
+        elif opens[kind]:
+            parts.append(opens[kind] + esc(text[start:end], False) + '</span>')
+        else:
+            parts.append(esc(text[start:end], False))
+    parts.append('</tt></span>\n')
+    return parts
+
+
+## Renderers of the highlight output formats
+RENDERERS = {'html':RenderHtml, 'xhtml':RenderHtml, 'latex':RenderLatex,
+        'rtf':RenderRtf, 'ansi':RenderTerminal, 'xterm256':RenderTerminal,
+        'truecolor':RenderTerminal, 'bbcode':RenderBBCode,
+        'pango':RenderPango}
+
+
+## Render the token stream with the theme in the output format of the
+#  options. Returns the list of output strings, None if the format has no
+#  renderer.
+def Render(stream, theme, opts):
+    renderer = RENDERERS.get(opts.get('output') or 'html')
+    if renderer is None:
+        return None
+    return renderer(stream, theme, opts)
+
+
+## Conversion over the token stream, run in the calling thread. The output
+#  is handed to onChunk in pieces if given, else returned by Wait().
+class TokenJob:
+
+    def __init__(self, backend, opts, data, onChunk=None):
+        self.backend = backend
+        self.opts = opts
+        self.data = data
+        self.onChunk = onChunk
+        self.killed = False
+        # stage timings of the job
+        self.timing = {}
+
+    ## Convert, returns (stdout bytes, stderr). stdout is None if streamed.
+    def Wait(self):
+        opts = self.opts
+        encoding = opts.get('encoding') or 'utf-8'
+        try:
+            stream = self.backend.Lex(opts.get('syntax') or '',
+                    self.data, encoding)
+            theme = self.backend.Theme(opts.get('style') or '')
+            parts = Render(stream, theme, opts)
+        except Exception as e:
+            return b'', str(e)
+
+        if parts is None:
+            return b'', 'Output format %s is not supported by the token ' \
+                    'renderer' % opts.get('output')
+        if self.killed:
+            return b'', 'Cancelled'
+
+        if self.onChunk is None:
+            return ''.join(parts).encode(encoding, 'replace'), ''
+
+        # pieces of about CHUNK characters
+        chunk = []
+        size = 0
+        for part in parts:
+            chunk.append(part)
+            size += len(part)
+            if size >= CHUNK:
+                if self.killed:
+                    return None, 'Cancelled'
+                self.onChunk(''.join(chunk))
+                chunk = []
+                size = 0
+        if chunk:
+            self.onChunk(''.join(chunk))
+        return None, ''
+
+    ## Abort the conversion, the result is discarded
+    def Kill(self):
+        self.killed = True
+
+
+## Token stream backend. The source is lexed once and kept, so that changes
+#  of the theme and the output format only render it again. Options not
+#  supported by the renderers (reformat, wrap) are ignored.
+class TokenBackend:
+
+    name = 'tokens'
+
+    def __init__(self, themeDir=None):
+        self.themeDir = themeDir
+        # (syntax, encoding, digest) -> TokenStream, most recent last
+        self.streams = OrderedDict()
+        self.themes = {}
+        # used by the foreground and the background workers
+        self.lock = threading.Lock()
+
+    ## Token stream of the source bytes, lexed if not kept
+    def Lex(self, syntax, data, encoding):
+        key = (syntax, encoding, hashlib.sha1(data).digest())
+        with self.lock:
+            stream = self.streams.get(key)
+            if stream is not None:
+                self.streams.move_to_end(key)
+                return stream
+
+        stream = Tokenize(codecs.decode(data, encoding, 'replace'), syntax)
+        with self.lock:
+            self.streams[key] = stream
+            while len(self.streams) > STREAMS:
+                self.streams.popitem(last=False)
+        return stream
+
+    ## Theme of the name, loaded once
+    def Theme(self, name):
+        with self.lock:
+            theme = self.themes.get(name)
+        if theme is None:
+            theme = LoadTheme(name, self.themeDir)
+            with self.lock:
+                self.themes[name] = theme
+        return theme
+
+    ## Canonical form of the options, used as the cache key
+    def Key(self, opts):
+        return (self.name, ConvertOptions.Of(opts))
+
+    ## Start a conversion, run by Wait() in the calling thread
+    def Start(self, opts, data):
+        return TokenJob(self, opts, data)
+
+    ## Start a streaming conversion
+    def Stream(self, opts, data, onChunk):
+        return TokenJob(self, opts, data, onChunk)
+
+    ## Convert the source with each of the options, lexing it once. Returns
+    #  a list of (stdout, stderr).
+    def RenderSet(self, optsList, data):
+        return [self.Start(opts, data).Wait() for opts in optsList]
+
+    ## Drop the lexed sources, the next conversions lex again
+    def Forget(self):
+        with self.lock:
+            self.streams.clear()
+
+    ## Release resources
+    def Close(self):
+        self.Forget()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Line structured HTML pages for the WebView. No wx dependency.
+#
+# The highlighted lines are wrapped one by one in <span class="l"> inside
+# <pre id="hl">, so that a range of lines can be replaced by a script without
+# reloading the page. Large outputs are shown through a virtualized page
+# holding only the lines around the visible range.
+#
+
+import json
+from array import array
+
+
+## Script to replace a range of lines
+SPLICE_JS = """<script>
+function hlSplice(start, count, html) {
+    var pre = document.getElementById('hl');
+    var ref = pre.children[start + count] || null;
+    var tmp = document.createElement('pre');
+    tmp.innerHTML = html;
+    for (var i = 0; i < count && pre.children[start]; i++)
+        pre.removeChild(pre.children[start]);
+    while (tmp.firstChild)
+        pre.insertBefore(tmp.firstChild, ref);
+}
+</script>
+"""
+
+## Line numbers by CSS counter, which stay correct when lines are spliced
+LINENO_CSS = """<style>
+#hl { counter-reset: ln; }
+#hl .l::before { counter-increment: ln; content: counter(ln);
+    display: inline-block; width: 4em; margin-right: 1em; text-align: right;
+    opacity: 0.5; }
+</style>
+"""
+
+## Lines of context rendered ahead of a changed region. Multi-line constructs
+#  starting in there are coloured correctly.
+CONTEXT = 50
+
+
+## Find the changed region between two lists of lines. Returns
+#  (start, oldEnd, newEnd) such that old[start:oldEnd] is replaced by
+#  new[start:newEnd].
+def DiffLines(old, new):
+    n = min(len(old), len(new))
+
+    # common prefix
+    start = 0
+    while start < n and old[start] == new[start]:
+        start += 1
+
+    # common suffix, not overlapping the prefix
+    end = 0
+    while (end < n - start and
+            old[len(old) - end - 1] == new[len(new) - end - 1]):
+        end += 1
+
+    return start, len(old) - end, len(new) - end
+
+
+## Split the highlighted document into the part before the <pre> contents,
+#  the lines in it and the part after. Returns None if there is no <pre>.
+def SplitPre(html):
+    head = html.find('<pre')
+    if head < 0:
+        return None
+    head = html.find('>', head) + 1
+    tail = html.rfind('</pre>')
+    if head <= 0 or tail < head:
+        return None
+
+    lines = html[head:tail].split('\n')
+    # the source ends with a new line
+    if lines and lines[-1] == '':
+        lines.pop()
+
+    return html[:head], lines, html[tail:]
+
+
+## Wrap the highlighted lines for the page
+def WrapLines(lines):
+    return ''.join('<span class="l">' + line + '\n</span>' for line in lines)
+
+
+## Live preview state. The document shown in the WebView is updated by
+#  re-highlighting only the region of lines changed since the last update.
+class LivePreview:
+
+    def __init__(self):
+        # source lines currently shown, None if there is no page
+        self.lines = None
+        # options used for the page
+        self.opts = None
+
+    ## Forget the page, the next update rebuilds it
+    def Reset(self):
+        self.lines = None
+        self.opts = None
+
+    ## Plan the update for the new source. Returns (text to render, plan).
+    #  The plan is handed back to Apply() with the highlighted output.
+    def Plan(self, text, opts):
+        lines = text.split('\n')
+
+        # rebuild the whole page
+        if self.lines is None or opts != self.opts:
+            return text + '\n', ('page', lines, opts)
+
+        start, oldEnd, newEnd = DiffLines(self.lines, lines)
+
+        # too much changed to be worth splicing
+        if (newEnd - start) * 2 > len(lines):
+            return text + '\n', ('page', lines, opts)
+
+        # render the changed region with some context ahead
+        first = max(0, start - CONTEXT)
+        region = lines[first:newEnd]
+        return ('\n'.join(region) + '\n',
+                ('splice', lines, start - first, start, oldEnd, newEnd))
+
+    ## Apply the highlighted output. Returns ('page', html) to load a new
+    #  page, ('script', js) to run on the current one, or None if the output
+    #  does not have the expected line structure.
+    def Apply(self, plan, html):
+        parts = SplitPre(html)
+        if parts is None:
+            return None
+        head, out, tail = parts
+
+        if plan[0] == 'page':
+            lines, opts = plan[1], plan[2]
+            if len(out) != len(lines):
+                return None
+
+            # mark the <pre> element and add the helpers in front of it
+            pre = head.rfind('<pre')
+            extra = SPLICE_JS
+            if opts.get('lineno'):
+                extra = extra + LINENO_CSS
+            page = (head[:pre] + extra + '<pre id="hl"' + head[pre+4:] +
+                    WrapLines(out) + tail)
+
+            self.lines = lines
+            self.opts = opts
+            return 'page', page
+
+        else:
+            lines, skip, start, oldEnd, newEnd = plan[1:]
+            if len(out) != newEnd - start + skip:
+                return None
+
+            js = 'hlSplice(%d,%d,%s);' % (start, oldEnd - start,
+                    json.dumps(WrapLines(out[skip:])))
+
+            self.lines = lines
+            return 'script', js
+
+
+## Script of the virtualized page. Only a window of lines is in the document,
+#  spacers above and below stand in for the rest. When scrolled near the edge
+#  of the window, the visible range is posted to the host, which answers by
+#  calling hlShow() with the lines around it.
+VIRTUAL_JS = """<script>
+var hlTotal = %d, hlFirst = 0, hlLast = 0, hlLineH = 0, hlPending = false;
+function hlShow(first, last, html) {
+    hlPending = false;
+    var body = document.getElementById('hlBody');
+    body.innerHTML = html;
+    if (hlLineH == 0 && last > first)
+        hlLineH = body.offsetHeight / (last - first);
+    document.getElementById('hlTop').style.height = (first * hlLineH) + 'px';
+    document.getElementById('hlBottom').style.height =
+        ((hlTotal - last) * hlLineH) + 'px';
+    hlFirst = first;
+    hlLast = last;
+}
+function hlScroll() {
+    if (hlPending || hlLineH == 0)
+        return;
+    var pre = document.getElementById('hl');
+    var top = window.scrollY - pre.offsetTop;
+    var first = Math.max(0, Math.floor(top / hlLineH));
+    var last = Math.min(hlTotal,
+        first + Math.ceil(window.innerHeight / hlLineH) + 1);
+    var margin = Math.floor((hlLast - hlFirst - (last - first)) / 4);
+    if ((first < hlFirst + margin && hlFirst > 0) ||
+            (last > hlLast - margin && hlLast < hlTotal)) {
+        hlPending = true;
+        window.%s.postMessage(JSON.stringify([first, last]));
+    }
+}
+window.addEventListener('scroll', hlScroll);
+window.addEventListener('resize', hlScroll);
+</script>
+"""
+
+## Name of the script message handler of the virtualized page
+VIRTUAL_HANDLER = 'wx_msg'
+
+## Lines rendered beyond the visible range in each direction
+VIRTUAL_MARGIN = 300
+
+
+## Highlighted document shown through a virtualized page. The output is kept
+#  as it is, in one string, with an index of the line offsets inside <pre>.
+class VirtualDocument:
+
+    def __init__(self, html):
+        self.html = html
+        self.offsets = None
+
+        head = html.find('<pre')
+        if head < 0:
+            return
+        head = html.find('>', head) + 1
+        tail = html.rfind('</pre>')
+        if head <= 0 or tail < head:
+            return
+
+        # start offset of each line, and the end of the last one
+        offsets = array('Q', [head])
+        find = html.find
+        pos = head
+        while True:
+            pos = find('\n', pos, tail)
+            if pos < 0:
+                break
+            pos += 1
+            offsets.append(pos)
+        if offsets[-1] != tail:
+            offsets.append(tail)
+
+        self.offsets = offsets
+        self.head = head
+        self.tail = tail
+
+    ## The <pre> element was found
+    def IsValid(self):
+        return self.offsets is not None
+
+    ## Number of lines
+    def Count(self):
+        return len(self.offsets) - 1
+
+    ## Html of the lines first to last (exclusive)
+    def Lines(self, first, last):
+        return self.html[self.offsets[first]:self.offsets[last]]
+
+    ## Page with the first window of lines
+    def Page(self):
+        last = min(self.Count(), VIRTUAL_MARGIN * 2)
+        pre = self.html.rfind('<pre', 0, self.head)
+        return (self.html[:pre] +
+                VIRTUAL_JS % (self.Count(), VIRTUAL_HANDLER) +
+                '<pre id="hl"' + self.html[pre+4:self.head] +
+                '<span id="hlTop" style="display:block"></span>'
+                '<span id="hlBody"></span>'
+                '<span id="hlBottom" style="display:block"></span>' +
+                self.html[self.tail:self.tail+6] +
+                '<script>hlShow(0,%d,%s);</script>' % (last,
+                    json.dumps(self.Lines(0, last))) +
+                self.html[self.tail+6:])
+
+    ## Script answering the visible range posted by the page
+    def Window(self, message):
+        try:
+            first, last = json.loads(message)
+        except (ValueError, TypeError):
+            return None
+
+        first = max(0, int(first) - VIRTUAL_MARGIN)
+        last = min(self.Count(), int(last) + VIRTUAL_MARGIN)
+        if last <= first:
+            return None
+        return 'hlShow(%d,%d,%s);' % (first, last,
+                json.dumps(self.Lines(first, last)))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# \file
+# \author   <a href="http://www.innomatic.ca">innomatic</a>
+# \brief    Highlight command lines of the conversion options
+#
+# The argv of each combination of the controls is pinned, as it is run
+# without a shell and every value has to reach highlight as it is:
+#
+#   python3 -m pytest tests
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hlcore import ConvertOptions, HighlightCommand, SettingsOptions
+
+
+## Highlight executable of the tests
+EXE = '/usr/bin/highlight'
+
+## Arguments given with any options
+TAIL = ['--include-style', '--replace-tabs=4']
+
+## Metadata lists of the settings tests, descriptions to highlight names
+SYNTAX = {'C and C++':'c', 'Python':'py'}
+OUTPUT = {'HTML':'html', 'LaTeX':'latex'}
+THEMES = {'Vim Edit':'edit-vim', 'Molokai':'molokai'}
+ASTYLE = {'None':' ', 'Allman':'allman', 'K&R':'kr'}
+PLUGIN = {'mark_lines':'Mark lines', 'bash_functions':'Bash functions'}
+
+
+class ArgvTest(unittest.TestCase):
+
+    def testEmpty(self):
+        self.assertEqual(ConvertOptions().Argv(EXE), [EXE] + TAIL)
+
+    def testSyntaxOutputStyle(self):
+        opts = ConvertOptions(syntax='c', output='html', style='edit-vim')
+        self.assertEqual(opts.Argv(EXE), [EXE, '--syntax=c',
+            '--out-format=html', '--style=edit-vim'] + TAIL)
+
+    def testLineNumbers(self):
+        opts = ConvertOptions(lineno=True)
+        self.assertEqual(opts.Argv(EXE), [EXE, '--include-style',
+            '--line-numbers', '--replace-tabs=4'])
+
+    def testLineStart(self):
+        opts = ConvertOptions(lineno=True, linestart=42)
+        self.assertEqual(opts.Argv(EXE), [EXE, '--include-style',
+            '--line-numbers', '--line-number-start=42', '--replace-tabs=4'])
+
+    def testLineStartWithoutNumbers(self):
+        opts = ConvertOptions(linestart=42)
+        self.assertEqual(opts.Argv(EXE), [EXE] + TAIL)
+
+    def testWrap(self):
+        opts = ConvertOptions(wrap=True)
+        self.assertEqual(opts.Argv(EXE), [EXE, '--include-style',
+            '--wrap-simple', '--wrap-no-numbers', '--replace-tabs=4'])
+
+    def testInlineCss(self):
+        opts = ConvertOptions(inlcss=True)
+        self.assertEqual(opts.Argv(EXE), [EXE, '--include-style',
+            '--inline-css', '--replace-tabs=4'])
+
+    def testFontWithSpaces(self):
+        opts = ConvertOptions(font='DejaVu Sans Mono', fontsize='11')
+        self.assertEqual(opts.Argv(EXE), [EXE, '--font=DejaVu Sans Mono',
+            '--font-size=11'] + TAIL)
+
+    def testFontWithQuotes(self):
+        opts = ConvertOptions(font='Bob\'s "Mono" (v2), $HOME; `x`')
+        self.assertEqual(opts.Argv(EXE), [EXE,
+            '--font=Bob\'s "Mono" (v2), $HOME; `x`'] + TAIL)
+
+    def testFontSizeWithoutFont(self):
+        opts = ConvertOptions(fontsize='11')
+        self.assertEqual(opts.Argv(EXE), [EXE] + TAIL)
+
+    def testAstyle(self):
+        opts = ConvertOptions(reformat='allman')
+        self.assertEqual(opts.Argv(EXE), [EXE, '--reformat=allman'] + TAIL)
+
+    def testAstyleNone(self):
+        opts = ConvertOptions(reformat=' ')
+        self.assertEqual(opts.Argv(EXE), [EXE] + TAIL)
+
+    def testPlugin(self):
+        opts = ConvertOptions(plugin='mark_lines')
+        self.assertEqual(opts.Argv(EXE), [EXE, '--plugin=mark_lines'] + TAIL)
+
+    def testEncoding(self):
+        opts = ConvertOptions(encoding='windows-1252')
+        self.assertEqual(opts.Argv(EXE), [EXE] + TAIL +
+            ['--encoding=windows-1252'])
+
+    def testAll(self):
+        opts = ConvertOptions(syntax='py', output='latex', style='molokai',
+                reformat='kr', plugin='bash_functions', font='Fira Code',
+                fontsize='12', lineno=True, linestart=7, wrap=True,
+                inlcss=True, encoding='utf-8')
+        self.assertEqual(opts.Argv(EXE), [EXE, '--syntax=py',
+            '--out-format=latex', '--reformat=kr', '--style=molokai',
+            '--plugin=bash_functions', '--font=Fira Code', '--font-size=12',
+            '--include-style', '--line-numbers', '--line-number-start=7',
+            '--wrap-simple', '--wrap-no-numbers', '--inline-css',
+            '--replace-tabs=4', '--encoding=utf-8'])
+
+    def testExeWithSpaces(self):
+        exe = 'c:\\Program Files\\Highlight\\highlight.exe'
+        self.assertEqual(HighlightCommand(exe, {'syntax':'c'}),
+            [exe, '--syntax=c'] + TAIL)
+
+    def testCommandOfDict(self):
+        self.assertEqual(HighlightCommand(EXE, {'lineno':True, 'wrap':True,
+            'font':'Courier New'}), [EXE, '--font=Courier New',
+                '--include-style', '--line-numbers', '--wrap-simple',
+                '--wrap-no-numbers', '--replace-tabs=4'])
+
+    def testCommandOfOptions(self):
+        opts = ConvertOptions(syntax='c', inlcss=True)
+        self.assertEqual(HighlightCommand(EXE, opts), opts.Argv(EXE))
+
+    def testUnknownOption(self):
+        with self.assertRaises(TypeError):
+            HighlightCommand(EXE, {'shell':'rm -rf /'})
+
+
+class SettingsTest(unittest.TestCase):
+
+    def Argv(self, settng):
+        return SettingsOptions(settng, SYNTAX, OUTPUT, THEMES, ASTYLE,
+                PLUGIN).Argv(EXE)
+
+    def testEmpty(self):
+        self.assertEqual(self.Argv({}), [EXE] + TAIL)
+
+    def testDescriptions(self):
+        self.assertEqual(self.Argv({'syntax':'C and C++', 'output':'HTML',
+            'themes':'Vim Edit'}), [EXE, '--syntax=c', '--out-format=html',
+                '--style=edit-vim'] + TAIL)
+
+    def testUnknownDescriptions(self):
+        self.assertEqual(self.Argv({'syntax':'Cobol', 'output':'html',
+            'themes':'edit-vim', 'astyle':'GNU', 'plugin':'missing'}),
+            [EXE] + TAIL)
+
+    def testAstyle(self):
+        self.assertEqual(self.Argv({'astyle':'K&R'}),
+            [EXE, '--reformat=kr'] + TAIL)
+
+    def testAstyleNone(self):
+        self.assertEqual(self.Argv({'astyle':'None'}), [EXE] + TAIL)
+
+    def testPlugin(self):
+        self.assertEqual(self.Argv({'plugin':'mark_lines'}),
+            [EXE, '--plugin=mark_lines'] + TAIL)
+
+    def testPluginWithoutList(self):
+        opts = SettingsOptions({'plugin':'mark_lines'}, SYNTAX, OUTPUT,
+                THEMES, ASTYLE)
+        self.assertEqual(opts.Argv(EXE), [EXE] + TAIL)
+
+    def testFontWithQuotes(self):
+        self.assertEqual(self.Argv({'hlfont':"Bob's Mono", 'fntsiz':'14'}),
+            [EXE, "--font=Bob's Mono", '--font-size=14'] + TAIL)
+
+    def testFontSizeWithoutFont(self):
+        self.assertEqual(self.Argv({'hlfont':'', 'fntsiz':'14'}),
+            [EXE] + TAIL)
+
+    def testOptions(self):
+        self.assertEqual(self.Argv({'option':{'lineno':True, 'wrapln':True,
+            'inlcss':True}}), [EXE, '--include-style', '--line-numbers',
+                '--wrap-simple', '--wrap-no-numbers', '--inline-css',
+                '--replace-tabs=4'])
+
+    def testOptionsOff(self):
+        self.assertEqual(self.Argv({'option':{'lineno':False,
+            'wrapln':False, 'inlcss':False}}), [EXE] + TAIL)
+
+    def testAll(self):
+        self.assertEqual(self.Argv({'syntax':'Python', 'output':'LaTeX',
+            'themes':'Molokai', 'astyle':'Allman', 'plugin':'bash_functions',
+            'hlfont':'Fira Code', 'fntsiz':'12', 'option':{'lineno':True,
+                'wrapln':True, 'inlcss':True}}), [EXE, '--syntax=py',
+            '--out-format=latex', '--reformat=allman', '--style=molokai',
+            '--plugin=bash_functions', '--font=Fira Code', '--font-size=12',
+            '--include-style', '--line-numbers', '--wrap-simple',
+            '--wrap-no-numbers', '--inline-css', '--replace-tabs=4'])
+
+
+if __name__ == '__main__':
+    unittest.main()
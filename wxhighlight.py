@@ -5,79 +5,192 @@
 # \author   <a href="http://www.innomatic.ca">innomatic</a>
 # \brief    Highlight wxPython frontend
 # \see      http://www.andre-simon.de/doku/highlight/en/highlight.php
-# \bug      screen capture works on the first monitor only.
 #
 
-import ctypes
-import glob
+import argparse
+import json
+import itertools
+import logging
 import os
-import pickle
+import threading
+import time
 import wx
-import wx.html2 as html2
-from subprocess import run, PIPE
+from hlcore import (CacheStamp, ConvertOptions, ConvertWorker, EngineAvailable,
+        HIGHLIGHT, RenderCache, SettingsOptions, SNIFF_SIZE, Stats,
+        UserCacheDir)
+from hlconfig import ASTYLE_STYLES, ConfigError, DiscoverParams, OUTPUT_FORMATS
+from hlclip import ClipPayloads, FORMATS as CLIP_PAYLOADS
+from hldoc import Document, DocumentSet, FileLoader
+from hlexport import ExportSet, WriteExport
+from hlimage import ParseHtml, SaveImage
+from hlrender import Renderer
+from hlview import LivePreview, VirtualDocument, VIRTUAL_HANDLER
 
-## Get the real screen size after SetProcessDPIAware, which is used to compute
-#  the screen ratio. This function runs in separate process not to affect the UI.
-def SystemMetrics(q):
-    ctypes.windll.user32.SetProcessDPIAware()
-    q.put(ctypes.windll.user32.GetSystemMetrics(0))
-    return
 
+## Inputs larger than this are converted with the output streamed
+STREAM_SIZE = 1 << 20
 
-## FileDropTarget. On drop it loads the file contents and update the file name
+## Streamed chunks posted to the window and not shown yet, at most
+STREAM_BACKLOG = 4
+
+## Outputs larger than this are shown through a virtualized page
+VIRTUAL_SIZE = 2 << 20
+
+## Total size of the renders kept for the open documents
+RENDER_BYTES = 64 << 20
+
+log = logging.getLogger('wxhighlight')
+
+
+## FileDropTarget. On drop the files are opened in the document tabs
 class MyFileDropTarget(wx.FileDropTarget):
 
-    def __init__(self, window, log):
+    def __init__(self, frame):
         wx.FileDropTarget.__init__(self)
-        # target window
-        self.window = window
-        # file name window (wx.TextCtrl)
-        self.log = log
+        # main frame
+        self.frame = frame
 
-    # Load file content into the target window
-    def OnDropFiles(self, x, y, fname):
-        try:
-            # let the parent load the file
-            self.window.LoadFile(fname[0])
-        except:
+    # Let the frame open the files
+    def OnDropFiles(self, x, y, fnames):
+        return self.frame.OpenFiles(fnames)
+
+
+## Plain text made when a program asks for it
+class ClipTextData(wx.TextDataObject):
+
+    def __init__(self, clip):
+        wx.TextDataObject.__init__(self)
+        self.clip = clip
+
+    def GetTextLength(self):
+        return len(self.GetText()) + 1
+
+    def GetText(self):
+        return self.clip.Get('text') or ''
+
+
+## Html made when a program asks for it
+class ClipHtmlData(wx.HTMLDataObject):
+
+    def __init__(self, clip):
+        wx.HTMLDataObject.__init__(self)
+        self.clip = clip
+
+    def GetHTML(self):
+        return self.clip.Get('html') or ''
+
+
+## Bytes of a payload made when a program asks for it
+class ClipBytesData(wx.DataObjectSimple):
+
+    def __init__(self, clip, name, fmt):
+        wx.DataObjectSimple.__init__(self, fmt)
+        self.clip = clip
+        self.name = name
+
+    def GetDataSize(self):
+        return len(self.clip.Get(self.name) or b'')
+
+    def GetDataHere(self, buf):
+        data = self.clip.Get(self.name)
+        if data is None:
             return False
+        buf[:] = data
+        return True
+
+    # pasted data is not taken
+    def SetData(self, buf):
+        return False
+
+
+## Clipboard format names of rtf and PNG by platform
+CLIP_FORMATS = {
+    '__WXMSW__': {'rtf':'Rich Text Format', 'png':'PNG'},
+    '__WXMAC__': {'rtf':'public.rtf', 'png':'public.png'},
+    }
+
+## Clipboard data object offering the payloads named, made only when
+#  asked for. The first one is preferred.
+def ClipboardData(clip, names):
+    formats = CLIP_FORMATS.get(wx.Platform,
+            {'rtf':'text/rtf', 'png':'image/png'})
+    data = wx.DataObjectComposite()
+    for idx, name in enumerate(names):
+        if name == 'text':
+            obj = ClipTextData(clip)
+        elif name == 'html':
+            obj = ClipHtmlData(clip)
+        elif name == 'png' and hasattr(wx, 'DF_PNG'):
+            obj = ClipBytesData(clip, name, wx.DataFormat(wx.DF_PNG))
         else:
-            # show file name on the log window
-            if 'nt' in os.name:
-                self.log.SetValue(fname[0][fname[0].rfind('\\')+1:])
-            else:
-                self.log.SetValue(fname[0][fname[0].rfind('/')+1:])
-
-            return True
+            obj = ClipBytesData(clip, name, wx.DataFormat(formats[name]))
+        data.Add(obj, idx == 0)
+    return data
 
 
 ## Main frame window
 class MyFrame(wx.Frame):
 
     def __init__(self, *args, **kwgs):
+        # startup time is measured up to the first idle
+        self.started = time.perf_counter()
+        # close once started, for the measurement
+        self.exitOnStart = kwgs.pop('exitOnStart', False)
         wx.Frame.__init__(self, *args, **kwgs)
 
         # spliter window 
         self.spw = wx.SplitterWindow(self, style=wx.SP_LIVE_UPDATE)
         self.spw.SetMinimumPaneSize(100)
 
-        # source text on the top
-        self.textSrc = wx.TextCtrl(self.spw, style=wx.TE_MULTILINE)
+        # source documents on the top, one tab each
+        self.nbkSrc = wx.Notebook(self.spw)
+        self.nbkSrc.Bind(wx.EVT_NOTEBOOK_PAGE_CHANGED, self.OnDocChanged)
+        self.docs = DocumentSet(RENDER_BYTES)
+        # current document, textSrc is its text control
+        self.doc = None
+        self.textSrc = None
 
         # notebook below
         self.nbkOut = wx.Notebook(self.spw)
-        self.spw.SplitHorizontally(self.textSrc, self.nbkOut, 0)
-
-        # webview output
-        self.webView = html2.WebView.New(self.nbkOut)
+        self.spw.SplitHorizontally(self.nbkSrc, self.nbkOut, 0)
+
+        # webview output, created on the first conversion as the browser
+        # engine is slow to start. The panel holds its place.
+        self.pnlWeb = wx.Panel(self.nbkOut)
+        self.pnlWeb.SetSizer(wx.BoxSizer(wx.VERTICAL))
+        self.webView = None
+        self.virtualOk = False
         # it becomes the first page of the notebook
-        self.nbkOut.AddPage(self.webView, 'WebView')
+        self.nbkOut.AddPage(self.pnlWeb, 'WebView')
+        # virtualized document shown
+        self.virtual = None
 
         # text output
         self.textOut = wx.TextCtrl(self.nbkOut,
                 style=wx.TE_MULTILINE|wx.TE_READONLY)
         # it becomes the second page of the notebook
         self.nbkOut.AddPage(self.textOut, 'TextView')
+        # output, filled into textOut when the page is selected
+        self.outText = None
+        self.textStale = False
+        # output bytes as converted, and the encoding of the latest request
+        self.outBytes = None
+        self.outEncoding = 'utf-8'
+        # ConvertOptions of the output shown, and of the latest conversion
+        self.outOpts = None
+        self.convOpts = None
+
+        # timing statistics
+        self.lstStats = wx.ListCtrl(self.nbkOut, style=wx.LC_REPORT)
+        for col, label in enumerate(['Stage', 'Last (ms)', 'Mean (ms)',
+                'P95 (ms)', 'Count', 'Bytes In', 'Bytes Out']):
+            self.lstStats.InsertColumn(col, label,
+                    wx.LIST_FORMAT_LEFT if col == 0 else wx.LIST_FORMAT_RIGHT,
+                    width=140 if col == 0 else 90)
+        # it becomes the third page of the notebook
+        self.nbkOut.AddPage(self.lstStats, 'Stats')
+        self.nbkOut.Bind(wx.EVT_NOTEBOOK_PAGE_CHANGED, self.OnPageChanged)
+        self.stats = Stats()
 
         # control panel on the right
         self.pnlCtrl = wx.Panel(self)
@@ -90,7 +203,13 @@ class MyFrame(wx.Frame):
         self.txtDisply = wx.TextCtrl(self.pnlCtrl, -1, style=wx.TE_READONLY)
         # txtFlname events
         self.txtFlname.Bind(wx.EVT_LEFT_DOWN, self.OnLoadSource)
-        self.txtFlname.Bind(wx.EVT_TEXT, self.OnSourceName)
+        # document tabs
+        self.btnNewDoc = wx.Button(self.pnlCtrl, -1, label='New Document')
+        self.Bind(wx.EVT_BUTTON, self.OnNewDoc, self.btnNewDoc)
+        self.btnClsDoc = wx.Button(self.pnlCtrl, -1, label='Close Document')
+        self.Bind(wx.EVT_BUTTON, self.OnCloseDoc, self.btnClsDoc)
+        # file loading progress
+        self.gauLoad = wx.Gauge(self.pnlCtrl, -1, 1000, size=(-1,8))
 
         # other controls
         self.sttSyntax = wx.StaticText(self.pnlCtrl, -1, 'Syntax')
@@ -99,71 +218,140 @@ class MyFrame(wx.Frame):
         self.choOutput = wx.Choice(self.pnlCtrl, -1, style=wx.CB_SORT)
         self.sttThemes = wx.StaticText(self.pnlCtrl, -1, 'Theme')
         self.choThemes = wx.Choice(self.pnlCtrl, -1, style=wx.CB_SORT)
+        self.Bind(wx.EVT_CHOICE, self.OnStyleChoice, self.choThemes)
+        self.Bind(wx.EVT_CHOICE, self.OnStyleChoice, self.choOutput)
         self.sttAstyle = wx.StaticText(self.pnlCtrl, -1, 'Astyle')
         self.choAstyle = wx.Choice(self.pnlCtrl, -1, style=wx.CB_SORT)
         self.sttHlFont = wx.StaticText(self.pnlCtrl, -1, 'Font')
         self.choHlFont = wx.Choice(self.pnlCtrl, -1, style=wx.CB_SORT)
         self.sttFntSiz = wx.StaticText(self.pnlCtrl, -1, 'Size')
         self.choFntSiz = wx.Choice(self.pnlCtrl, -1)
+        self.sttEngine = wx.StaticText(self.pnlCtrl, -1, 'Engine')
+        self.choEngine = wx.Choice(self.pnlCtrl, -1)
+        self.Bind(wx.EVT_CHOICE, self.OnEngine, self.choEngine)
+        self.sttImgDpi = wx.StaticText(self.pnlCtrl, -1, 'Image DPI')
+        self.choImgDpi = wx.Choice(self.pnlCtrl, -1)
 
         # option checkboxes
         self.sttOption = wx.StaticText(self.pnlCtrl, -1, 'Option')
         self.chkLineNo = wx.CheckBox(self.pnlCtrl, -1, 'Line Numbering')
         self.chkWrapLn = wx.CheckBox(self.pnlCtrl, -1, 'Wrap Lines after 80')
         self.chkInLCss = wx.CheckBox(self.pnlCtrl, -1, 'CSS within each tag')
+        self.chkLivePv = wx.CheckBox(self.pnlCtrl, -1, 'Live Preview')
+        self.Bind(wx.EVT_CHECKBOX, self.OnLivePreview, self.chkLivePv)
 
         # convert button
         self.btnConvrt = wx.Button(self.pnlCtrl, -1, label='Convert')
         self.Bind(wx.EVT_BUTTON, self.OnConvert, self.btnConvrt)
+        # busy indicator while the conversion runs
+        self.gauBusy = wx.Gauge(self.pnlCtrl, -1, 100, size=(-1,8))
+        self.tmrBusy = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnBusyTimer, self.tmrBusy)
         # text to clipboard
         self.btnClpTxt = wx.Button(self.pnlCtrl, -1, label='Output to Clipboard')
         self.Bind(wx.EVT_BUTTON, self.OnClipText, self.btnClpTxt)
         # image to clipboard
         self.btnClpImg = wx.Button(self.pnlCtrl, -1, label='Image to Clipboard')
         self.Bind(wx.EVT_BUTTON, self.OnClipImage, self.btnClpImg)
+        # image to file
+        self.btnSavImg = wx.Button(self.pnlCtrl, -1, label='Image to File')
+        self.Bind(wx.EVT_BUTTON, self.OnSaveImage, self.btnSavImg)
         # text to file
         self.btnSavTxt = wx.Button(self.pnlCtrl, -1, label='Output to File')
         self.Bind(wx.EVT_BUTTON, self.OnSaveFile, self.btnSavTxt)
+        # formats and themes to a folder or zip
+        self.btnExpSet = wx.Button(self.pnlCtrl, -1, label='Export Set')
+        self.Bind(wx.EVT_BUTTON, self.OnExportSet, self.btnExpSet)
 
         # window event
         self.Bind(wx.EVT_CLOSE, self.OnClose)
 
-        # set droptarget
-        dt = MyFileDropTarget(self.textSrc, self.txtFlname)
-        self.textSrc.SetDropTarget(dt)
-
-        # font enumerator
-        fe = wx.FontEnumerator()
-        # we may want only fixed-width ones
-        fe.EnumerateFacenames(fixedWidthOnly=True)
-        for item in fe.GetFacenames():
-            # we don't need vertical fonts 
-            if item[0] == '@':
-                pass
-            else:
-                self.choHlFont.Append(item)
+        # live preview, updated shortly after the last edit
+        self.live = LivePreview()
+        self.liveSeq = None
+        self.livePlan = None
+        self.cllLive = None
+        # streamed output has been started
+        self.streamStarted = False
+        # chunks posted ahead of the view, the engine waits for a free one
+        self.streamSlots = threading.Semaphore(STREAM_BACKLOG)
+        # (document, version) of the whole document conversion in flight
+        self.convDoc = None
+
+        # first document, it takes the settings loaded below
+        self.doc = self.NewDocument()
+        self.textSrc = self.doc.view
+        self.docs.View(self.doc)
+
         # font size
         for item in ['8','9','10','11','12','14','16','20']:
             self.choFntSiz.Append(item)
+        # image resolution
+        for item in ['96','144','192','300']:
+            self.choImgDpi.Append(item)
+
+        # conversion engines
+        self.choEngine.Append('highlight')
+        # embedded engines if pygments is installed
+        if EngineAvailable():
+            self.choEngine.Append('pygments')
+            self.choEngine.Append('tokens')
 
         # executable
-        if 'nt' in os.name:
-            self.hlight = 'c:\\Program Files\\Highlight\\highlight.exe'
-        else:
-            self.hlight = '/usr/bin/highlight'
+        self.hlight = HIGHLIGHT
+        # conversions, syntax detection and the settings store
+        self.renderer = Renderer(exe=self.hlight, stats=self.stats)
 
         # initialize params
         self.LoadParams()
+
+        # render cache, on-disk tier unless turned off in the settings
+        if self.settng.get('diskcache', True):
+            self.cache = RenderCache(cacheDir=UserCacheDir())
+        else:
+            self.cache = RenderCache()
+        self.renderer.cache = self.cache
+
+        # background conversion worker
+        self.worker = ConvertWorker(
+                lambda *args: wx.CallAfter(self.OnConverted, *args),
+                self.renderer.SetEngine(self.choEngine.GetStringSelection(),
+                    self.themeDir), self.cache, self.stats)
+        # background rendering of the other documents, sharing the backend
+        self.preWorker = ConvertWorker(
+                lambda *args: wx.CallAfter(self.OnPreRendered, *args),
+                self.worker.backend, self.cache)
+        # (document, version, seq, encoding) of the background render in
+        # flight
+        self.preDoc = None
+        # html render of the image export, and the (seq, encoding) of the
+        # one in flight
+        self.imgWorker = ConvertWorker(
+                lambda *args: wx.CallAfter(self.OnImageRendered, *args),
+                self.worker.backend, self.cache)
+        self.imgJob = None
+        self.Bind(wx.EVT_IDLE, self.OnIdle)
+        # files are loaded in the background, keyed by a serial number
+        self.loadSerial = itertools.count(1)
+        self.loader = FileLoader(
+                lambda *args: wx.CallAfter(self.OnLoadChunk, *args),
+                lambda *args: wx.CallAfter(self.OnLoadDone, *args))
         # intialize screen scale
         self.InitScale()
 
-        # sizer
-        sizer_x = wx.FlexGridSizer(17,2,0,0)
+        # sizer (number of rows is computed from the items)
+        sizer_x = wx.FlexGridSizer(0,2,0,0)
         # file name and scale information
         sizer_x.Add(self.sttFlname, 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add(self.txtFlname, 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add(self.sttDisply, 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add(self.txtDisply, 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add(self.btnNewDoc, 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add(self.btnClsDoc, 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add(self.gauLoad, 0, wx.ALL|wx.EXPAND, 4)
         # add space
         sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
@@ -180,6 +368,10 @@ class MyFrame(wx.Frame):
         sizer_x.Add(self.choHlFont, 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add(self.sttFntSiz, 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add(self.choFntSiz, 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add(self.sttEngine, 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add(self.choEngine, 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add(self.sttImgDpi, 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add(self.choImgDpi, 0, wx.ALL|wx.EXPAND, 4)
         # options
         sizer_x.Add(self.sttOption, 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add(self.chkLineNo, 0, wx.ALL|wx.EXPAND, 4)
@@ -187,6 +379,8 @@ class MyFrame(wx.Frame):
         sizer_x.Add(self.chkWrapLn, 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add(self.chkInLCss, 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add(self.chkLivePv, 0, wx.ALL|wx.EXPAND, 4)
         # add space
         sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
@@ -194,11 +388,17 @@ class MyFrame(wx.Frame):
         sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add(self.btnConvrt, 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add(self.gauBusy, 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add(self.btnClpTxt, 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add(self.btnClpImg, 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add(self.btnSavImg, 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
         sizer_x.Add(self.btnSavTxt, 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add((20,20), 0, wx.ALL|wx.EXPAND, 4)
+        sizer_x.Add(self.btnExpSet, 0, wx.ALL|wx.EXPAND, 4)
         # fit inside the panel
         self.pnlCtrl.SetSizer(sizer_x)
 
@@ -215,144 +415,484 @@ class MyFrame(wx.Frame):
         self.SetAutoLayout(1)
         self.Show()
 
+    ## Create the webview in place of the panel, once
+    def CreateWebView(self):
+        if self.webView is not None:
+            return
+
+        import wx.html2 as html2
+        with self.stats.Time('webview create'):
+            self.webView = html2.WebView.New(self.pnlWeb)
+            self.pnlWeb.GetSizer().Add(self.webView, 1, wx.EXPAND)
+            self.pnlWeb.Layout()
+        # the virtualized page asks for lines by script messages (wx 4.2)
+        try:
+            self.virtualOk = self.webView.AddScriptMessageHandler(
+                    VIRTUAL_HANDLER)
+            self.webView.Bind(html2.EVT_WEBVIEW_SCRIPT_MESSAGE_RECEIVED,
+                    self.OnScriptMessage)
+        except AttributeError:
+            self.virtualOk = False
+
     ## Compile options and call Highlight
     def OnConvert(self, evt):
+        self.CreateWebView()
 
         # get the selected text region if any
         sel = self.textSrc.GetStringSelection()
 
-        # if none then select entire document instead
+        # if none then select entire document instead, its render is kept
+        self.convDoc = None
         if sel == '':
             sel = self.textSrc.GetValue()
+            self.convDoc = (self.doc, self.doc.version)
 
         # no source to convert?
         if sel == '':
             return
 
-        # construct command line with options
-        cmd = self.hlight
+        # the foreground goes first
+        self.CancelPreRender()
+
+        with self.stats.Time('command'):
+            opts, data = self.EncodeOptions(self.GetOptions(), sel)
+        self.outEncoding = opts['encoding']
+        self.convOpts = opts
+
+        # run highlight in the background, superseding any previous request
+        if (len(data) > STREAM_SIZE and
+                opts.get('output', 'html') in ('html', 'xhtml')):
+            # large input: show the output as it comes
+            self.streamStarted = False
+            self.worker.Submit(opts, data, self.PostStreamChunk)
+        else:
+            self.worker.Submit(opts, data)
+        self.StartBusy()
+        # the live preview page is replaced
+        self.live.Reset()
+        self.liveSeq = None
+
+    ## Source text to bytes in the encoding of the document. Returns the
+    #  options with the encoding set, and the bytes.
+    def EncodeOptions(self, opts, text, doc=None):
+        doc = doc or self.doc
+        return self.renderer.Prepare(text, opts, doc.encoding)
+
+    ## Conversion options from the controls, as a ConvertOptions. The line
+    #  numbers start from the selected region if selected is set, else from
+    #  the top of the document.
+    def GetOptions(self, selected=True):
+
+        # conversion options
+        opts = {}
 
         # syntax
         try:
-            item = self.syntax[self.choSyntax.GetStringSelection()]
+            opts['syntax'] = self.syntax[self.choSyntax.GetStringSelection()]
         except:
             pass
-        else:
-            cmd = cmd + ' --syntax=' + item
 
         # output format
         try:
-            item = self.output[self.choOutput.GetStringSelection()]
+            opts['output'] = self.output[self.choOutput.GetStringSelection()]
         except:
             pass
-        else:
-            cmd = cmd + ' --out-format=' + item
 
         # astyle
         try:
-            item = self.astyle[self.choAstyle.GetStringSelection()]
+            opts['reformat'] = self.astyle[self.choAstyle.GetStringSelection()]
         except:
             pass
-        else:
-            if item == ' ':
-                pass
-            else:
-                cmd = cmd + ' --reformat=' + item
 
         # theme
         try:
-            item = self.themes[self.choThemes.GetStringSelection()]
+            opts['style'] = self.themes[self.choThemes.GetStringSelection()]
         except:
             pass
-        else:
-            cmd = cmd + ' --style=' + item
+
+        # plugin, set in the settings file as there is no control for it
+        if self.settng.get('plugin') in self.plugin:
+            opts['plugin'] = self.settng['plugin']
 
         # font
         facename =  self.choHlFont.GetStringSelection()
         if facename != '':
-            cmd = cmd + ' --font="' + facename + '"'
+            opts['font'] = facename
 
             # size
             size = self.choFntSiz.GetStringSelection()
             if size != '':
-                cmd = cmd + ' --font-size=' + size
-
-        # css option
-        cmd = cmd + ' --include-style'
+                opts['fontsize'] = size
 
         # line numbering
         if self.chkLineNo.GetValue():
-            cmd = cmd + ' --line-numbers'
+            opts['lineno'] = True
 
-            # get the first line of the selected region
-            first_line = sel.splitlines()[0]
+            # start of the selected region, the whole document if none
+            start, end = self.textSrc.GetSelection()
+            if not selected or start == end:
+                start = 0
 
-            # find the line number of the first selected line
-            for index in range(self.textSrc.GetNumberOfLines()):
-                if self.textSrc.GetLineText(index) == first_line:
-                    # set the starting line number
-                    cmd = cmd + ' --line-number-start=' + str(index+1)
-                    break
+            # line of the start position, which may be in the middle of it
+            found, col, line = self.textSrc.PositionToXY(start)
+            if found:
+                # set the starting line number
+                opts['linestart'] = line+1
 
         # wrap
         if self.chkWrapLn.GetValue():
-            cmd = cmd + ' --wrap-simple --wrap-no-numbers'
+            opts['wrap'] = True
 
         # inline CSS
         if self.chkInLCss.GetValue():
-            cmd = cmd + ' --inline-css'
+            opts['inlcss'] = True
+
+        return ConvertOptions.Of(opts)
+
+    ## Source text edited
+    def OnSourceText(self, evt):
+        evt.Skip()
 
-        # tabs to space
-        cmd = cmd + ' --replace-tabs=4'
+        # the render of the document is stale
+        doc = self.DocumentOf(evt.GetEventObject())
+        if doc is not None:
+            doc.Touch()
 
-        # run highlight
-        p = run(cmd, stdout=PIPE, stderr=PIPE, input=sel, encoding='ascii',
-                shell=True)
+        # no preview of a partly loaded file, or of a document in the
+        # background
+        if (not self.chkLivePv.GetValue() or doc is None or
+                doc is not self.doc or doc.loading is not None):
+            return
+
+        # debounce the updates while typing
+        if self.cllLive is None:
+            self.cllLive = wx.CallLater(300, self.OnLiveUpdate)
+        else:
+            self.cllLive.Start(300)
+
+    ## Live preview turned on or off
+    def OnLivePreview(self, evt):
+        if self.chkLivePv.GetValue():
+            self.OnLiveUpdate()
+        else:
+            if self.cllLive is not None:
+                self.cllLive.Stop()
+            self.live.Reset()
+            self.liveSeq = None
+
+    ## Update the live preview
+    def OnLiveUpdate(self):
+        text = self.textSrc.GetValue()
+        if text == '':
+            return
+        self.CreateWebView()
+
+        with self.stats.Time('command'):
+            opts = self.GetOptions(False)
+
+        # the foreground goes first
+        self.CancelPreRender()
+
+        # only html keeps one output line per source line
+        if (opts.get('output', 'html') not in ('html', 'xhtml') or
+                opts.get('wrap') or opts.get('reformat', ' ') != ' '):
+            self.OnConvert(None)
+            return
+
+        # line numbers are drawn by the page itself
+        render = opts.Replace(lineno=False, linestart=0)
+
+        # render the whole document or just the changed region
+        region, self.livePlan = self.live.Plan(text, opts)
+        render, data = self.EncodeOptions(render, region)
+        self.outEncoding = render['encoding']
+        self.liveSeq = self.worker.Submit(render, data)
+
+    ## Post a piece of the streamed output to the window, from the worker.
+    #  Waits while the window is behind, which holds the engine back as
+    #  well. The piece is dropped if the conversion has been superseded.
+    def PostStreamChunk(self, seq, chunk):
+        while not self.streamSlots.acquire(timeout=0.1):
+            if seq != self.worker.seq or not self.worker.running:
+                return
+        wx.CallAfter(self.OnStreamChunk, seq, chunk)
+
+    ## Piece of the streamed output posted back from the worker
+    def OnStreamChunk(self, seq, chunk):
+        self.streamSlots.release()
+
+        # a newer request is on its way
+        if seq != self.worker.seq:
+            return
+
+        # document.write() parses the partial html as it arrives
+        script = 'document.write(' + json.dumps(chunk) + ');'
+        if not self.streamStarted:
+            self.streamStarted = True
+            # start a new document
+            script = 'document.open();' + script
+            self.textOut.Clear()
+            # textOut holds the output
+            self.outText = None
+            self.outBytes = None
+            self.outOpts = self.convOpts
+            self.textStale = False
+            self.virtual = None
+
+        self.webView.RunScript(script)
+        self.textOut.AppendText(chunk)
+
+    ## Conversion result posted back from the worker
+    def OnConverted(self, seq, stdout, stderr):
+
+        # a newer request is on its way
+        if seq != self.worker.seq:
+            return
+
+        self.StopBusy()
+
+        # live preview update, errors are not reported while typing
+        if seq == self.liveSeq:
+            self.liveSeq = None
+            self.virtual = None
+            result = None
+            stdout = stdout.decode(self.outEncoding, 'replace')
+            if stderr == '':
+                result = self.live.Apply(self.livePlan, stdout)
+            if stderr != '':
+                self.live.Reset()
+            elif result is None:
+                # line structure not as expected, show it as it is
+                self.live.Reset()
+                with self.stats.Time('webview', len(stdout)):
+                    self.webView.SetPage(stdout,'')
+            elif result[0] == 'page':
+                with self.stats.Time('webview', len(result[1])):
+                    self.webView.SetPage(result[1],'')
+            else:
+                with self.stats.Time('webview splice', len(result[1])):
+                    self.webView.RunScript(result[1])
+            self.UpdateStats()
+            return
+
+        # end of the streamed output
+        if stdout is None and self.streamStarted:
+            self.webView.RunScript('document.close();')
 
         # error occurred
-        if p.stderr != '':
+        if stderr != '':
             # display error message
-            wx.MessageBox(p.stderr, 'Conversion failed.', wx.ICON_EXCLAMATION)
+            wx.MessageBox(stderr, 'Conversion failed.', wx.ICON_EXCLAMATION)
+
+        elif stdout is not None:
+            self.ShowOutput(stdout, self.outEncoding, self.convOpts)
+
+        # keep the render of the whole document. The streamed one is not
+        # copied out of the view, it is made again when needed.
+        if stderr == '' and stdout is not None and self.convDoc is not None:
+            doc, version = self.convDoc
+            self.docs.SetRender(doc, version, stdout, self.outEncoding)
+        self.convDoc = None
+
+        self.UpdateStats()
+
+    ## Show the conversion output, made with the ConvertOptions given. The
+    #  bytes are decoded for the widgets and kept as they are for saving.
+    def ShowOutput(self, data, encoding, opts):
+        self.CreateWebView()
+        with self.stats.Time('decode', len(data)):
+            stdout = data.decode(encoding, 'replace')
+        self.outBytes = data
+        self.outEncoding = encoding
+        self.outOpts = opts
+
+        page = stdout
+        self.virtual = None
+
+        # large output, render only the lines in view
+        if self.virtualOk and len(stdout) > VIRTUAL_SIZE:
+            doc = VirtualDocument(stdout)
+            if doc.IsValid():
+                self.virtual = doc
+                page = doc.Page()
+
+        # render html output
+        with self.stats.Time('webview', len(page)):
+            self.webView.SetPage(page,'')
+
+        # html source, filled when its page is selected
+        self.outText = stdout
+        self.textStale = True
+        if self.nbkOut.GetCurrentPage() is self.textOut:
+            self.FillTextView()
+
+    ## Fill the text view with the output
+    def FillTextView(self):
+        if self.textStale:
+            self.textStale = False
+            with self.stats.Time('textview', len(self.outText)):
+                self.textOut.SetValue(self.outText)
+
+    ## Output as text
+    def GetOutput(self):
+        if self.outText is not None:
+            return self.outText
+        return self.textOut.GetValue()
+
+    ## Virtualized page asks for the lines in view
+    def OnScriptMessage(self, evt):
+        if self.virtual is None:
+            return
+        script = self.virtual.Window(evt.GetString())
+        if script is not None:
+            with self.stats.Time('webview window', len(script)):
+                self.webView.RunScript(script)
 
-        else:
-            # render html output
-            self.webView.SetPage(p.stdout,'')
-            # html source
-            self.textOut.SetValue(p.stdout)
+    ## Output notebook page changed
+    def OnPageChanged(self, evt):
+        evt.Skip()
+        page = self.nbkOut.GetPage(evt.GetSelection())
+        if page is self.lstStats:
+            self.UpdateStats()
+        elif page is self.textOut:
+            self.FillTextView()
+
+    ## Show the timing statistics
+    def UpdateStats(self):
+        # only when visible
+        if self.nbkOut.GetCurrentPage() is not self.lstStats:
+            return
 
-    ## Copy html source to clipboard
-    def OnClipText(self, evt):
+        self.lstStats.DeleteAllItems()
+        for row, item in enumerate(self.stats.Summary()):
+            self.lstStats.InsertItem(row, item['stage'])
+            self.lstStats.SetItem(row, 1, '%.2f' % (item['last'] * 1000))
+            self.lstStats.SetItem(row, 2, '%.2f' % (item['mean'] * 1000))
+            self.lstStats.SetItem(row, 3, '%.2f' % (item['p95'] * 1000))
+            self.lstStats.SetItem(row, 4, str(item['count']))
+            self.lstStats.SetItem(row, 5, str(item['in']))
+            self.lstStats.SetItem(row, 6, str(item['out']))
+
+    ## Conversion engine changed
+    def OnEngine(self, evt):
+        self.CancelPreRender()
+        backend = self.renderer.SetEngine(self.choEngine.GetStringSelection(),
+                self.themeDir)
+        self.preWorker.SetBackend(backend)
+        self.imgWorker.SetBackend(backend)
+        old = self.worker.SetBackend(backend)
+        old.Close()
+        # the renders are of the other engine
+        for doc in self.docs:
+            doc.Touch()
+
+    ## Theme or output format chosen. The token engine renders the lexed
+    #  source again at once.
+    def OnStyleChoice(self, evt):
+        if (self.choEngine.GetStringSelection() == 'tokens' and
+                not self.textSrc.IsEmpty() and self.doc.loading is None):
+            self.OnConvert(None)
+
+    ## Show busy indicator
+    def StartBusy(self):
+        if not self.tmrBusy.IsRunning():
+            self.tmrBusy.Start(100)
+        self.gauBusy.Pulse()
+
+    ## Hide busy indicator
+    def StopBusy(self):
+        self.tmrBusy.Stop()
+        self.gauBusy.SetValue(0)
+
+    ## Keep the busy indicator moving
+    def OnBusyTimer(self, evt):
+        self.gauBusy.Pulse()
+
+    ## Put the output on the clipboard in the formats named. Each format is
+    #  made only when pasted, and once, with the options of the output shown.
+    def CopyOutput(self, names):
+        text = self.textSrc.GetStringSelection() or self.textSrc.GetValue()
+        if text == '':
+            return
+        opts, data = self.EncodeOptions(self.outOpts or self.GetOptions(),
+                text)
+        clip = ClipPayloads(self.renderer, opts, data, self.GetOutput(),
+                self.GetImageDpi(), self.stats)
 
         if wx.TheClipboard.Open():
-            wx.TheClipboard.SetData(wx.TextDataObject(self.textOut.GetValue()))
+            with self.stats.Time('clipboard'):
+                wx.TheClipboard.SetData(ClipboardData(clip, names))
             wx.TheClipboard.Close()
+            self.UpdateStats()
 
-    ## Copy screen image to clipboard
+    ## Copy the output to clipboard as text, html, rtf and image
+    def OnClipText(self, evt):
+        self.CopyOutput(CLIP_PAYLOADS)
+
+    ## Html of the source for the image export, converted in the background
+    #  and saved by OnImageRendered
+    def RenderImage(self):
+        text = self.textSrc.GetStringSelection() or self.textSrc.GetValue()
+        if text == '':
+            return
+        opts = self.GetOptions().Replace(output='html')
+        opts, data = self.EncodeOptions(opts, text)
+        self.imgJob = (self.imgWorker.Submit(opts, data), opts['encoding'])
+        self.StartBusy()
+
+    ## Html for the image export converted
+    def OnImageRendered(self, seq, stdout, stderr):
+        if self.imgJob is None or seq != self.imgJob[0]:
+            return
+        encoding = self.imgJob[1]
+        self.imgJob = None
+        self.StopBusy()
+
+        if stderr != '':
+            wx.MessageBox(stderr, 'Conversion failed.', wx.ICON_EXCLAMATION)
+            return
+        doc = ParseHtml(stdout.decode(encoding, 'replace'))
+        if doc is not None:
+            self.SaveImageAs(doc)
+
+    ## Resolution of the exported image
+    def GetImageDpi(self):
+        try:
+            return int(self.choImgDpi.GetStringSelection())
+        except ValueError:
+            return 96
+
+    ## Copy the image of the whole output to clipboard
     def OnClipImage(self, evt):
+        self.CopyOutput(['png'])
+
+    ## Save the image of the whole output as SVG or PNG. The output is read
+    #  back if it is html, else the source is converted to html for it.
+    def OnSaveImage(self, evt):
+        doc = ParseHtml(self.GetOutput())
+        if doc is None:
+            self.RenderImage()
+        else:
+            self.SaveImageAs(doc)
 
-        if wx.TheClipboard.Open():
-            # get webView rectangle in the screen coordinate
-            rect = self.webView.GetScreenRect()
-            # apply screen scale
-            rect.x = rect.x * self.scale
-            rect.y = rect.y * self.scale
-            rect.width = rect.width * self.scale
-            rect.height = rect.height * self.scale
-            
-            # prepare screen DC
-            dcScr = wx.ScreenDC()
-            # prepare memory DC
-            bmp = wx.Bitmap(rect.width, rect.height)
-            memDC = wx.MemoryDC()
-            memDC.SelectObject(bmp)
-            # render screen area into the memory DC
-            memDC.Blit(0,0,rect.width,rect.height,dcScr,rect.x,rect.y)
-            # clear memory DC
-            memDC.SelectObject(wx.NullBitmap)
-
-            # copy the bitmap into clipboard
-            wx.TheClipboard.SetData(wx.BitmapDataObject(bmp))
-            wx.TheClipboard.Close()
+    ## Save the image of the highlighted document to the file chosen
+    def SaveImageAs(self, doc):
+        with wx.FileDialog(self, 'Save image',
+                wildcard='SVG files (*.svg)|*.svg|PNG files (*.png)|*.png',
+                style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as dlg:
+
+            if dlg.ShowModal() == wx.ID_OK:
+                path = dlg.GetPath()
+                # extension from the selected type
+                ext = ['.svg', '.png'][dlg.GetFilterIndex()]
+                if not path.lower().endswith(ext):
+                    path = path + ext
+                try:
+                    with self.stats.Time('save image'):
+                        SaveImage(doc, path, self.GetImageDpi())
+                except (ValueError, OSError) as e:
+                    wx.MessageBox(str(e), 'Image Error', wx.ICON_EXCLAMATION)
+                self.UpdateStats()
 
     ## Load source file
     def OnLoadSource(self, evt):
@@ -360,208 +900,486 @@ class MyFrame(wx.Frame):
                 style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as dlg:
 
             if dlg.ShowModal() == wx.ID_OK:
-                fname = dlg.GetPath()
-                self.textSrc.LoadFile(fname)
-                # show file name
-                if 'nt' in os.name:
-                    self.txtFlname.SetValue(fname[fname.rfind('\\')+1:])
-                else:
-                    self.txtFlname.SetValue(fname[fname.rfind('/')+1:])
-
-    ## New source file is loaded
-    def OnSourceName(self, evt):
-        # file name
-        fname = evt.GetString()
-        # file extension
-        ext = fname[fname.rfind('.')+1:]
-
-        value = ''
-
-        # search filetype dict for the match
-        if ext == 'c':
-            # extension .c is not found in the dict
-            value = 'c'
-        elif ext == 'md' or ext == 'MD':
-            # extension .md is not found in the dict
-            value = 'md'
-        elif fname in self.ftmaps['Filenames']:
-            # try filename match first
-            value = self.ftmaps['Filenames'][fname]
-        elif ext in self.ftmaps['Extensions']:
-            # then try file extension match
-            value = self.ftmaps['Extensions'][ext]
-
-        # none found
+                self.OpenFiles([dlg.GetPath()])
+
+    ## Syntax description of the file from its name or its first bytes, empty
+    #  if none found
+    def DetectSyntax(self, fname, head):
+        # search by the file name, then by the content
+        value = self.renderer.Detect(fname, head)
         if value == '':
+            return ''
+        return self.renderer.Describe(value)
+
+    ## Open the files in the document tabs, loaded in the background. An
+    #  empty untitled document is reused for the first one.
+    def OpenFiles(self, fnames):
+        doc = None
+        for fname in fnames:
+            if (doc is None and self.doc.path is None and
+                    self.doc.loading is None and self.textSrc.IsEmpty()):
+                doc = self.doc
+            else:
+                doc = self.NewDocument()
+
+            doc.path = fname
+            doc.name = os.path.basename(fname)
+            self.nbkSrc.SetPageText(self.nbkSrc.FindPage(doc.view),
+                    doc.Title())
+            # settings of the current document, the syntax is detected when
+            # loaded
+            doc.settng = self.GetControls()
+
+            # read only and not redrawn until loaded
+            doc.loading = next(self.loadSerial)
+            doc.view.SetEditable(False)
+            doc.view.Freeze()
+            self.loader.Load(doc.loading, fname)
+
+        if doc is None:
+            return False
+
+        # show the last one
+        self.nbkSrc.ChangeSelection(self.nbkSrc.FindPage(doc.view))
+        if doc is self.doc:
+            self.ShowDocument(doc)
+        else:
+            self.SelectDocument(doc)
+        return True
+
+    ## Document being loaded with the key, None if closed or cancelled
+    def LoadingDocument(self, key):
+        for doc in self.docs:
+            if doc.loading == key:
+                return doc
+        return None
+
+    ## Piece of a file posted back from the loader
+    def OnLoadChunk(self, key, text, done, total):
+        doc = self.LoadingDocument(key)
+        if doc is not None:
+            doc.view.AppendText(text)
+            self.gauLoad.SetValue(int(done * 1000 / total))
+        # ready for the next one
+        self.loader.Release()
+
+    ## File loaded, or failed to
+    def OnLoadDone(self, key, encoding, error):
+        self.gauLoad.SetValue(0)
+        doc = self.LoadingDocument(key)
+        if doc is None:
+            return
+
+        doc.loading = None
+        doc.view.Thaw()
+        doc.view.SetEditable(True)
+        doc.view.SetInsertionPoint(0)
+        doc.view.ShowPosition(0)
+
+        if error != '':
+            wx.MessageBox('Failed to load %s\n%s' % (doc.path, error),
+                    'File Load Error', wx.ICON_EXCLAMATION)
+            return
+
+        # syntax from the file name or the content
+        doc.encoding = encoding
+        desc = self.DetectSyntax(doc.name, doc.view.GetRange(0, SNIFF_SIZE))
+        if desc != '':
+            doc.settng['syntax'] = desc
+        doc.Touch()
+
+        if doc is self.doc:
+            self.ShowDocument(doc)
+
+    ## New empty document, added as the last tab
+    def NewDocument(self):
+        text = wx.TextCtrl(self.nbkSrc, style=wx.TE_MULTILINE)
+        text.Bind(wx.EVT_TEXT, self.OnSourceText)
+        # set droptarget
+        text.SetDropTarget(MyFileDropTarget(self))
+
+        # settings of the current document, none before the controls are set
+        settng = self.GetControls() if self.doc is not None else None
+        doc = self.docs.Add(Document(settng=settng))
+        doc.view = text
+        self.nbkSrc.AddPage(text, doc.Title())
+        return doc
+
+    ## Document of the text control
+    def DocumentOf(self, view):
+        for doc in self.docs:
+            if doc.view is view:
+                return doc
+        return None
+
+    ## New document button
+    def OnNewDoc(self, evt):
+        doc = self.NewDocument()
+        self.nbkSrc.ChangeSelection(self.nbkSrc.FindPage(doc.view))
+        self.SelectDocument(doc)
+
+    ## Close document button. The last one is only cleared.
+    def OnCloseDoc(self, evt):
+        doc = self.doc
+        if doc.loading is not None:
+            self.loader.Cancel(doc.loading)
+            doc.loading = None
+            doc.view.Thaw()
+            doc.view.SetEditable(True)
+
+        if len(self.docs) == 1:
+            self.textSrc.Clear()
+            doc.path = None
+            doc.name = ''
+            self.nbkSrc.SetPageText(0, doc.Title())
+            self.ShowDocument(doc)
             return
 
-        # let's update the syntax choice box
-        for key2, value2 in self.syntax.items():
-            if value == value2:
-                self.choSyntax.SetStringSelection(key2)
-                break
+        if self.preDoc is not None and self.preDoc[0] is doc:
+            self.CancelPreRender()
+        self.docs.Remove(doc)
+        self.nbkSrc.DeletePage(self.nbkSrc.FindPage(doc.view))
+        self.SelectDocument(self.DocumentOf(self.nbkSrc.GetCurrentPage()))
+
+    ## Document tab changed
+    def OnDocChanged(self, evt):
+        evt.Skip()
+        doc = self.DocumentOf(self.nbkSrc.GetPage(evt.GetSelection()))
+        if doc is not None:
+            self.SelectDocument(doc)
+
+    ## Switch to the document, keeping the settings of the previous one
+    def SelectDocument(self, doc):
+        old = self.doc
+        if doc is old:
+            return
+
+        # snapshot of the settings, the render is stale if they changed
+        if old is not None and old in self.docs:
+            settng = self.GetControls()
+            if old.settng is not None and settng != old.settng:
+                old.Touch()
+            old.settng = settng
+
+        self.ShowDocument(doc)
+
+    ## Show the document with its settings and render
+    def ShowDocument(self, doc):
+        self.doc = doc
+        self.textSrc = doc.view
+        self.docs.View(doc)
+
+        # conversions of the previous document are of no use here
+        if self.cllLive is not None:
+            self.cllLive.Stop()
+        self.worker.Cancel()
+        self.StopBusy()
+        self.live.Reset()
+        self.liveSeq = None
+        self.convDoc = None
+
+        # no event, the syntax is in the settings
+        self.txtFlname.ChangeValue(doc.name)
+        if doc.settng is not None:
+            self.SetControls(doc.settng)
+
+        if doc.render is not None:
+            # shown at once, rendered with the settings just set
+            self.ShowOutput(doc.render, doc.renderEncoding,
+                    self.GetOptions(selected=False))
+        else:
+            self.virtual = None
+            self.outBytes = None
+            self.outOpts = None
+            self.outText = ''
+            self.textStale = True
+            if self.webView is not None:
+                self.webView.SetPage('', '')
+            if self.nbkOut.GetCurrentPage() is self.textOut:
+                self.FillTextView()
+            if not self.textSrc.IsEmpty() and doc.loading is None:
+                self.OnConvert(None)
+
+    ## Conversion options from the settings of a document
+    def DocumentOptions(self, doc):
+        # the plugin has no control, it is taken from the settings
+        settng = dict(doc.settng, plugin=self.settng.get('plugin'))
+        opts = SettingsOptions(settng, self.syntax, self.output,
+                self.themes, self.astyle, self.plugin)
+        # same as GetOptions() for the whole document
+        if opts.lineno:
+            opts = opts.Replace(linestart=1)
+        return opts
+
+    ## Render the other documents while idle, one at a time. The first idle
+    #  ends the startup.
+    def OnIdle(self, evt):
+        evt.Skip()
+
+        # first idle, the window is up
+        if self.started is not None:
+            self.OnStarted(time.perf_counter() - self.started)
+            self.started = None
+
+        # the foreground goes first
+        if self.preDoc is not None or self.tmrBusy.IsRunning():
+            return
+
+        doc = self.docs.Pending(self.doc)
+        if doc is None:
+            return
+
+        doc.tried = doc.version
+        text = doc.view.GetValue()
+        if text == '' or doc.settng is None:
+            return
+
+        opts, data = self.EncodeOptions(self.DocumentOptions(doc), text, doc)
+        seq = self.preWorker.Submit(opts, data)
+        self.preDoc = (doc, doc.version, seq, opts['encoding'])
+
+    ## Background render posted back from the worker
+    def OnPreRendered(self, seq, stdout, stderr):
+        if self.preDoc is None or seq != self.preDoc[2]:
+            return
+
+        doc, version, seq, encoding = self.preDoc
+        self.preDoc = None
+        if stderr == '':
+            self.docs.SetRender(doc, version, stdout, encoding)
+
+        # on to the next one
+        wx.WakeUpIdle()
+
+    ## Stop the background render, it is tried again later
+    def CancelPreRender(self):
+        if self.preDoc is not None:
+            self.preWorker.Cancel()
+            self.preDoc[0].tried = None
+            self.preDoc = None
 
     # Save the html text
     def OnSaveFile(self, evt):
-        if self.textOut.GetValue() == '':
+        if self.GetOutput() == '':
             return
 
         with wx.FileDialog(self, 'Save to file',
                 style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as dlg:
 
             if dlg.ShowModal() == wx.ID_OK:
-                self.textOut.SaveFile(dlg.GetPath())
-
-    ## Initialize parameters
-    def InitParams(self):
-
-        # config folders and filetype config file
-        cmd = self.hlight + ' --print-config'
+                # output bytes as they are, the streamed one from textOut
+                data = self.outBytes
+                if data is None:
+                    data = self.textOut.GetValue().encode(self.outEncoding,
+                            'replace')
+                try:
+                    with open(dlg.GetPath(), 'wb') as f:
+                        f.write(data)
+                except:
+                    wx.MessageBox('Failed to save the file',
+                            'File Save Error', wx.ICON_EXCLAMATION)
+
+    ## Render the source into the chosen formats and themes, and write them
+    #  into a folder or a zip file
+    def OnExportSet(self, evt):
+        text = self.textSrc.GetStringSelection() or self.textSrc.GetValue()
+        if text == '':
+            return
 
-        # query config settings
+        # formats, the current one checked
+        formats = sorted(self.output.keys())
+        with wx.MultiChoiceDialog(self, 'Output formats', 'Export Set',
+                formats) as dlg:
+            current = self.choOutput.GetStringSelection()
+            if current in formats:
+                dlg.SetSelections([formats.index(current)])
+            if dlg.ShowModal() != wx.ID_OK or not dlg.GetSelections():
+                return
+            formats = [formats[i] for i in dlg.GetSelections()]
+
+        # themes, the current one checked
+        themes = sorted(self.themes.keys())
+        with wx.MultiChoiceDialog(self, 'Themes', 'Export Set',
+                themes) as dlg:
+            current = self.choThemes.GetStringSelection()
+            if current in themes:
+                dlg.SetSelections([themes.index(current)])
+            if dlg.ShowModal() != wx.ID_OK or not dlg.GetSelections():
+                return
+            themes = [themes[i] for i in dlg.GetSelections()]
+
+        # destination, a zip file or a folder
+        with wx.FileDialog(self, 'Export to',
+                wildcard='Zip files (*.zip)|*.zip|Folder|*',
+                style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as dlg:
+            if dlg.ShowModal() != wx.ID_OK:
+                return
+            path = dlg.GetPath()
+            if dlg.GetFilterIndex() == 0 and not path.lower().endswith('.zip'):
+                path = path + '.zip'
+
+        base = os.path.splitext(self.doc.name)[0] or 'export'
+        # render in the background
+        self.btnExpSet.Disable()
+        self.StartBusy()
+        opts, data = self.EncodeOptions(self.GetOptions(), text)
+        threading.Thread(target=self.RunExport, daemon=True,
+                args=(self.worker.backend, opts, data,
+                    [self.output[f] for f in formats],
+                    [self.themes[t] for t in themes], path, base)).start()
+
+    ## Export thread
+    def RunExport(self, backend, opts, data, formats, themes, path, base):
+        start = time.perf_counter()
         try:
-            p = run(cmd, stdout=PIPE, encoding='ascii')
-        except:
-            wx.MessageBox('Make sure that Highlight is installed properly',
-                    'Highlight Execution Error', wx.ICON_EXCLAMATION)
+            results = ExportSet(backend, opts, data, formats, themes,
+                    self.cache)
+            names = WriteExport(results, path, base)
+        except Exception as e:
+            wx.CallAfter(self.OnExported, None, str(e), 0)
             return
 
-        # collect output
-        output = p.stdout.splitlines()
+        errors = ['%s/%s: %s' % (fmt, theme, err.strip())
+                for fmt, theme, out, err in results if err != '']
+        self.stats.Add('export set', time.perf_counter() - start, len(data),
+                sum(len(r[2]) for r in results))
+        wx.CallAfter(self.OnExported, names, '\n'.join(errors), len(results))
+
+    ## Export finished
+    def OnExported(self, names, errors, total):
+        self.btnExpSet.Enable()
+        self.StopBusy()
+        self.UpdateStats()
+
+        if names is None:
+            wx.MessageBox(errors, 'Export Error', wx.ICON_EXCLAMATION)
+        elif errors != '':
+            wx.MessageBox('%d of %d exported.\n\n%s' % (len(names), total,
+                errors), 'Export Set', wx.ICON_EXCLAMATION)
+        else:
+            wx.MessageBox('%d files exported.' % len(names), 'Export Set',
+                    wx.ICON_INFORMATION)
 
-        for idx, line in enumerate(output):
-            # read config file search path
-            if line == 'Config file search directories:':
-                config_path = output[idx+1]
-            # read filetype config file location
-            elif line == 'Filetype config file:':
-                ftcfg_path = output[idx+1]
+    ## Window is up. The slower parts of the startup run from here.
+    def OnStarted(self, elapsed):
+        self.stats.Add('startup', elapsed)
+        log.info('started in %.1f ms', elapsed * 1000)
 
-        try:
-            # open filetype config
-            ftcfg = open(ftcfg_path, 'r')
-            # enumerate other config files
-            if 'nt' in os.name:
-                themes = glob.glob(config_path + 'themes\\*.theme')
-                syntax = glob.glob(config_path + 'langDefs\\*.lang')
-                plugin = glob.glob(config_path + 'plugins\\*.lua')
-            else:
-                themes = glob.glob(config_path + 'themes/*.theme')
-                syntax = glob.glob(config_path + 'langDefs/*.lang')
-                plugin = glob.glob(config_path + 'plugins/*.lua')
-        except:
-            wx.MessageBox('Failed to retrieve config files',
-                    'Hightlight Config Read Error', wx.ICON_EXCLAMATION)
+        if self.exitOnStart:
+            print('startup %.6f' % elapsed)
+            self.Close()
             return
-        
-        # filetype mappings
-        self.ftmaps = {'Extensions':{},'Filenames':{}}
-        saved = ''
-
-        for line in ftcfg:
-            # previous line continues
-            if saved != '':
-                # concatenate two lines
-                line = saved.rstrip('\r\n') + line.strip(' ')
-                # clear cache
-                saved = ''
-
-            # file extensions
-            if 'Lang' in line and 'Extensions' in line:
-                # unfinished line
-                if line.count('{') != line.count('}'):
-                    # something is not right
-                    if saved != '':
-                        # clear saved to prevent error propagation
-                        saved = ''
-                    # line continues
-                    else:
-                        # save current line to join next
-                        saved = line
-
-                else:
-                    keys = line[line.find('Extensions')+12 : line.rfind(',')]
-                    value = line[line.find('Lang')+6 : line.find('",')]
-                    for key in keys.split(','):
-                        key = key.lstrip('" ').rstrip('" }')
-                        self.ftmaps['Extensions'][key] = value
-
-            # file names
-            elif 'Lang' in line and 'Filenames' in line:
-                # unfinished line
-                if line.count('{') != line.count('}'):
-                    # something is not right
-                    if saved != '':
-                        # clear saved to prevent error propagation
-                        saved = ''
-                    # line continues
-                    else:
-                        # save current line to join next
-                        saved = line
-
-                else:
-                    keys = line[line.find('Filenames')+11 : line.rfind('"}') + 1]
-                    value = line[line.find('Lang')+6 : line.find('",')]
-                    for key in keys.split(','):
-                        key = key.lstrip('" ').rstrip('" ')
-                        self.ftmaps['Filenames'][key] = value
-
-            # ignore shebang
-            elif 'Lang' in line and 'Shebang' in line:
-                pass
-
-            # ignore empty line
-            elif line == '':
-                pass
-
-        # themes
-        self.themes = {}
-        for item in themes:
-            # description as key
-            self.themes[self.GetDescription(item)] = self.GetFileName(item)
-
-        # syntax (langDefs)
-        self.syntax = {}
-        for item in syntax:
-            # description as key
-            self.syntax[self.GetDescription(item)] = self.GetFileName(item)
-        
-        # plugin
-        self.plugin = {}
-        for item in plugin:
-            # file name as key
-            self.plugin[self.GetFileName(item)] = self.GetDescription(item)
-
-        # outputs formats
-        self.output = {'html':'html','xhtml':'xhtml','latex':'latex',
-                'tex':'tex','odt':'odt','rtf':'rtf','ansi':'ansi','svg':'svg',
-                'xterm256':'xterm256','truecolor':'truecolor','pango':'pango',
-                'bbcode':'bbcode'}
-
-        # reformat
-        self.astyle = {' ':' ','allman':'allman','banner':'banner',
-                'gnu':'gnu', 'horstmann':'horstmann','java':'java','kr':'kr',
-                'linux':'linux','mozilla':'mozilla','pico':'pico','lisp':'lisp'}
-
-        # option
-        self.settng = {'themes':'vim molokai', 'syntax':'C and C++',
-                'output':'html', 'astyle':' ', 'plugin':None,
-                'hlfont': 'Courier New', 'fntsiz':'10', 
-                'option':{'lineno':1, 'wrapln':0, 'inlcss':0} }
 
+        self.EnumerateFonts()
+
+    ## Fill the font choices, keeping the selection
+    def SetFonts(self, fonts):
+        sel = self.choHlFont.GetStringSelection() or self.settng['hlfont']
+        self.choHlFont.Set(fonts)
+        if sel:
+            self.choHlFont.SetStringSelection(sel)
+
+    ## Enumerate the fixed-width fonts once the window is shown. It runs in
+    #  the GUI thread, as the enumerator is not thread-safe everywhere. The
+    #  list is kept in the settings for the next start.
+    def EnumerateFonts(self):
+        with self.stats.Time('fonts'):
+            fe = wx.FontEnumerator()
+            fe.EnumerateFacenames(fixedWidthOnly=True)
+            # we don't need vertical fonts
+            fonts = sorted(f for f in fe.GetFacenames() if f[0] != '@')
+
+        if fonts != self.settng.get('fonts'):
+            self.settng['fonts'] = fonts
+            self.SetFonts(fonts)
+
+    ## Check the highlight metadata in the background, and scan the
+    #  installation again if it is missing or stale
+    def RefreshParams(self):
+        def Run():
+            start = time.perf_counter()
+            try:
+                meta = self.store.LoadMetadata()
+                if meta is not None:
+                    wx.CallAfter(self.SetCacheStamp, meta)
+                    return
+                meta = DiscoverParams(self.hlight, self.store.FileCache())
+            except ConfigError as e:
+                wx.CallAfter(self.InitParams, None, e.args)
+            else:
+                self.stats.Add('discover', time.perf_counter() - start)
+                wx.CallAfter(self.InitParams, meta)
+
+        threading.Thread(target=Run, daemon=True).start()
+
+    ## Use the disk cache for the installation of the metadata checked. The
+    #  legacy metadata has no stamp, the cache is then kept in memory.
+    def SetCacheStamp(self, meta):
+        if meta.get('stamp'):
+            self.cache.SetStamp(CacheStamp(meta['stamp']))
+
+    ## Take the metadata scanned in the background. error is (message,
+    #  title) if the scan failed.
+    def InitParams(self, meta, error=None):
+
+        if error is not None:
+            # keep the metadata of the last run
+            if self.metaCached:
+                return
+            # fall back to the legacy parameters if any
+            meta = self.store.LegacyMetadata()
+            if meta is None:
+                wx.MessageBox(error[0], error[1], wx.ICON_EXCLAMATION)
+                return
+        else:
+            try:
+                self.store.SaveMetadata(meta)
+            except:
+                wx.MessageBox('Failed to save the highlight metadata',
+                        'Parameter Save Error', wx.ICON_EXCLAMATION)
+
+        # selections made meanwhile are kept
+        self.UpdateSettings()
+        self.SetMetadata(meta)
+        self.SetCacheStamp(meta)
+        self.metaCached = True
+        self.FillChoices()
+        self.SetControls(self.settng)
+        # the token engine reads the themes found
+        if self.choEngine.GetStringSelection() == 'tokens':
+            self.OnEngine(None)
+
+    ## Take the choice lists from the metadata
+    def SetMetadata(self, meta):
+        # filetype index is rebuilt on demand
+        self.renderer.SetMetadata(meta)
+        self.syntax = meta['syntax']
+        self.themes = meta['themes']
+        self.plugin = meta['plugin']
+        self.output = meta['output']
+        self.astyle = meta['astyle']
+        # theme files, read by the token engine
+        paths = meta.get('paths') or {}
+        self.themeDir = (os.path.join(paths['config'], 'themes') if
+                paths.get('config') else None)
 
     ## Load parameters
     def LoadParams(self):
-        try:
-            f = open('wxhighlight.cfg', 'rb')
-        except:
-            wx.MessageBox('Parametes Not found...  Initializing...',
-                    'Parameter Load Error', wx.ICON_INFORMATION)
-            # if not found then initialize it
-            self.InitParams()
-        else:
-            (self.ftmaps, self.syntax, self.themes, self.plugin, self.output,
-                    self.astyle, self.settng) = pickle.load(f)
+        self.store = self.renderer.Store()
+        # user settings
+        self.settng = self.store.LoadSettings()
+        # fonts found on the last run, enumerated again once started
+        self.SetFonts(self.settng.get('fonts') or [])
+
+        # highlight metadata of the last run, checked in the background
+        meta = self.store.LoadMetadata(check=False)
+        self.metaCached = meta is not None
+        if meta is None:
+            # empty choices until scanned
+            meta = {'syntax':{}, 'themes':{}, 'plugin':{},
+                    'output':OUTPUT_FORMATS, 'astyle':ASTYLE_STYLES}
+        self.SetMetadata(meta)
+        self.RefreshParams()
 
         # controls should be updated by the parameters
         self.UpdateControls()
@@ -572,109 +1390,108 @@ class MyFrame(wx.Frame):
         self.UpdateSettings()
 
         try:
-            f = open('wxhighlight.cfg', 'wb')
+            with self.stats.Time('saveparams'):
+                self.store.SaveSettings(self.settng)
         except:
-            wx.MessageBox('Failed to save wxhighlight.cfg',
+            wx.MessageBox('Failed to save the settings',
                     'Parameter Save Error', wx.ICON_EXCLAMATION)
-        else:
-            pickle.dump((self.ftmaps, self.syntax, self.themes, self.plugin,
-                self.output, self.astyle, self.settng), f)
 
-    ## Discovery screen scale
-    #  \note This does not work on the second monitor
+    ## Display scale of the window, for information. The image export does
+    #  not depend on it.
     def InitScale(self):
-
-        # This issue is unique in Windows
-        if 'nt' in os.name:
-            import multiprocessing as mp
-            ctx = mp.get_context('spawn')
-            q = ctx.Queue()
-            p = ctx.Process(target=SystemMetrics, args=(q,))
-            p.start()
-            sm = q.get()
-            self.scale = sm / ctypes.windll.user32.GetSystemMetrics(0)
-            p.join()
-        # in Linux it should work without the scaling
-        else:
-            self.scale = 1.0
+        self.scale = self.GetContentScaleFactor()
         # show the scale
         self.txtDisply.SetLabel('{:.2f}'.format(self.scale))
 
 
+    ## Fill the choice boxes from the metadata
+    def FillChoices(self):
+        self.choSyntax.Set(list(self.syntax.keys()))
+        self.choOutput.Set(list(self.output.keys()))
+        self.choThemes.Set(list(self.themes.keys()))
+        self.choAstyle.Set(list(self.astyle.keys()))
+
     ## Fill the choice boxes and set the option check boxes
     def UpdateControls(self):
 
-        for key in self.syntax.keys():
-            self.choSyntax.Append(key)
-        for key in self.output.keys():
-            self.choOutput.Append(key)
-        for key in self.themes.keys():
-            self.choThemes.Append(key)
-        for key in self.astyle.keys():
-            self.choAstyle.Append(key)
-
-        if self.settng['syntax']:
-            self.choSyntax.SetStringSelection(self.settng['syntax'])
-        if self.settng['output']:
-            self.choOutput.SetStringSelection(self.settng['output'])
-        if self.settng['themes']:
-            self.choThemes.SetStringSelection(self.settng['themes'])
-        if self.settng['astyle']:
-            self.choAstyle.SetStringSelection(self.settng['astyle'])
-        if self.settng['hlfont']:
-            self.choHlFont.SetStringSelection(self.settng['hlfont'])
-        if self.settng['fntsiz']:
-            self.choFntSiz.SetStringSelection(self.settng['fntsiz'])
-
-        if self.settng['option']:
-            self.chkLineNo.SetValue(self.settng['option']['lineno'])
-            self.chkWrapLn.SetValue(self.settng['option']['wrapln'])
-            self.chkInLCss.SetValue(self.settng['option']['inlcss'])
+        self.FillChoices()
+        self.SetControls(self.settng)
+        if not self.choImgDpi.SetStringSelection(
+                self.settng.get('imgdpi', '96')):
+            self.choImgDpi.SetSelection(0)
+        # older settings have no engine
+        if not self.choEngine.SetStringSelection(
+                self.settng.get('engine', 'highlight')):
+            self.choEngine.SetSelection(0)
 
         self.Refresh()
 
+    ## Set the controls from the settings of a document
+    def SetControls(self, settng):
+
+        if settng['syntax']:
+            self.choSyntax.SetStringSelection(settng['syntax'])
+        if settng['output']:
+            self.choOutput.SetStringSelection(settng['output'])
+        if settng['themes']:
+            self.choThemes.SetStringSelection(settng['themes'])
+        if settng['astyle']:
+            self.choAstyle.SetStringSelection(settng['astyle'])
+        if settng['hlfont']:
+            self.choHlFont.SetStringSelection(settng['hlfont'])
+        if settng['fntsiz']:
+            self.choFntSiz.SetStringSelection(settng['fntsiz'])
+
+        if settng['option']:
+            self.chkLineNo.SetValue(settng['option']['lineno'])
+            self.chkWrapLn.SetValue(settng['option']['wrapln'])
+            self.chkInLCss.SetValue(settng['option']['inlcss'])
+
+    ## Settings of a document from the controls
+    def GetControls(self):
+        return {'syntax':self.choSyntax.GetStringSelection(),
+                'output':self.choOutput.GetStringSelection(),
+                'themes':self.choThemes.GetStringSelection(),
+                'astyle':self.choAstyle.GetStringSelection(),
+                'hlfont':self.choHlFont.GetStringSelection(),
+                'fntsiz':self.choFntSiz.GetStringSelection(),
+                'option':{'lineno':self.chkLineNo.GetValue(),
+                    'wrapln':self.chkWrapLn.GetValue(),
+                    'inlcss':self.chkInLCss.GetValue()}}
+
 
     ## Update settings dict
     def UpdateSettings(self):
 
-        self.settng['syntax'] = self.choSyntax.GetStringSelection()
-        self.settng['output'] = self.choOutput.GetStringSelection()
-        self.settng['themes'] = self.choThemes.GetStringSelection()
-        self.settng['astyle'] = self.choAstyle.GetStringSelection()
-        self.settng['hlfont'] = self.choHlFont.GetStringSelection()
-        self.settng['fntsiz'] = self.choFntSiz.GetStringSelection()
-        self.settng['option']['lineno'] = self.chkLineNo.GetValue()
-        self.settng['option']['wrapln'] = self.chkWrapLn.GetValue()
-        self.settng['option']['inlcss'] = self.chkInLCss.GetValue()
+        # choices not filled yet keep the saved selection
+        self.settng.update((key, value) for key, value in
+                self.GetControls().items() if value != '')
+        self.settng['engine'] = self.choEngine.GetStringSelection()
+        self.settng['imgdpi'] = self.choImgDpi.GetStringSelection()
 
 
-    ## Get the Description string from the file
-    def GetDescription(self, fname):
-        try:
-            f = open(fname, 'r')
-        except:
-            return ''
-        else:
-            for line in f:
-                if 'Description' in line:
-                    return line[line.find('"')+1:line.rfind('"')]
-
-
-    ## Get the Filename from the path string
-    def GetFileName(self, fpath):
-        if 'nt' in os.name:
-            return fpath[fpath.rfind('\\')+1:fpath.rfind('.')]
-        else:
-            return fpath[fpath.rfind('/')+1:fpath.rfind('.')]
-
     ## wx.EVT_CLOSE handler
     def OnClose(self, evt):
+        self.tmrBusy.Stop()
+        self.worker.Stop()
+        self.preWorker.Stop()
+        self.imgWorker.Stop()
+        self.loader.Stop()
+        self.worker.backend.Close()
         self.SaveParams()
         evt.Skip()
 
 
 if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Highlight wxPython GUI')
+    parser.add_argument('--startup', action='store_true',
+            help='print the startup time and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+            format='%(asctime)s %(name)s: %(message)s')
     app = wx.App()
-    frame = MyFrame(None, -1, "Highlight wxPython GUI", size=(1100,800))
+    frame = MyFrame(None, -1, "Highlight wxPython GUI", size=(1100,800),
+            exitOnStart=args.startup)
     app.MainLoop()
 